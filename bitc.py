@@ -0,0 +1,185 @@
+# micropython ESP32
+# chunked bitstream container reader
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# ".bitc" file made by tools/bitcpack.py:
+# header (32 bytes, little endian)
+#   "BITC" version wbits 0 0
+#   idcode (0: any) length chunk_size nchunks usercode crc32
+# index, 16 bytes per chunk
+#   file offset, compressed size, crc32 of chunk data, method 0 0 0
+# crc32 of header and index
+# chunk data
+# chunks are compressed independently, each can be read
+# and checked alone, so a stream can start at any chunk.
+# method | method_zero_runs: chunk starts with a table of
+# zero runs: count, then (literal bytes, zero bytes) pairs,
+# followed by the compressed literal bytes only.
+# crc32 of such chunk is of the table and the literals.
+# usage:
+# import bitc
+# f = bitc.ChunkIO(open("blink.bitc", "rb"))
+# f.readinto(buf)
+# or without copy, zero runs come from zero_buf:
+# mv = f.readspan(4096)
+
+from struct import unpack_from
+from binascii import crc32
+
+magic = b"BITC"
+method_stored  = 0
+method_deflate = 1 # raw deflate, 2^wbits window
+method_lz4     = 2 # LZ4 block, see unlz4.py
+method_zero_runs = 0x10
+
+# zero runs are sent from here, never written
+zero_buf = bytearray(4096)
+
+# read until buf is full or end of file
+def readinto_full(stream, buf):
+  mv = memoryview(buf)
+  n = 0
+  while n < len(mv):
+    r = stream.readinto(mv[n:])
+    if not r:
+      break
+    n += r
+  return n
+
+class ChunkIO:
+  # chunk: first chunk to read, see seek_chunk()
+  def __init__(self, stream, chunk=0):
+    self.stream = stream
+    h = bytearray(32)
+    if readinto_full(stream, h) != 32 or h[0:4] != magic:
+      raise ValueError("not BITC container")
+    if h[4] != 1:
+      raise ValueError("BITC version %d" % h[4])
+    self.wbits = h[5]
+    self.idcode, self.length, self.chunk_size, self.nchunks, self.usercode, self.crc = unpack_from("<6I", h, 8)
+    self.index = bytearray(16*self.nchunks)
+    c = bytearray(4)
+    readinto_full(stream, self.index)
+    readinto_full(stream, c)
+    if crc32(self.index, crc32(h)) != unpack_from("<I", c)[0]:
+      raise ValueError("BITC index CRC")
+    self.here = 36 + len(self.index) # stream position
+    csize = 0
+    for i in range(self.nchunks):
+      csize = max(csize, unpack_from("<I", self.index, 16*i+4)[0])
+    self.src = bytearray(csize)
+    self.out = None
+    self.seek_chunk(chunk)
+
+  # continue from chunk k, returns its offset in the bitstream.
+  # forward on any stream, backward if the stream can seek
+  def seek_chunk(self, k):
+    self.next = k
+    self.data = memoryview(self.src)[:0] # literals of current chunk
+    self.pos = 0
+    self.runs = self.data # zero run table
+    self.nruns = 0
+    self.run = 0
+    self.lit = 0 # literal bytes before next zero run
+    self.zero = 0 # zero bytes left in current run
+    return k*self.chunk_size
+
+  # stream to file offset
+  def skip_to(self, offset):
+    if offset != self.here:
+      if hasattr(self.stream, "seek"):
+        self.stream.seek(offset)
+      elif offset > self.here:
+        while self.here < offset:
+          n = readinto_full(self.stream, memoryview(self.src)[:min(len(self.src), offset-self.here)])
+          if n == 0:
+            raise ValueError("BITC truncated")
+          self.here += n
+      else:
+        raise ValueError("BITC can't seek back")
+      self.here = offset
+
+  # read, decompress and check chunk k to self.data
+  # and zero runs to self.runs
+  # a bad chunk is read once more if the stream can seek
+  def read_chunk(self, k):
+    offset, n, crc, method = unpack_from("<IIIB", self.index, 16*k)
+    size = min(self.chunk_size, self.length-k*self.chunk_size)
+    for retry in range(2):
+      self.skip_to(offset)
+      src = memoryview(self.src)[:n]
+      if readinto_full(self.stream, src) != n:
+        raise ValueError("BITC truncated")
+      self.here += n
+      self.nruns = 0
+      c = 0 # crc32 of zero run table
+      l = n
+      if method & method_zero_runs:
+        t = 4+8*unpack_from("<I", src)[0]
+        if t <= n:
+          self.nruns = (t-4)//8
+          self.runs = src[4:t]
+          c = crc32(src[:t])
+          src = src[t:]
+          l = n-t
+      m = method & ~method_zero_runs
+      if m == method_stored:
+        self.data = src
+      elif m == method_lz4:
+        import unlz4
+        if self.out is None:
+          self.out = bytearray(self.chunk_size)
+        self.data = memoryview(self.out)[:max(0, unlz4.lz4_block(src, l, self.out, size))]
+      elif m == method_deflate:
+        import uzlib
+        self.data = memoryview(uzlib.decompress(src, -self.wbits))
+      else:
+        raise ValueError("BITC method %d" % method)
+      z = 0
+      for i in range(self.nruns):
+        z += unpack_from("<I", self.runs, 8*i+4)[0]
+      if len(self.data)+z == size and crc32(self.data, c) == crc:
+        return
+      if not hasattr(self.stream, "seek"):
+        break
+    raise ValueError("BITC chunk %d CRC" % k)
+
+  # next piece of at most n bytes without copy:
+  # decompressed literals or zero_buf for a zero run,
+  # empty at end of bitstream
+  def readspan(self, n):
+    while True:
+      if self.lit:
+        n = min(n, self.lit)
+        self.lit -= n
+        self.pos += n
+        return self.data[self.pos-n:self.pos]
+      if self.zero:
+        n = min(n, self.zero, len(zero_buf))
+        self.zero -= n
+        return memoryview(zero_buf)[:n]
+      if self.run < self.nruns:
+        self.lit, self.zero = unpack_from("<II", self.runs, 8*self.run)
+        self.run += 1
+      elif self.pos < len(self.data):
+        self.lit = len(self.data)-self.pos
+      elif self.next < self.nchunks:
+        self.read_chunk(self.next)
+        self.next += 1
+        self.pos = 0
+        self.run = 0
+      else:
+        return memoryview(zero_buf)[:0]
+
+  def readinto(self, buf):
+    mv = self.readspan(len(buf))
+    buf[:len(mv)] = mv
+    return len(mv)
+
+# header of a container file: idcode, length, chunk_size, usercode
+def info(filename):
+  with open(filename, "rb") as f:
+    c = ChunkIO(f)
+    return c.idcode, c.length, c.chunk_size, c.usercode
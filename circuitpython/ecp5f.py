@@ -117,21 +117,34 @@ def flash_read(data, addr=0):
   flash_read_block(data, addr)
   flash_close()
 
-def compare_flash_file_buf(flash_b, file_b, must:int) -> int:
-  flash_block = memoryview(flash_b)
-  file_block = memoryview(file_b)
-  l = int(len(file_b))
-  for i in range(l):
-    if (flash_block[i] & file_block[i]) != file_block[i]:
-      must = 1
-  if must: # erase will reset all bytes to 0xFF
-    for i in range(l):
-      if file_block[i] != 0xFF:
-        must = 3
-  else: # no erase
-    for i in range(l):
-      if flash_block[i] != file_block[i]:
-        must = 2
+# compare flash and file block in one pass,
+# whole pages at a time, file_b[0] is page p0.
+# flags of each page:
+# bit 0: differs from flash, must be written without erase
+# bit 1: not all 0xFF, must be written after erase
+# return value
+# 0-must nothing, 1-must erase, 2-must write, 3-must erase and write
+# bit 2: some page differs, bit 3: some page not all 0xFF,
+# kept for the next part of the same erase block
+def compare_flash_file_buf(flash_b, file_b, flags, p0:int, page:int, must:int) -> int:
+  blank = b"\xFF"*page
+  p = p0
+  for i in range(0, len(file_b), page):
+    flash_page = flash_b[i:i+page]
+    file_page = file_b[i:i+page]
+    if flash_page != file_page:
+      flags[p] |= 1
+      if not must & 1:
+        for j in range(len(file_page)):
+          if (flash_page[j] & file_page[j]) != file_page[j]:
+            must |= 1
+            break
+    if file_page != blank[:len(file_page)]:
+      flags[p] |= 2
+    must |= flags[p] << 2
+    p += 1
+  if must & (8 if must & 1 else 4): # erase resets all bytes to 0xFF
+    must |= 2
   return must
 
 def flash_stream(filedata, addr=0):
@@ -146,6 +159,9 @@ def flash_stream(filedata, addr=0):
   count_total = 0
   count_erase = 0
   count_write = 0
+  count_page = 0
+  page_flag = bytearray(flash_erase_size//flash_write_size)
+  page_none = bytes(len(page_flag))
   file_block = bytearray(flash_erase_size)
   flash_block = bytearray(flash_read_size)
   file_blockmv=memoryview(file_block)
@@ -156,12 +172,13 @@ def flash_stream(filedata, addr=0):
     while retry > 0:
       must = 0
       flash_rd = 0
+      page_flag[:] = page_none
       while flash_rd<flash_erase_size:
         flash_read_block(flash_block,addr+bytes_uploaded+flash_rd)
-        must = compare_flash_file_buf(flash_block,file_blockmv[flash_rd:flash_rd+flash_read_size],must)
+        must = compare_flash_file_buf(flash_block,file_blockmv[flash_rd:flash_rd+flash_read_size],page_flag,flash_rd//flash_write_size,flash_write_size,must)
         flash_rd+=flash_read_size
       write_addr = addr+bytes_uploaded
-      if must == 0:
+      if not must & 3:
         if (write_addr & 0xFFFF) == 0:
           print("\r0x%06X %dK %c" % (write_addr, flash_erase_size>>10, progress_char),end="")
         else:
@@ -178,11 +195,15 @@ def flash_stream(filedata, addr=0):
         progress_char = "e"
       if must & 2: # must_write:
         #print("from 0x%06X write %dK" % (write_addr, flash_erase_size>>10),end="\r")
+        # only pages that differ, after erase only not all 0xFF
+        page_must = 2 if must & 1 else 1
         block_addr = 0
         next_block_addr = 0
         while next_block_addr < len(file_block):
           next_block_addr = block_addr+flash_write_size
-          flash_write_block(file_blockmv[block_addr:next_block_addr], addr=write_addr)
+          if page_flag[block_addr//flash_write_size] & page_must:
+            flash_write_block(file_blockmv[block_addr:next_block_addr], addr=write_addr)
+            count_page += 1
           write_addr += flash_write_size
           block_addr = next_block_addr
         count_write += 1
@@ -191,7 +212,7 @@ def flash_stream(filedata, addr=0):
       break
   print("\r",end="")
   stopwatch_stop(bytes_uploaded)
-  print("%dK blocks: %d total, %d erased, %d written." % (flash_erase_size>>10, count_total, count_erase, count_write))
+  print("%dK blocks: %d total, %d erased, %d written (%d pages)." % (flash_erase_size>>10, count_total, count_erase, count_write, count_page))
   return retry > 0 # True if successful
 
 def flash(filepath, addr=0, close=True):
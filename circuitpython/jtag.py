@@ -18,9 +18,36 @@ gpio_tck = board.IO36
 gpio_tdo = board.IO37
 gpio_tms = board.IO38  # BLUE LED - 549ohm - 3.3V
 
-spi_freq = const(40000000) # Hz JTAG clk frequency
+spi_freq = 40000000 # Hz JTAG clk frequency, config_file overrides
+config_file = "jtag.conf" # per-board settings "name:value", see calibrate()
 hwspi=None
 
+# per-board settings, written by calibrate()
+def load_config():
+  global spi_freq
+  try:
+    with open(config_file) as f:
+      for line in f:
+        # blank, hand-edited or half-written lines keep defaults
+        item = line.strip().split(":", 1)
+        if len(item) != 2:
+          continue
+        name = item[0]
+        try:
+          value = int(item[1])
+        except ValueError:
+          continue
+        if name == "spi_freq":
+          spi_freq = value
+  except (OSError, ValueError): # ValueError: not UTF-8 text
+    pass
+
+def save_config():
+  with open(config_file, "w") as f:
+    f.write("spi_freq:%d\n" % spi_freq)
+
+load_config()
+
 
 def bitbang_tms_on():
   global tms
@@ -212,6 +239,94 @@ def idcode():
   bitbang_tms_off()
   return unpack("<I", id_bytes)[0]
 
+# hwspi TCK frequencies tried by calibrate(), 80 MHz APB divided
+calibrate_freqs = (5000000, 8000000, 10000000, 13333333, 16000000, 20000000, 26666666, 40000000)
+
+# bit offset of n bits of t (MSB first) in rx, -1 if not found
+def find_bits(rx, t, n):
+  l = 8*len(rx)
+  r = int.from_bytes(rx, "big")
+  m = (1 << n) - 1
+  for d in range(min(32, l-n+1)):
+    if (r >> (l-d-n)) & m == t:
+      return d
+  return -1
+
+# TAP from "select DR scan" to "shift DR",
+# hwspi at freq shifts tx and reads rx
+def calibrate_shift(freq, tx, rx):
+  send_tms(0) # -> capture DR
+  #send_tms(0) # -> shift DR NOTE will be send during TCK glitch
+  bitbang_jtag_off() # NOTE TCK glitch
+  spi_jtag_on()
+  hwspi.configure(baudrate=freq,polarity=1,phase=1)
+  hwspi.write_readinto(tx, rx)
+  spi_jtag_off()
+  bitbang_jtag_on()
+
+# hwspi readback at freq of a pattern thru BYPASS
+# and of IDCODE id. returns bit offsets, -1 if not found
+def calibrate_read(freq, tx, rx, rxid, id):
+  bitbang_tms_on()
+  bitbang_jtag_on()
+  reset_tap()
+  runtest_idle(1,0)
+  sir(b"\xFF") # BYPASS
+  calibrate_shift(freq, tx, rx)
+  reset_tap()
+  runtest_idle(1,0) # IDCODE after reset
+  calibrate_shift(freq, bytearray(b"\xFF"*len(rxid)), rxid)
+  reset_tap()
+  bitbang_jtag_off()
+  bitbang_tms_off()
+  # IDCODE is shifted LSB first
+  idrev = 0
+  for i in range(32):
+    idrev = (idrev << 1) | ((id >> i) & 1)
+  return find_bits(rx, int.from_bytes(tx, "big") >> 32, 8*len(tx)-32), find_bits(rxid, idrev, 32)
+
+# find highest hwspi TCK frequency with reliable readback,
+# keep one step below it as safety margin and save to config_file.
+# the filesystem is read-only while USB storage is mounted,
+# then copy config_file to it from the host.
+# returns selected frequency, 0 if none works
+def calibrate(repeat=4, save=True):
+  global spi_freq
+  id = idcode()
+  if id == 0 or id == 0xFFFFFFFF:
+    print("calibrate: no JTAG device")
+    return 0
+  tx = bytearray([(i*0x3B+0x5A)&0xFF for i in range(64)])
+  rx = bytearray(len(tx))
+  rxid = bytearray(8)
+  ref = None
+  good = -1
+  for i in range(len(calibrate_freqs)):
+    freq = calibrate_freqs[i]
+    ok = True
+    for n in range(repeat):
+      d = calibrate_read(freq, tx, rx, rxid, id)
+      if ref is None:
+        ref = d # offsets at lowest frequency are the reference
+      if d != ref or -1 in d:
+        ok = False
+        break
+    print("%d Hz %s" % (freq, "ok" if ok else "fail"))
+    if not ok:
+      break
+    good = i
+  if good < 0:
+    print("calibrate: fails at lowest frequency")
+    return 0
+  spi_freq = calibrate_freqs[max(0, good-1)]
+  print("spi_freq = %d Hz" % spi_freq)
+  if save:
+    try:
+      save_config()
+    except OSError:
+      print("%s read-only, copy \"spi_freq:%d\" to %s" % (config_file, spi_freq, config_file))
+  return spi_freq
+
 # common JTAG open for both program and flash
 def common_open():
   bitbang_tms_on()
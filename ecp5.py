@@ -9,9 +9,15 @@
 from time import ticks_ms, sleep_ms
 from machine import SPI, Pin
 from micropython import const
-from struct import unpack
+from struct import pack, unpack, unpack_from, pack_into
+from array import array
 from uctypes import addressof
-from gc import collect
+from gc import collect, mem_free
+from os import stat
+try:
+  import _thread
+except ImportError:
+  _thread = None
 
 # FJC-ESP32-V0r2 pluggable
 #gpio_tms = const(4)
@@ -35,32 +41,149 @@ gpio_led = const(5)
 #gpio_tcknc = const(21) # 1,2,3,19,21 free pin for SPI workaround
 #gpio_led = const(19)
 
-spi_freq = const(25000000) # Hz JTAG clk frequency
+spi_freq = 25000000 # Hz JTAG clk frequency, config_file overrides
+config_file = "ecp5.conf" # per-board settings "name:value", see calibrate()
+# 1: flash_stream() keeps CRC32 of each erase block it has
+# verified in flash, in a file per FPGA and flash chip, and skips
+# blocks whose file CRC32 matches without reading flash back.
+# only valid while nothing else writes the flash,
+# flash(..., verify=1) reads all back and rebuilds the index
+flash_shadow = 0
+flash_shadow_file = "ecp5flash%08x%06x.idx" # IDCODE, JEDEC ID, see flash_shadow_load()
+gz_wbits = 15 # deflate window of last opened .gz, see open_gz()
+gz_stream = None # its compressed stream, gzip trailer follows deflate data
+web_length = None # HTTP Content-Length of last open_web()
+# RAM for decompressed bitstreams of prog(), see cache_load()
+# 0: off, -1: quarter of free RAM if more than 1 MB (WROVER PSRAM)
+cache_budget = 0
+cache = [] # [filepath, (size, mtime, bitstream size), bitstream, CRC32], least recently used first
 # -1 for JTAG over SOFT SPI slow, compatibility
 #  1 or 2 for JTAG over HARD SPI fast
 #  2 is preferred as it has default pinout wired
 flash_read_size = const(2048)
-flash_write_size = const(256)
-flash_erase_size = const(4096)
-flash_erase_cmd = { 4096:0x20, 32768:0x52, 65536:0xD8, 262144:0xD8 } # erase commands from FLASH PDF
-flash_era = bytearray([flash_erase_cmd[flash_erase_size],0,0])
-#rb=bytearray(256) # reverse bits
-#init_reverse_bits()
+# flash chip parameters, set by flash_open() from JEDEC ID and SFDP, see flash_config()
+flash_jedec = 0 # JEDEC ID: manufacturer, memory type, capacity
+flash_size = 0 # bytes, 0: unknown
+flash_write_size = 256 # page
+flash_erase_size = 4096
+flash_erase_ms = 2002 # erase busy timeout
+flash_erase_cmd = { 4096:0x20, 32768:0x52, 65536:0xD8, 262144:0xD8 } # erase commands from FLASH PDF, chips without SFDP
+flash_cmd4 = { 0x03:0x13, 0x02:0x12, 0x20:0x21, 0x52:0x5C, 0xD8:0xDC } # 4-byte address commands
+flash_read_cmd = 0x03
+flash_write_cmd = 0x02
+flash_addr_len = 3 # 4 above 16MB, with commands from flash_cmd4
+# largest erase block flash_stream() may use, it buffers two of them.
+# 4K fits on ESP32-WROOM, raise it on WROVER for chips without uniform 4K erase
+flash_erase_max = 4096
+flash_era = bytearray([flash_erase_cmd[flash_erase_size],0,0,0]) # erase command and address except LSB
+flash_era_mv = memoryview(flash_era)[:flash_addr_len]
+rb=bytearray(256) # reverse bits
 spi_channel = const(2) # -1 soft, 1:sd, 2:jtag
-flash_req=bytearray(4)
+# 1: SIR/SDR payloads over SPI when available, 0: always bitbang
+spi_lsb1st = 1
+lsb1st_spi = None # SPI clocking TCK in bitbang mode, None if not available
+lsb1st_buf = bytearray(64) # bit-reversed scratch for SPI shifts
+lsb1st_mv = memoryview(lsb1st_buf)
+flash_req=bytearray(5)
+flash_req_mv = memoryview(flash_req)[:1+flash_addr_len] # command and address
 read_status=bytearray([5])
 status=bytearray(1)
+# per-phase counters, see stats()
+stat_tck      = const(0) # bitbanged TCK cycles
+stat_hwspi    = const(1) # hardware SPI bytes
+stat_swspi    = const(2) # software SPI bytes
+stat_idle_ms  = const(3) # run-test/idle time
+stat_flash_ms = const(4) # flash busy-wait time
+stat_read_ms  = const(5) # waiting for file or network data
+stat_spi_ms   = const(6) # hwspi bitstream writes
+stat_overlap_ms = const(7) # reading and hwspi writing at the same time
+stats_buf=bytearray(4*8)
+stats_ms=0 # ticks_ms at stats_reset()
+stream_crc=0 # CRC32 of bitstream data sent by last prog/flash
+stream_bytes=0 # its length
+# deferred JTAG queue, see queue_sir()
+queue_buf=bytearray(512)
+queue_len=0
+queue_msg=[] # message of each checked scan
+queue_fail=0 # bit k set if check k failed
+queue_ran=0 # checks already run
+queue_rd=bytearray(4) # response of checked scan
 
-def bitbang_jtag_on():
-  global tck,tms,tdi,tdo,led
+# scan chain, device 0 is nearest to TDO
+chain_max = const(16)
+chain_ids=[] # IDCODE of each device, 0 if it has only BYPASS, see chain()
+chain_irlen=bytearray([8]) # IR length of each device
+chain_dev=0 # selected device
+# BYPASS padding bits shifted before and after the selected device
+ir_pre=0
+ir_post=0
+dr_pre=0
+dr_post=0
+# IR length by JEDEC manufacturer id (IDCODE bits 11-1)
+irlen_vendor={0x021:8, 0x049:6, 0x06E:10} # Lattice, Xilinx, Altera
+
+# >0 while session_open() keeps pins and SPI on
+session_on=0
+
+# ESP32 GPIO registers for register-level bitbang
+gpio_reg = 1 # 1: bitbang thru registers, 0: thru Pin methods
+gpio_base = const(0x3FF44000)
+gpio_w1ts = const(2) # GPIO_OUT_W1TS word offset
+gpio_w1tc = const(3) # GPIO_OUT_W1TC
+gpio_in   = const(15 + (gpio_tdo >> 5)) # GPIO_IN or GPIO_IN1
+mask_tck = const(1 << gpio_tck)
+mask_tms = const(1 << gpio_tms)
+mask_tdi = const(1 << gpio_tdi)
+mask_tdo = const(1 << (gpio_tdo & 31))
+
+# TAP states
+state_reset     = const(0)
+state_idle      = const(1)
+state_drselect  = const(2)
+state_drcapture = const(3)
+state_drshift   = const(4)
+state_drexit1   = const(5)
+state_drpause   = const(6)
+state_drexit2   = const(7)
+state_drupdate  = const(8)
+state_irselect  = const(9)
+state_ircapture = const(10)
+state_irshift   = const(11)
+state_irexit1   = const(12)
+state_irpause   = const(13)
+state_irexit2   = const(14)
+state_irupdate  = const(15)
+# next state for [2*state+tms]
+tap_next=bytes([
+  1, 0,  1, 2,  3, 9,  4, 5,  4, 5,  6, 8,  6, 7,  4, 8,
+  1, 2, 10, 0, 11,12, 11,12, 13,15, 13,14, 11,15,  1, 2])
+tap_state=state_reset # tracked TAP state
+# shortest TMS path for [16*from+to], bits sent LSB first
+tap_path_tms=bytearray(256)
+tap_path_len=bytearray(256)
+
+# reg: 1 register-level bitbang, 0 Pin methods,
+# None keeps the backend of gpio_reg
+def bitbang_jtag_on(reg=None):
+  global tck,tms,tdi,tdo,led,gpio_reg
+  if session_on and reg is None:
+    # pins kept by session, take TCK and TDI back from hwspi
+    tck.init(Pin.OUT)
+    tdi.init(Pin.OUT)
+    return
   led=Pin(gpio_led,Pin.OUT)
   tms=Pin(gpio_tms,Pin.OUT)
   tck=Pin(gpio_tck,Pin.OUT)
   tdi=Pin(gpio_tdi,Pin.OUT)
   tdo=Pin(gpio_tdo,Pin.IN)
+  if reg is not None:
+    gpio_reg = reg
+  bitbang_select(gpio_reg)
 
 def bitbang_jtag_off():
   global tck,tms,tdi,tdo,led
+  if session_on:
+    return
   led=Pin(gpio_led,Pin.IN)
   tms=Pin(gpio_tms,Pin.IN)
   tck=Pin(gpio_tck,Pin.IN)
@@ -77,15 +200,59 @@ def bitbang_jtag_off():
   del tdi
   del tdo
 
+# per-board settings, written by calibrate()
+def load_config():
+  global spi_freq, cache_budget, flash_shadow, flash_erase_max
+  try:
+    with open(config_file) as f:
+      for line in f:
+        # blank, hand-edited or half-written lines keep defaults
+        item = line.strip().split(":", 1)
+        if len(item) != 2:
+          continue
+        name = item[0]
+        try:
+          value = int(item[1])
+        except ValueError:
+          continue
+        if name == "spi_freq":
+          spi_freq = value
+        if name == "cache_budget":
+          cache_budget = value
+        if name == "flash_shadow":
+          flash_shadow = value
+        if name == "flash_erase_max":
+          flash_erase_max = value
+  except (OSError, ValueError): # ValueError: not UTF-8 text
+    pass
+
+def save_config():
+  with open(config_file, "w") as f:
+    f.write("spi_freq:%d\n" % spi_freq)
+    f.write("cache_budget:%d\n" % cache_budget)
+    f.write("flash_shadow:%d\n" % flash_shadow)
+    f.write("flash_erase_max:%d\n" % flash_erase_max)
+
+load_config()
+
 # initialize both hardware accelerated SPI
 # software SPI on the same pins
+# hwspi SCK is parked at gpio_tcknc between bitstreams,
+# swspi on the JTAG pins shifts LSB-first payloads
 def spi_jtag_on():
-  global hwspi,swspi
+  global hwspi,swspi,lsb1st_spi
+  if session_on:
+    return
   hwspi=SPI(spi_channel, baudrate=spi_freq, polarity=1, phase=1, bits=8, firstbit=SPI.MSB, sck=Pin(gpio_tck), mosi=Pin(gpio_tdi), miso=Pin(gpio_tdo))
   swspi=SPI(-1, baudrate=spi_freq, polarity=1, phase=1, bits=8, firstbit=SPI.MSB, sck=Pin(gpio_tck), mosi=Pin(gpio_tdi), miso=Pin(gpio_tdo))
+  if spi_lsb1st:
+    lsb1st_spi=swspi
 
 def spi_jtag_off():
-  global hwspi,swspi
+  global hwspi,swspi,lsb1st_spi
+  if session_on:
+    return
+  lsb1st_spi=None
   hwspi.deinit()
   del hwspi
   swspi.deinit()
@@ -98,42 +265,102 @@ def spi_jtag_off():
 #    print("%02X" % block[len(block)-n-1], end="")
 #  print(tail, end="")
 
-#@micropython.viper
-#def init_reverse_bits():
-#  #p8rb=ptr8(addressof(rb))
-#  p8rb=memoryview(rb)
-#  for i in range(256):
-#    v=i
-#    r=0
-#    for j in range(8):
-#      r<<=1
-#      r|=v&1
-#      v>>=1
-#    p8rb[i]=r
+@micropython.viper
+def init_reverse_bits():
+  p8rb=ptr8(addressof(rb))
+  for i in range(256):
+    v=i
+    r=0
+    for j in range(8):
+      r<<=1
+      r|=v&1
+      v>>=1
+    p8rb[i]=r
+
+init_reverse_bits()
+
+# bit-reverse n bytes from src to dst, src and dst may be the same
+@micropython.viper
+def reverse_bits_buf(src:ptr8, dst:ptr8, n:int):
+  p8rb=ptr8(addressof(rb))
+  for i in range(n):
+    dst[i]=p8rb[src[i]]
+
+# breadth-first search from each state,
+# fills tap_path_tms and tap_path_len
+def init_tap_paths():
+  for start in range(16):
+    seen=1<<start
+    todo=[(start,0,0)]
+    for state,bits,n in todo:
+      tap_path_tms[start*16+state]=bits
+      tap_path_len[start*16+state]=n
+      for t in range(2):
+        nxt=tap_next[2*state+t]
+        if not (seen>>nxt)&1:
+          seen|=1<<nxt
+          todo.append((nxt,bits|(t<<n),n+1))
+
+init_tap_paths()
 
 @micropython.viper
 def send_tms(val:int):
+  global tap_state
   if val:
     tms.on()
   else:
     tms.off()
   tck.off()
   tck.on()
+  tap_state=int(ptr8(addressof(tap_next))[2*int(tap_state)+val])
+  ptr32(addressof(stats_buf))[stat_tck]+=1
+
+# walk the shortest path from tracked state to the new state
+# TMS bits are clocked as one burst
+@micropython.viper
+def tap_goto(state:int):
+  global tap_state
+  i=(int(tap_state)<<4)|state
+  bits=int(ptr8(addressof(tap_path_tms))[i])
+  l=int(ptr8(addressof(tap_path_len))[i])
+  for n in range(l):
+    if (bits >> n) & 1:
+      tms.on()
+    else:
+      tms.off()
+    tck.off()
+    tck.on()
+  tap_state=state
+  ptr32(addressof(stats_buf))[stat_tck]+=l
 
-# exit 1 DR -> select DR scan
-def send_tms0111():
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+# l bytes go thru SPI as bit-reversed bytes
+def spi_read_ptr_lsb1st(p, l, w):
+  s = addressof(lsb1st_buf)
+  i = 0
+  while i < l:
+    n = min(l-i, len(lsb1st_buf))
+    reverse_bits_buf(p+i, s, n)
+    lsb1st_spi.write_readinto(lsb1st_mv[:n], lsb1st_mv[:n])
+    stat_add(stat_swspi, n)
+    if w:
+      reverse_bits_buf(s, w+i, n)
+    i += n
 
+# shift l bytes from p, response to w if not 0
+# all but the last byte go thru SPI when available,
+# last byte is bitbanged to set TMS at the last bit
+# TMS=1 at the last bit moves TAP from "shift" to "exit 1"
 @micropython.viper
-def send_read_buf_lsb1st(buf, last:int, w:ptr8):
-  p = ptr8(addressof(buf))
-  l = int(len(buf))
-  val = 0
+def send_read_ptr_lsb1st(p:ptr8, l:int, last:int, w:ptr8):
+  global tap_state
+  j = 0
   tms.off()
-  for i in range(l-1):
+  if l > 1:
+    if lsb1st_spi:
+      spi_read_ptr_lsb1st(p, l-1, w)
+      j = l-1
+  val = 0
+  for i in range(j, l-1):
     byte = 0
     val = p[i]
     for nf in range(8):
@@ -171,9 +398,17 @@ def send_read_buf_lsb1st(buf, last:int, w:ptr8):
     byte |= 1 << 7
   if int(w):
     w[l-1] = byte # write last byte
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=8*(l-j)
+
+@micropython.viper
+def send_read_buf_lsb1st(buf, last:int, w:ptr8):
+  send_read_ptr_lsb1st(addressof(buf), int(len(buf)), last, w)
 
 @micropython.viper
 def send_int_msb1st(val:int, last:int, bits:int):
+  global tap_state
   tms.off()
   for nf in range(bits-1):
     if (val >> (7-nf)) & 1:
@@ -190,93 +425,614 @@ def send_int_msb1st(val:int, last:int, bits:int):
     tdi.off()
   tck.off()
   tck.on()
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=bits
+
+# shift n bits of TDI=1 (BYPASS)
+@micropython.viper
+def send_ones(n:int, last:int):
+  global tap_state
+  if n <= 0:
+    return
+  tms.off()
+  tdi.on()
+  for i in range(n-1):
+    tck.off()
+    tck.on()
+  if last:
+    tms.on()
+  tck.off()
+  tck.on()
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=n
+
+# shift bits of val, LSB first, max 32 bits
+# returns TDO bits LSB first
+@micropython.viper
+def send_read_bits(val:int, last:int, bits:int)->uint:
+  global tap_state
+  r = 0
+  tms.off()
+  for i in range(bits):
+    if last and i == bits-1:
+      tms.on()
+    if (val >> i) & 1:
+      tdi.on()
+    else:
+      tdi.off()
+    tck.off()
+    tck.on()
+    if tdo.value():
+      r |= 1 << i
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=bits
+  return uint(r)
+
+# register-level bitbang backend, same edges as above
+# without Pin method calls: TCK, TMS and TDI are written
+# thru ESP32 GPIO_OUT_W1TS/W1TC, TDO is read from GPIO_IN.
+# TDI/TMS change together with falling TCK,
+# TDO is sampled after rising TCK like above.
+@micropython.viper
+def send_tms_reg(val:int):
+  global tap_state
+  io=ptr32(gpio_base)
+  if val:
+    io[gpio_w1ts]=mask_tms
+    io[gpio_w1tc]=mask_tck
+  else:
+    io[gpio_w1tc]=mask_tck|mask_tms
+  io[gpio_w1ts]=mask_tck
+  tap_state=int(ptr8(addressof(tap_next))[2*int(tap_state)+val])
+  ptr32(addressof(stats_buf))[stat_tck]+=1
+
+@micropython.viper
+def tap_goto_reg(state:int):
+  global tap_state
+  io=ptr32(gpio_base)
+  i=(int(tap_state)<<4)|state
+  bits=int(ptr8(addressof(tap_path_tms))[i])
+  l=int(ptr8(addressof(tap_path_len))[i])
+  for n in range(l):
+    if (bits >> n) & 1:
+      io[gpio_w1ts]=mask_tms
+      io[gpio_w1tc]=mask_tck
+    else:
+      io[gpio_w1tc]=mask_tck|mask_tms
+    io[gpio_w1ts]=mask_tck
+  tap_state=state
+  ptr32(addressof(stats_buf))[stat_tck]+=l
+
+@micropython.viper
+def send_read_ptr_lsb1st_reg(p:ptr8, l:int, last:int, w:ptr8):
+  global tap_state
+  io=ptr32(gpio_base)
+  io[gpio_w1tc]=mask_tms
+  j = 0
+  if l > 1:
+    if lsb1st_spi:
+      spi_read_ptr_lsb1st(p, l-1, w)
+      j = l-1
+  end = 8*l-1 # last bit
+  val = 0
+  byte = 0
+  for n in range(8*j, 8*l):
+    nf = n & 7
+    if nf == 0:
+      val = p[n >> 3]
+      byte = 0
+    if last and n == end:
+      io[gpio_w1ts]=mask_tms
+    if (val >> nf) & 1:
+      io[gpio_w1ts]=mask_tdi
+      io[gpio_w1tc]=mask_tck
+    else:
+      io[gpio_w1tc]=mask_tck|mask_tdi
+    io[gpio_w1ts]=mask_tck
+    if io[gpio_in] & mask_tdo:
+      byte |= 1 << nf
+    if nf == 7 and int(w):
+      w[n >> 3] = byte
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=8*(l-j)
+
+@micropython.viper
+def send_int_msb1st_reg(val:int, last:int, bits:int):
+  global tap_state
+  io=ptr32(gpio_base)
+  io[gpio_w1tc]=mask_tms
+  for nf in range(bits):
+    if nf == bits-1:
+      if last:
+        io[gpio_w1ts]=mask_tms
+      b = val & 1
+    else:
+      b = (val >> (7-nf)) & 1
+    if b:
+      io[gpio_w1ts]=mask_tdi
+      io[gpio_w1tc]=mask_tck
+    else:
+      io[gpio_w1tc]=mask_tck|mask_tdi
+    io[gpio_w1ts]=mask_tck
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=bits
+
+@micropython.viper
+def send_ones_reg(n:int, last:int):
+  global tap_state
+  if n <= 0:
+    return
+  io=ptr32(gpio_base)
+  io[gpio_w1tc]=mask_tms
+  io[gpio_w1ts]=mask_tdi
+  for i in range(n-1):
+    io[gpio_w1tc]=mask_tck
+    io[gpio_w1ts]=mask_tck
+  if last:
+    io[gpio_w1ts]=mask_tms
+  io[gpio_w1tc]=mask_tck
+  io[gpio_w1ts]=mask_tck
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=n
+
+@micropython.viper
+def send_read_bits_reg(val:int, last:int, bits:int)->uint:
+  global tap_state
+  io=ptr32(gpio_base)
+  r = 0
+  io[gpio_w1tc]=mask_tms
+  for i in range(bits):
+    if last and i == bits-1:
+      io[gpio_w1ts]=mask_tms
+    if (val >> i) & 1:
+      io[gpio_w1ts]=mask_tdi
+      io[gpio_w1tc]=mask_tck
+    else:
+      io[gpio_w1tc]=mask_tck|mask_tdi
+    io[gpio_w1ts]=mask_tck
+    if io[gpio_in] & mask_tdo:
+      r |= 1 << i
+  if last:
+    tap_state = int(tap_state)+1
+  ptr32(addressof(stats_buf))[stat_tck]+=bits
+  return uint(r)
+
+# bitbang functions of each backend, see bitbang_select()
+bitbang_pin=(send_tms, tap_goto, send_read_ptr_lsb1st, send_int_msb1st, send_ones, send_read_bits)
+bitbang_reg=(send_tms_reg, tap_goto_reg, send_read_ptr_lsb1st_reg, send_int_msb1st_reg, send_ones_reg, send_read_bits_reg)
+
+# 1: register-level backend, 0: Pin methods
+# registers need TCK, TMS and TDI below gpio 32
+def bitbang_select(reg):
+  global send_tms, tap_goto, send_read_ptr_lsb1st, send_int_msb1st, send_ones, send_read_bits
+  if reg and gpio_tck < 32 and gpio_tms < 32 and gpio_tdi < 32:
+    fn = bitbang_reg
+  else:
+    fn = bitbang_pin
+  send_tms, tap_goto, send_read_ptr_lsb1st, send_int_msb1st, send_ones, send_read_bits = fn
+
+# shift l bytes from p to the selected device,
+# other devices get BYPASS padding.
+# state is state_irshift or state_drshift
+# TAP returns to "update IR/DR" state
+@micropython.viper
+def send_read_padded(state:int, p:ptr8, l:int, w:ptr8):
+  tap_goto(state)
+  if state == state_irshift:
+    pre = int(ir_pre)
+    post = int(ir_post)
+  else:
+    pre = int(dr_pre)
+    post = int(dr_post)
+  send_ones(pre, 0)
+  send_read_ptr_lsb1st(p, l, post == 0, w)
+  send_ones(post, 1)
+  tap_goto(state+4) # -> update
 
-# TAP to "reset" state
+# TAP to "reset" state from any state
 @micropython.viper
 def reset_tap():
+  global tap_state
   for n in range(6):
     send_tms(1) # -> Test Logic Reset
+  tap_state = state_reset
 
-# TAP should be in "idle" state
-# TAP returns to "select DR scan" state
+# TAP goes to "idle" state and stays there
+# for count cycles during minimum of ms time
 @micropython.viper
 def runtest_idle(count:int, duration_ms:int):
-  leave=int(ticks_ms()) + duration_ms
+  tap_goto(state_idle)
+  t=int(ticks_ms())
+  leave=t + duration_ms
   for n in range(count):
     send_tms(0) # -> idle
   while int(ticks_ms())-leave < 0:
     send_tms(0) # -> idle
-  send_tms(1) # -> select DR scan
+  ptr32(addressof(stats_buf))[stat_idle_ms]+=int(ticks_ms())-t
 
 # send SIR command (bytes)
-# TAP should be in "select DR scan" state
-# TAP returns to "select DR scan" state
+# TAP can be in any state
+# TAP returns to "update IR" state
 @micropython.viper
 def sir(buf):
-  send_tms(1) # -> select IR scan
-  send_tms(0) # -> capture IR
-  send_tms(0) # -> shift IR
-  send_read_buf_lsb1st(buf,1,0) # -> exit 1 IR
-  send_tms0111() # -> select DR scan
+  send_read_padded(state_irshift,addressof(buf),int(len(buf)),0)
 
 # send SIR command (bytes)
-# TAP should be in "select DR scan" state
-# TAP returns to "select DR scan" state
+# TAP can be in any state
 # finish with n idle cycles during minimum of ms time
 @micropython.viper
 def sir_idle(buf, n:int, ms:int):
-  send_tms(1) # -> select IR scan
-  send_tms(0) # -> capture IR
-  send_tms(0) # -> shift IR
-  send_read_buf_lsb1st(buf,1,0) # -> exit 1 IR
-  send_tms(0) # -> pause IR
-  send_tms(1) # -> exit 2 IR
-  send_tms(1) # -> update IR
-  runtest_idle(n+1,ms) # -> select DR scan
+  sir(buf)
+  runtest_idle(n,ms)
 
 @micropython.viper
 def sdr(buf):
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  send_read_buf_lsb1st(buf,1,0)
-  send_tms0111() # -> select DR scan
+  send_read_padded(state_drshift,addressof(buf),int(len(buf)),0)
 
 @micropython.viper
 def sdr_idle(buf, n:int, ms:int):
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  send_read_buf_lsb1st(buf,1,0)
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  runtest_idle(n+1, ms) # -> select DR scan
+  sdr(buf)
+  runtest_idle(n, ms)
 
 # sdr buffer will be overwritten with response
 @micropython.viper
 def sdr_response(buf):
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  send_read_buf_lsb1st(buf,1,addressof(buf))
-  send_tms0111() # -> select DR scan
+  send_read_padded(state_drshift,addressof(buf),int(len(buf)),addressof(buf))
 
 def check_response(response, expected, mask=0xFFFFFFFF, message=""):
   if (response & mask) != expected:
     print("0x%08X & 0x%08X != 0x%08X %s" % (response,mask,expected,message))
 
-def idcode():
+# deferred JTAG queue: scans are packed into queue_buf
+# and shifted in one pass by queue_flush().
+# entry: shift state, length, check, idle count, idle ms, TDI bytes
+# checked entry is followed by expected and mask (4 bytes each)
+# entry longer than 255 bytes or queue_buf is shifted at once
+def queue_scan(state, buf, n, ms, expected, mask, message):
+  global queue_len
+  l = len(buf)
+  check = 0 if expected is None else 1
+  if check and l > len(queue_rd):
+    raise ValueError("checked scan max %d bytes" % len(queue_rd))
+  size = 7 + l + 8*check
+  if l > 255 or size > len(queue_buf):
+    queue_run_pending() # keep order of scans
+    send_read_padded(state, addressof(buf), l, 0)
+    if n or ms:
+      runtest_idle(n, ms)
+    return
+  if queue_len + size > len(queue_buf):
+    queue_run_pending()
+  i = queue_len
+  pack_into("<BBBHH", queue_buf, i, state, l, check, n, ms)
+  queue_buf[i+7:i+7+l] = buf
+  if check:
+    pack_into("<II", queue_buf, i+7+l, expected, mask)
+    queue_msg.append(message)
+  queue_len = i + size
+
+# queue SIR, then n idle cycles during minimum of ms time
+def queue_sir(buf, n=0, ms=0):
+  queue_scan(state_irshift, buf, n, ms, None, 0, None)
+
+# queue SDR, then n idle cycles during minimum of ms time
+# if expected is given, response (max 4 bytes) is checked
+# (response & mask) == expected at flush
+def queue_sdr(buf, n=0, ms=0, expected=None, mask=0xFFFFFFFF, message=""):
+  queue_scan(state_drshift, buf, n, ms, expected, mask, message)
+
+def queue_report(k, response, expected, mask):
+  check_response(response, expected, mask, queue_msg[k])
+
+# shift length bytes of queued entries,
+# k is index of the first check in them.
+# returns failed checks as bitmask
+@micropython.viper
+def queue_run(length:int, k:int)->int:
+  a = int(addressof(queue_buf))
+  q = ptr8(a)
+  r = ptr8(addressof(queue_rd))
+  fail = 0
+  i = 0
+  while i < length:
+    state = q[i]
+    l = q[i+1]
+    check = q[i+2]
+    if check:
+      send_read_padded(state, a+i+7, l, r)
+    else:
+      send_read_padded(state, a+i+7, l, 0)
+    count = q[i+3] | (q[i+4] << 8)
+    ms = q[i+5] | (q[i+6] << 8)
+    if count or ms:
+      runtest_idle(count, ms)
+    i += 7 + l
+    if check:
+      response = 0
+      for j in range(l):
+        response |= r[j] << (8*j)
+      expected = 0
+      mask = 0
+      for j in range(4):
+        expected |= q[i+j] << (8*j)
+        mask |= q[i+4+j] << (8*j)
+      if (response & mask) != expected:
+        queue_report(k, uint(response), uint(expected), uint(mask))
+        fail |= 1 << k
+      k += 1
+      i += 8
+  return fail
+
+# shift what is queued so far, e.g. when queue_buf is full
+def queue_run_pending():
+  global queue_len, queue_fail, queue_ran
+  queue_fail |= queue_run(queue_len, queue_ran)
+  queue_len = 0
+  queue_ran = len(queue_msg)
+
+# shift all queued scans, report failed checks.
+# returns 0 if all checks passed, else bit k set for failed check k
+def queue_flush():
+  global queue_fail, queue_ran
+  queue_run_pending()
+  fail = queue_fail
+  queue_fail = 0
+  queue_ran = 0
+  queue_msg.clear()
+  return fail
+
+# enumerate devices on the JTAG chain.
+# after reset each TAP has IDCODE (LSB=1)
+# or BYPASS (one 0 bit) in DR.
+# fills chain_ids and chain_irlen, returns chain_ids
+def chain():
+  global chain_ids, chain_irlen, chain_dev
+  bitbang_jtag_on()
+  led.on()
+  reset_tap()
+  tap_goto(state_drshift)
+  ids = []
+  while len(ids) < chain_max:
+    if send_read_bits(1,0,1) == 0:
+      ids.append(0) # BYPASS only
+      continue
+    id = 1 | (send_read_bits(-1,0,31) << 1)
+    if id == 0xFFFFFFFF: # TDI ones came thru, end of chain
+      break
+    ids.append(id)
+  # total IR length: fill IR with 0 and
+  # count 1 bits shifted until first 1 comes out
+  tap_goto(state_irshift)
+  for i in range(chain_max):
+    send_read_bits(0,0,32)
+  total = 0
+  while total < 32*chain_max and send_read_bits(1,0,1) == 0:
+    total += 1
+  tap_goto(state_irupdate) # all 1 is BYPASS
+  reset_tap()
+  led.off()
+  bitbang_jtag_off()
+  irlen = bytearray(len(ids))
+  unknown = []
+  for i in range(len(ids)):
+    irlen[i] = irlen_vendor.get((ids[i] >> 1) & 0x7FF, 0)
+    if irlen[i] == 0:
+      unknown.append(i)
+  if len(unknown) == 1:
+    irlen[unknown[0]] = total - sum(irlen)
+  elif unknown:
+    print("chain: IR length unknown for devices %s, set ecp5.chain_irlen" % unknown)
+  elif sum(irlen) != total:
+    print("chain: IR length %d != %d measured" % (sum(irlen), total))
+  if len(ids) == chain_max:
+    print("chain: no end of chain found, TDO stuck at 0?")
+  chain_ids = ids
+  if ids:
+    chain_irlen = irlen
+  if chain_dev >= len(chain_irlen):
+    chain_dev = 0
+  chain_pads()
+  return ids
+
+# BYPASS padding for the selected device
+def chain_pads():
+  global ir_pre, ir_post, dr_pre, dr_post
+  ir_pre = sum(chain_irlen[:chain_dev])
+  ir_post = sum(chain_irlen[chain_dev+1:])
+  dr_pre = chain_dev
+  dr_post = len(chain_irlen)-1-chain_dev
+
+# select device for following operations,
+# chain is enumerated on first use
+def select(dev):
+  global chain_dev
+  if not chain_ids:
+    chain()
+  if dev < 0 or dev >= len(chain_irlen):
+    print("select: no device %d in chain of %d" % (dev, len(chain_irlen)))
+    return False
+  if chain_irlen[dev] != 8: # sir() shifts whole bytes
+    print("select: device %d IR length %d, ECP5 has 8" % (dev, chain_irlen[dev]))
+    return False
+  chain_dev = dev
+  chain_pads()
+  return True
+
+# hwspi TCK frequencies tried by calibrate(), 80 MHz APB divided
+calibrate_freqs = (5000000, 8000000, 10000000, 13333333, 16000000, 20000000, 26666666, 40000000)
+
+# bit offset of n bits of t (MSB first) in rx, -1 if not found
+def find_bits(rx, t, n):
+  l = 8*len(rx)
+  r = int.from_bytes(rx, "big")
+  m = (1 << n) - 1
+  for d in range(min(32, l-n+1)):
+    if (r >> (l-d-n)) & m == t:
+      return d
+  return -1
+
+# hwspi readback at freq of a pattern thru BYPASS
+# and of IDCODE id. returns bit offsets, -1 if not found
+def calibrate_read(freq, tx, rx, rxid, id):
+  spi_jtag_on()
+  hwspi.init(sck=Pin(gpio_tcknc)) # avoid TCK-glitch
+  bitbang_jtag_on()
+  reset_tap()
+  runtest_idle(1,0)
+  sir(b"\xFF") # BYPASS
+  tap_goto(state_drshift)
+  hwspi.init(baudrate=freq, sck=Pin(gpio_tck))
+  hwspi.write_readinto(tx, rx)
+  hwspi.init(sck=Pin(gpio_tcknc))
+  bitbang_jtag_on()
+  sir(b"\xE0") # IDCODE
+  tap_goto(state_drshift)
+  hwspi.init(baudrate=freq, sck=Pin(gpio_tck))
+  hwspi.readinto(rxid, 0xFF)
+  hwspi.init(sck=Pin(gpio_tcknc))
+  bitbang_jtag_on()
+  reset_tap()
+  spi_jtag_off()
+  bitbang_jtag_off()
+  # IDCODE is shifted LSB first
+  idrev = int.from_bytes(bytes([rb[b] for b in id.to_bytes(4, "little")]), "big")
+  return find_bits(rx, int.from_bytes(tx, "big") >> 32, 8*len(tx)-32), find_bits(rxid, idrev, 32)
+
+# find highest hwspi TCK frequency with reliable readback,
+# keep one step below it as safety margin and save to config_file.
+# returns selected frequency, 0 if none works
+def calibrate(repeat=4, save=True):
+  global spi_freq
+  id = idcode()
+  if id == 0 or id == 0xFFFFFFFF:
+    print("calibrate: no JTAG device")
+    return 0
+  tx = bytearray([(i*0x3B+0x5A)&0xFF for i in range(64)])
+  rx = bytearray(len(tx))
+  rxid = bytearray(8)
+  ref = None
+  good = -1
+  for i in range(len(calibrate_freqs)):
+    freq = calibrate_freqs[i]
+    ok = True
+    for n in range(repeat):
+      d = calibrate_read(freq, tx, rx, rxid, id)
+      if ref is None:
+        ref = d # offsets at lowest frequency are the reference
+      if d != ref or -1 in d:
+        ok = False
+        break
+    print("%d Hz %s" % (freq, "ok" if ok else "fail"))
+    if not ok:
+      break
+    good = i
+  if good < 0:
+    print("calibrate: fails at lowest frequency")
+    return 0
+  spi_freq = calibrate_freqs[max(0, good-1)]
+  print("spi_freq = %d Hz" % spi_freq)
+  if session_on:
+    hwspi.init(baudrate=spi_freq)
+  if save:
+    save_config()
+  return spi_freq
+
+# keep pins, SPI and tracked TAP state on between
+# idcode(), chain(), prog(), flash(), flashrd() ...
+# until session_close(). Sessions can nest.
+# with ecp5.session():
+#   ecp5.idcode()
+#   ecp5.flash("blink.bit")
+def session_open():
+  global session_on
+  if session_on == 0:
+    spi_jtag_on()
+    hwspi.init(sck=Pin(gpio_tcknc)) # avoid TCK-glitch
+    bitbang_jtag_on()
+  session_on += 1
+
+def session_close():
+  global session_on
+  if session_on == 0:
+    return
+  session_on -= 1
+  if session_on == 0:
+    led.off()
+    spi_jtag_off()
+    bitbang_jtag_off()
+
+class session:
+  def __enter__(self):
+    session_open()
+    return self
+
+  def __exit__(self, *args):
+    session_close()
+
+# after reset each device has IDCODE (32 bits) or
+# BYPASS (1 bit) in DR, no IR of other vendors is loaded.
+# devices nearer to TDO are shifted out first
+def idcode(dev=None):
+  if dev is not None and not select(dev):
+    return 0
+  if dr_pre and not chain_ids[chain_dev] & 1:
+    return 0 # BYPASS only, no IDCODE
   bitbang_jtag_on()
   led.on()
   reset_tap()
   runtest_idle(1,0)
-  #sir(b"\xE0")
-  id_bytes = bytearray(4)
-  sdr_response(id_bytes)
+  tap_goto(state_drshift)
+  for i in range(dr_pre):
+    send_read_bits(-1,0,32 if chain_ids[i] & 1 else 1)
+  id = send_read_bits(-1,1,32)
+  tap_goto(state_drupdate)
   led.off()
   bitbang_jtag_off()
-  return unpack("<I", id_bytes)[0]
+  return id
+
+# USERCODE and status of the running design
+# without entering programming mode
+def usercode_status():
+  bitbang_jtag_on()
+  led.on()
+  reset_tap()
+  runtest_idle(1,0)
+  r = bytearray(4)
+  sir(b"\xC0") # USERCODE
+  sdr_response(r)
+  usercode = unpack("<I", r)[0]
+  r[:] = bytes(4)
+  sir(b"\x3C") # LSC_READ_STATUS
+  sdr_response(r)
+  led.off()
+  bitbang_jtag_off()
+  return usercode, unpack("<I", r)[0]
+
+# read LSC_READ_STATUS until (status & mask) == value
+# with n idle cycles between reads, at most timeout_ms.
+# returns last status
+def wait_status(mask, value, timeout_ms, n=16):
+  r = bytearray(4)
+  t = ticks_ms()
+  while True:
+    sir(b"\x3C") # LSC_READ_STATUS
+    r[:] = b"\x00\x00\x00\x00"
+    sdr_response(r)
+    status = unpack("<I", r)[0]
+    if status & mask == value or ticks_ms()-t >= timeout_ms:
+      stat_add(stat_idle_ms, ticks_ms()-t)
+      return status
+    runtest_idle(n,0)
 
 # common JTAG open for both program and flash
 def common_open():
+  stats_reset()
   spi_jtag_on()
   hwspi.init(sck=Pin(gpio_tcknc)) # avoid TCK-glitch
   bitbang_jtag_on()
@@ -285,20 +1041,16 @@ def common_open():
   runtest_idle(1,0)
   #sir(b"\xE0") # read IDCODE
   #sdr(pack("<I",0), expected=pack("<I",0), message="IDCODE")
-  sir(b"\x1C") # LSC_PRELOAD: program Bscan register
-  sdr(bytearray([0xFF for i in range(64)]))
-  sir(b"\xC6") # ISC ENABLE: Enable SRAM programming mode
-  sdr_idle(b"\x00",2,10)
-  sir_idle(b"\x3C",2,1) # LSC_READ_STATUS
-  status = bytearray(4)
-  sdr_response(status)
-  check_response(unpack("<I",status)[0], mask=0x24040, expected=0, message="FAIL status")
+  queue_sir(b"\x1C") # LSC_PRELOAD: program Bscan register
+  queue_sdr(b"\xFF"*64)
+  queue_sir(b"\xC6") # ISC ENABLE: Enable SRAM programming mode
+  queue_sdr(b"\x00",2)
+  queue_flush()
+  # poll BUSY (0x1000) instead of fixed waits
+  check_response(wait_status(0x1000,0,100), expected=0, mask=0x24040, message="FAIL status")
   sir(b"\x0E") # ISC_ERASE: Erase the SRAM
-  sdr_idle(b"\x01",2,10)
-  sir_idle(b"\x3C",2,1) # LSC_READ_STATUS
-  status = bytearray(4)
-  sdr_response(status)
-  check_response(unpack("<I",status)[0], mask=0xB000, expected=0, message="FAIL status")
+  sdr_idle(b"\x01",2,0)
+  check_response(wait_status(0x1000,0,100), expected=0, mask=0xB000, message="FAIL status")
 
 # call this before sending the bitstram
 # FPGA will enter programming mode
@@ -309,10 +1061,12 @@ def prog_open():
   sdr_idle(b"\x01",2,10)
   sir(b"\x7A") # LSC_BITSTREAM_BURST
   # ---------- bitstream begin -----------
-  # manually walk the TAP
   # we will be sending one long DR command
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
+  # BYPASS of devices nearer to TDO, the selected device
+  # sees dr_post+dr_pre junk bits before the bitstream,
+  # pad them to whole bytes to keep the bitstream byte aligned
+  send_ones(dr_pre+(-(dr_pre+dr_post)&7),0)
   # switch from bitbanging to SPI mode
   hwspi.init(sck=Pin(gpio_tck)) # 1 TCK-glitch? TDI=0
   # we are lucky that format of the bitstream tolerates
@@ -335,35 +1089,40 @@ def prog_stream_done():
 # returns status True-OK False-Fail
 def prog_close():
   bitbang_jtag_on()
-  send_tms(1) # -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  #send_tms(0) # -> idle, disabled here as runtest_idle does the same
-  runtest_idle(100,10)
+  send_ones(dr_post,1) # push bitstream thru devices nearer to TDI
+  tap_goto(state_drupdate) # TAP was left in "shift DR"
+  runtest_idle(100,0)
+  wait_status(0x1000,0,10) # not BUSY
   # ---------- bitstream end -----------
-  sir_idle(b"\xC0",2,1) # read usercode
-  usercode = bytearray(4)
-  sdr_response(usercode)
-  check_response(unpack("<I",usercode)[0],expected=0,message="FAIL usercode")
+  queue_sir(b"\xC0",2) # read usercode
+  queue_sdr(b"\x00\x00\x00\x00", expected=0, message="FAIL usercode")
+  queue_sir(b"\x26",2) # ISC DISABLE
+  queue_flush()
+  status = wait_status(0x2100,0x100,200,100) # DONE, no FAIL
+  sir_idle(b"\xFF",2,0) # BYPASS
+  check_response(status, expected=0x100, mask=0x2100, message="FAIL status")
+  done = status & 0x2100 == 0x100
+  reset_tap()
+  led.off()
+  bitbang_jtag_off()
+  return done
+
+# instead of prog_close() after a bad bitstream source:
+# erase SRAM and leave programming mode, nothing is started
+def prog_abort():
+  bitbang_jtag_on()
+  send_ones(dr_post,1)
+  tap_goto(state_drupdate) # TAP was left in "shift DR"
+  sir(b"\x0E") # ISC_ERASE
+  sdr_idle(b"\x01",2,10)
   sir_idle(b"\x26",2,200) # ISC DISABLE
   sir_idle(b"\xFF",2,1) # BYPASS
-  sir(b"\x3C") # LSC_READ_STATUS
-  status = bytearray(4)
-  sdr_response(status)
-  status = unpack("<I",status)[0]
-  check_response(status,mask=0x2100,expected=0x100,message="FAIL status")
-  done = True
-  if (status & 0x2100) != 0x100:
-    done = False
   reset_tap()
   led.off()
   bitbang_jtag_off()
-  return done
 
 # call this before sending the flash image
 # FPGA will enter flashing mode
-# TAP should be in "select DR scan" state
 @micropython.viper
 def flash_open():
   common_open()
@@ -378,13 +1137,14 @@ def flash_open():
   # found in datasheet. e.g.
   # \x1B -> 0xD8
   # \x60 -> 0x06 ...
+  flash_config()
 
 @micropython.viper
 def flash_wait_status(n:int):
   retry=n
   mask=1 # WIP bit (work-in-progress)
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  t=int(ticks_ms())
+  tap_goto(state_drshift)
   swspi.write(read_status) # READ STATUS REGISTER
   swspi.readinto(status)
   while retry > 0:
@@ -395,73 +1155,209 @@ def flash_wait_status(n:int):
     retry -= 1
   send_tms(1) # -> exit 1 DR # exit at byte incomplete
   #send_int_msb1st(0,1,8) # exit at byte complete
-  send_tms0111() # -> select DR scan
+  tap_goto(state_drupdate)
+  s=ptr32(addressof(stats_buf))
+  s[stat_swspi]+=2+n-retry
+  if retry > 0:
+    s[stat_swspi]+=1 # last read when not busy
+  s[stat_flash_ms]+=int(ticks_ms())-t
   if retry <= 0:
     print("error %d flash status 0x%02X & 0x%02X != 0" % (n,status[0],mask))
 
+# address after command byte, MSB first, flash_addr_len bytes
 @micropython.viper
-def flash_erase_block(addr:int):
+def flash_addr(buf, addr:int):
+  p8=ptr8(addressof(buf))
+  i=int(flash_addr_len)
+  while i > 0:
+    p8[i]=addr
+    addr>>=8
+    i-=1
+
+# start erase and return while flash is busy,
+# waits for previous erase or write to finish first
+@micropython.viper
+def flash_erase_start(addr:int):
+  flash_wait_status(int(flash_erase_ms))
   sdr(b"\x60") # SPI WRITE ENABLE
-  flash_wait_status(1001)
-  p8=ptr8(addressof(flash_era))
-  p8[1]=addr>>16
-  p8[2]=addr>>8
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  swspi.write(flash_era) # except LSB
+  flash_addr(flash_era, addr)
+  tap_goto(state_drshift)
+  swspi.write(flash_era_mv) # except LSB
+  ptr32(addressof(stats_buf))[stat_swspi]+=int(flash_addr_len)
   send_int_msb1st(addr,1,8) # last LSB byte -> exit 1 DR
-  send_tms0111() # -> select DR scan
-  flash_wait_status(2002)
+  tap_goto(state_drupdate)
 
 @micropython.viper
-def flash_write_block(block, last:int, addr:int):
-  sdr(b"\x60") # SPI WRITE ENABLE
+def flash_erase_block(addr:int):
+  flash_erase_start(addr)
+  flash_wait_status(int(flash_erase_ms))
+
+# start page write and return while flash is busy,
+# waits for previous erase or write to finish first
+@micropython.viper
+def flash_write_start(block, last:int, addr:int):
   flash_wait_status(1003)
-  p8=ptr8(addressof(flash_req))
-  p8[0]=2
-  p8[1]=addr>>16
-  p8[2]=addr>>8
-  p8[3]=addr
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  swspi.write(flash_req)
+  sdr(b"\x60") # SPI WRITE ENABLE
+  flash_req[0]=flash_write_cmd
+  flash_addr(flash_req, addr)
+  tap_goto(state_drshift)
+  swspi.write(flash_req_mv)
   swspi.write(block) # whole block
+  ptr32(addressof(stats_buf))[stat_swspi]+=1+int(flash_addr_len)+int(len(block))
   send_int_msb1st(last,1,8) # last byte -> exit 1 DR
-  send_tms0111() # -> select DR scan
+  tap_goto(state_drupdate)
+
+@micropython.viper
+def flash_write_block(block, last:int, addr:int):
+  flash_write_start(block, last, addr)
   flash_wait_status(1004)
 
-# data is bytearray of to-be-read length
+# JEDEC ID (0x9F) of SPI flash to 3-byte data:
+# manufacturer, memory type, capacity
 @micropython.viper
-def flash_read_block(data, addr:int):
+def flash_read_id(data):
+  tap_goto(state_drshift)
+  swspi.write(b"\x9F")
+  swspi.readinto(data)
+  ptr32(addressof(stats_buf))[stat_swspi]+=4
+  send_int_msb1st(0,1,8) # dummy read byte -> exit 1 DR
+  tap_goto(state_drupdate)
+
+# SFDP (0x5A) from addr to data,
+# 3-byte address and a dummy byte on any chip
+@micropython.viper
+def flash_read_sfdp(data, addr:int):
   p8=ptr8(addressof(flash_req))
-  p8[0]=3
+  p8[0]=0x5A
   p8[1]=addr>>16
   p8[2]=addr>>8
   p8[3]=addr
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  swspi.write(flash_req) # send SPI FLASH read command and address and dummy byte
+  p8[4]=0
+  tap_goto(state_drshift)
+  swspi.write(flash_req)
+  swspi.readinto(data)
+  ptr32(addressof(stats_buf))[stat_swspi]+=5+int(len(data))
+  send_int_msb1st(0,1,8) # dummy read byte -> exit 1 DR
+  tap_goto(state_drupdate)
+
+# chip parameters from JEDEC ID and the SFDP basic flash
+# parameter table (JESD216): size, page, erase types and
+# their max times, 3 or 4 address bytes.
+# of erase types up to flash_erase_max, the fastest per byte,
+# 4K only if the chip erases 4K everywhere.
+# above 16MB 4-byte address commands are used, not 4-byte
+# mode (0xB7), the chip stays ready for FPGA boot.
+def flash_config():
+  global flash_jedec, flash_size, flash_write_size, flash_erase_size, flash_erase_ms
+  global flash_read_cmd, flash_write_cmd, flash_addr_len, flash_era_mv, flash_req_mv
+  id = bytearray(3)
+  flash_read_id(id)
+  flash_jedec = id[0]<<16 | id[1]<<8 | id[2]
+  size = 1 << id[2] if 16 <= id[2] < 32 else 0 # most vendors
+  page = 256
+  uniform4k = 1
+  erase = [(4096, flash_erase_cmd[4096], 0), (65536, flash_erase_cmd[65536], 0)] # size, command, max ms
+  h = bytearray(16)
+  flash_read_sfdp(h, 0)
+  if h[0:4] == b"SFDP" and h[8] == 0: # first parameter header is basic table
+    t = bytearray(4*min(16, h[11]))
+    flash_read_sfdp(t, h[12] | h[13]<<8 | h[14]<<16)
+    d = unpack("<%dI" % (len(t)//4), t)
+    if len(d) >= 9:
+      if d[1] & 0x80000000:
+        size = 1 << ((d[1] & 0x7FFFFFFF) - 3)
+      else:
+        size = (d[1]+1) >> 3
+      uniform4k = d[0] & 3 == 1
+      erase = []
+      for i in range(4):
+        e = (d[7+i//2] >> 16*(i&1)) & 0xFFFF
+        ms = 0
+        if len(d) >= 10 and d[9]:
+          # typical time, units 1 ms, 16 ms, 128 ms, 1 s, max is 2*(multiplier+1) times that
+          typ = (d[9] >> (4+7*i)) & 0x7F
+          ms = ((typ & 0x1F)+1) * (1, 16, 128, 1000)[typ>>5] * 2*((d[9] & 15)+1)
+        if e & 0xFF:
+          erase.append((1 << (e & 0xFF), e >> 8, ms))
+      if len(d) >= 11:
+        page = 1 << ((d[10] >> 4) & 15)
+  best = None
+  for e in erase:
+    if e[0] < flash_read_size or (e[0] == 4096 and not uniform4k):
+      continue
+    if best is None or (best[0] > flash_erase_max and e[0] < best[0]):
+      best = e # smallest, until one fits
+    elif e[0] <= flash_erase_max and e[2]*best[0] < best[2]*e[0]:
+      best = e # less time per byte
+  if best is None:
+    best = (65536, 0xD8, 0)
+  flash_size = size
+  flash_write_size = page
+  flash_erase_size = best[0]
+  flash_erase_ms = max(2002, best[2])
+  flash_addr_len = 4 if size > 0x1000000 else 3
+  cmd = (3, 2, best[1])
+  if flash_addr_len == 4:
+    cmd = [flash_cmd4.get(c, c) for c in cmd]
+  flash_read_cmd, flash_write_cmd, flash_era[0] = cmd
+  flash_req_mv = memoryview(flash_req)[:1+flash_addr_len]
+  flash_era_mv = memoryview(flash_era)[:flash_addr_len]
+
+# data is bytearray of to-be-read length
+@micropython.viper
+def flash_read_block(data, addr:int):
+  flash_req[0]=flash_read_cmd
+  flash_addr(flash_req, addr)
+  tap_goto(state_drshift)
+  swspi.write(flash_req_mv) # send SPI FLASH read command and address and dummy byte
   swspi.readinto(data) # retrieve whole block
+  ptr32(addressof(stats_buf))[stat_swspi]+=1+int(flash_addr_len)+int(len(data))
   send_int_msb1st(0,1,8) # dummy read byte -> exit 1 DR
-  send_tms0111() # -> select DR scan
+  tap_goto(state_drupdate)
 
 # call this after uploading all of the flash blocks,
-# this will exit FPGA flashing mode and start the bitstream
-@micropython.viper
-def flash_close():
+# this will exit FPGA flashing mode and start the bitstream,
+# refresh=False leaves the FPGA unconfigured
+def flash_close(refresh=True):
   # switch from SPI to bitbanging
   # ---------- flashing end -----------
   sdr(b"\x20") # SPI WRITE DISABLE
   sir_idle(b"\xFF",100,1) # BYPASS
-  sir_idle(b"\x26",2,200) # ISC DISABLE
+  sir_idle(b"\x26",2,0) # ISC DISABLE
+  wait_status(0x1000,0,200) # not BUSY
   sir_idle(b"\xFF",2,1) # BYPASS
-  sir(b"\x79") # LSC_REFRESH reload the bitstream from flash
-  sdr_idle(b"\x00\x00\x00",2,100)
+  if refresh:
+    sir(b"\x79") # LSC_REFRESH reload the bitstream from flash
+    sdr_idle(b"\x00\x00\x00",2,100)
   spi_jtag_off()
   reset_tap()
   led.off()
   bitbang_jtag_off()
 
+@micropython.viper
+def stat_add(i:int, n:int):
+  ptr32(addressof(stats_buf))[i]+=n
+
+def stats_reset():
+  global stats_ms, stream_crc, stream_bytes
+  for i in range(len(stats_buf)):
+    stats_buf[i]=0
+  stats_ms=ticks_ms()
+  stream_crc=0
+  stream_bytes=0
+
+# counters since stats_reset(), reset at each prog/flash
+def stats():
+  c=unpack("<8I",stats_buf)
+  return {"elapsed_ms":ticks_ms()-stats_ms, "tck":c[stat_tck],
+    "hwspi_bytes":c[stat_hwspi], "swspi_bytes":c[stat_swspi],
+    "idle_ms":c[stat_idle_ms], "flash_wait_ms":c[stat_flash_ms], "read_ms":c[stat_read_ms],
+    "spi_ms":c[stat_spi_ms], "overlap_ms":c[stat_overlap_ms], "crc32":stream_crc}
+
+def print_stats():
+  for k,v in sorted(stats().items()):
+    print("%-13s %d" % (k,v))
+
 def stopwatch_start():
   global stopwatch_ms
   stopwatch_ms = ticks_ms()
@@ -469,33 +1365,211 @@ def stopwatch_start():
 def stopwatch_stop(bytes_uploaded):
   global stopwatch_ms
   elapsed_ms = ticks_ms() - stopwatch_ms
-  transfer_rate_MBps = 0
+  transfer_rate_kBps = 0
   if elapsed_ms > 0:
     transfer_rate_kBps = bytes_uploaded // elapsed_ms
   print("%d bytes uploaded in %d ms (%d kB/s)" % (bytes_uploaded, elapsed_ms, transfer_rate_kBps))
 
+crc_table = None # 256 words, see crc32_init()
+
+def crc32_init():
+  global crc_table
+  if crc_table is None:
+    crc_table = array("I", range(256))
+    for i in range(256):
+      c = i
+      for k in range(8):
+        c = (c >> 1) ^ (0xEDB88320 if c & 1 else 0)
+      crc_table[i] = c
+  return crc_table
+
+# table driven CRC32 (as zlib) of p[0:n] continuing from crc
+@micropython.viper
+def crc32_buf(crc:int, p:ptr8, n:int, t:ptr32)->uint:
+  c = crc ^ -1
+  i = 0
+  while i < n:
+    c = t[(c ^ p[i]) & 0xFF] ^ ((c >> 8) & 0xFFFFFF)
+    i += 1
+  return uint(c ^ -1)
+
+# fold data sent to the FPGA into stream_crc
+def crc_add(mv):
+  global stream_crc, stream_bytes
+  stream_crc = crc32_buf(stream_crc, mv, len(mv), crc_table)
+  stream_bytes += len(mv)
+
+# read until mv is full or end of file,
+# sockets and DecompIO may return less than asked.
+# returns number of bytes read
+def readinto_full(filedata, mv):
+  n = 0
+  while n < len(mv):
+    r = filedata.readinto(mv[n:])
+    if not r:
+      break
+    n += r
+  return n
+
+# reader thread of prog_stream_threaded()
+# fills block i while the other one goes to hwspi,
+# len 0 marks end of file, stop[0] set by the main loop ends it
+def prog_stream_reader(filedata, block, n, free, full, stop):
+  i = 0
+  while True:
+    free[i].acquire()
+    if stop[0]:
+      break
+    t = ticks_ms()
+    try:
+      n[i] = readinto_full(filedata, block[i])
+    except Exception as e:
+      print("prog_stream: %s" % e)
+      n[i] = 0
+    stat_add(stat_read_ms, ticks_ms()-t)
+    full[i].release()
+    if n[i] == 0:
+      break
+    i ^= 1
+
+# double-buffered: next block is read in a _thread
+# while current block goes to hwspi.
+# Gains when readinto() or hwspi.write() releases the GIL,
+# overlap_ms in stats() shows how much was achieved
+def prog_stream_threaded(filedata, blocksize):
+  block = (memoryview(bytearray(blocksize)), memoryview(bytearray(blocksize)))
+  n = [0, 0]
+  free = (_thread.allocate_lock(), _thread.allocate_lock())
+  full = (_thread.allocate_lock(), _thread.allocate_lock())
+  for lock in full:
+    lock.acquire()
+  stop = [0]
+  _thread.start_new_thread(prog_stream_reader, (filedata, block, n, free, full, stop))
+  bytes_uploaded = 0
+  i = 0
+  try:
+    while True:
+      full[i].acquire()
+      if n[i] == 0:
+        break
+      t = ticks_ms()
+      hwspi.write(block[i][:n[i]])
+      stat_add(stat_spi_ms, ticks_ms()-t)
+      stat_add(stat_hwspi, n[i])
+      crc_add(block[i][:n[i]])
+      bytes_uploaded += n[i]
+      free[i].release()
+      i ^= 1
+  finally: # reader waits on free, let it see stop
+    stop[0] = 1
+    for lock in free:
+      if lock.locked():
+        lock.release()
+  return bytes_uploaded
+
+# spans of .bitc container go to hwspi without copy,
+# zero runs from one static buffer, not decompressed
+def prog_stream_spans(filedata, blocksize):
+  bytes_uploaded = 0
+  while True:
+    t = ticks_ms()
+    try:
+      mv = filedata.readspan(blocksize)
+    except ValueError as e:
+      print("prog_stream: %s" % e)
+      break
+    t1 = ticks_ms()
+    stat_add(stat_read_ms, t1-t)
+    n = len(mv)
+    if n == 0:
+      break
+    hwspi.write(mv)
+    stat_add(stat_spi_ms, ticks_ms()-t1)
+    stat_add(stat_hwspi, n)
+    crc_add(mv)
+    bytes_uploaded += n
+  return bytes_uploaded
+
+# 1: prog_stream() reads in a _thread if available, 0: never
+prog_threads = 0
+
+# stream_crc and stream_bytes are of the data sent
 def prog_stream(filedata, blocksize=16384):
+  crc32_init()
   prog_open()
   bytes_uploaded = 0
   stopwatch_start()
-  block = bytearray(blocksize)
-  while True:
-    if filedata.readinto(block):
-      hwspi.write(block)
-      bytes_uploaded += len(block)
-    else:
-      break
+  t0 = ticks_ms()
+  spans = hasattr(filedata, "readspan")
+  threaded = prog_threads and _thread and not spans
+  if spans:
+    bytes_uploaded = prog_stream_spans(filedata, blocksize)
+  elif threaded:
+    bytes_uploaded = prog_stream_threaded(filedata, blocksize)
+  else:
+    block = memoryview(bytearray(blocksize))
+    while True:
+      t = ticks_ms()
+      n = readinto_full(filedata, block)
+      stat_add(stat_read_ms, ticks_ms()-t)
+      if n:
+        t = ticks_ms()
+        hwspi.write(block[:n])
+        stat_add(stat_spi_ms, ticks_ms()-t)
+        stat_add(stat_hwspi, n)
+        crc_add(block[:n])
+        bytes_uploaded += n
+      else:
+        break
+  c = unpack("<8I", stats_buf)
+  overlap = max(0, c[stat_read_ms]+c[stat_spi_ms]-(ticks_ms()-t0))
+  stat_add(stat_overlap_ms, overlap)
+  if threaded:
+    print("%d ms read, %d ms SPI, %d ms overlapped" % (c[stat_read_ms], c[stat_spi_ms], overlap))
   stopwatch_stop(bytes_uploaded)
   prog_stream_done()
 
+# gzip header, deflate window from FEXTRA subfield "WB"
+# (1 byte, log2 window size 9-15) written by tools/gzwin.py,
+# 15 (32K) without it. Stream is left at the deflate data
+def gz_header(stream):
+  h = stream.read(10)
+  if len(h) < 10 or h[0] != 0x1F or h[1] != 0x8B or h[2] != 8:
+    raise ValueError("not gzip")
+  flg = h[3]
+  wbits = 15
+  if flg & 4: # FEXTRA
+    x = stream.read(unpack("<H", stream.read(2))[0])
+    i = 0
+    while i+4 <= len(x):
+      l = x[i+2] | (x[i+3] << 8)
+      if x[i] == 0x57 and x[i+1] == 0x42 and l == 1 and 9 <= x[i+4] <= 15: # "WB"
+        wbits = x[i+4]
+      i += 4+l
+  for f in (8, 16): # FNAME, FCOMMENT zero terminated
+    if flg & f:
+      while stream.read(1) not in (b"\x00", b""):
+        pass
+  if flg & 2: # FHCRC
+    stream.read(2)
+  return wbits
+
+# raw deflate after gzip header, window only as large as needed
+def open_gz(stream):
+  global gz_wbits, gz_stream
+  import uzlib
+  gz_wbits = gz_header(stream)
+  gz_stream = stream
+  return uzlib.DecompIO(stream, -gz_wbits)
+
 def open_file(filename, gz=False):
   filedata = open(filename, "rb")
   if gz:
-    import uzlib
-    return uzlib.DecompIO(filedata,31)
+    return open_gz(filedata)
   return filedata
 
 def open_web(url, gz=False):
+  global web_length
   import socket
   _, _, host, path = url.split('/', 3)
   port = 80
@@ -506,12 +1580,15 @@ def open_web(url, gz=False):
   s = socket.socket()
   s.connect(addr)
   s.send(bytes('GET /%s HTTP/1.0\r\nHost: %s\r\nAccept:  image/*\r\n\r\n' % (path, host), 'utf8'))
+  web_length = None
   for i in range(100): # read first 100 lines searching for
-    if len(s.readline()) < 3: # first empty line (contains "\r\n")
+    line = s.readline()
+    if line[:15].lower() == b"content-length:":
+      web_length = int(line[15:])
+    if len(line) < 3: # first empty line (contains "\r\n")
       break
   if gz:
-    import uzlib
-    return uzlib.DecompIO(s,31)
+    return open_gz(s)
   return s
 
 # data is bytearray of to-be-read length
@@ -520,38 +1597,119 @@ def flash_read(data, addr=0):
   flash_read_block(data, addr)
   flash_close()
 
-# accelerated compare flash and file block
+# accelerated compare flash and file block in one pass,
+# 32-bit words, length multiple of 4, file_b[0] is page p0.
+# flags of each page:
+# bit 0: differs from flash, must be written without erase
+# bit 1: not all 0xFF, must be written after erase
 # return value
 # 0-must nothing, 1-must erase, 2-must write, 3-must erase and write
+# bit 2: some page differs, bit 3: some page not all 0xFF,
+# kept for the next part of the same erase block
 @micropython.viper
-def compare_flash_file_buf(flash_b, file_b, must:int)->int:
-  flash_block = ptr8(addressof(flash_b))
-  file_block = ptr8(addressof(file_b))
-  l = int(len(file_b))
-  for i in range(l):
-    if (flash_block[i] & file_block[i]) != file_block[i]:
-      must = 1
-  if must: # erase will reset all bytes to 0xFF
-    for i in range(l):
-      if file_block[i] != 0xFF:
-        must = 3
-  else: # no erase
-    for i in range(l):
-      if flash_block[i] != file_block[i]:
-        must = 2
+def compare_flash_file_buf(flash_b, file_b, flags, p0:int, must:int)->int:
+  flash_block = ptr32(addressof(flash_b))
+  file_block = ptr32(addressof(file_b))
+  f = ptr8(addressof(flags))
+  n = int(len(file_b)) >> 2
+  words = int(flash_write_size) >> 2 # per page
+  p = p0
+  i = 0
+  while i < n:
+    end = i + words
+    if end > n:
+      end = n
+    while i < end:
+      a = flash_block[i]
+      b = file_block[i]
+      if a != b:
+        f[p] |= 1
+        if (a & b) != b:
+          must |= 1
+      if (b & (b >> 16) & 0xFFFF) != 0xFFFF: # both halves 0xFFFF
+        f[p] |= 2
+      i += 1
+      if f[p] == 3 and must & 1: # nothing more to learn from this page
+        i = end
+    must |= f[p] << 2
+    p += 1
+  if must & 1: # erase resets all bytes to 0xFF
+    if must & 8:
+      must |= 2
+  elif must & 4:
+    must |= 2
   return must
 
+# shadow index: CRC32 of erase block i at 4*i, 0 unknown.
+# file starts with the erase block size it was made with,
+# index of another size is discarded, all blocks are read
+def flash_shadow_load(name):
+  try:
+    with open(name, "rb") as f:
+      size = f.read(4)
+      if len(size) == 4 and unpack("<I", size)[0] == flash_erase_size:
+        return bytearray(f.read())
+  except OSError:
+    pass
+  return bytearray(0)
+
+def flash_shadow_save(name, shadow):
+  with open(name, "wb") as f:
+    f.write(pack("<I", flash_erase_size))
+    f.write(shadow)
+
+def flash_shadow_get(shadow, i):
+  if 4*i+4 > len(shadow):
+    return 0
+  return unpack_from("<I", shadow, 4*i)[0]
+
+def flash_shadow_set(shadow, i, crc):
+  if 4*i+4 > len(shadow):
+    shadow.extend(bytearray(4*i+4-len(shadow)))
+  pack_into("<I", shadow, 4*i, crc)
+
+# next file block for flash_stream(), padded with 0xFF
+# as erased flash. busy: flash is erasing or writing
+# meanwhile, read time is counted as overlapped
+def flash_stream_read(filedata, block, busy):
+  t = ticks_ms()
+  n = readinto_full(filedata, memoryview(block))
+  t = ticks_ms()-t
+  stat_add(stat_read_ms, t)
+  if busy:
+    stat_add(stat_overlap_ms, t)
+  crc_add(memoryview(block)[:n])
+  for i in range(n, len(block)):
+    block[i] = 0xFF # erased flash after end of file
+  return n
+
 # clever = read-compare-erase-write
 # prevents flash wear when overwriting the same data
 # 4K erase block is max that fits on ESP32-WROOM
+# pipelined: next file block is read and decompressed
+# while flash erases or writes the first page of current block
+# verify=1 reads back blocks the shadow index would skip
+# check: function called at end of file, False if the data
+# read is corrupt. the first block is kept in RAM and written
+# after check() returns True, else it is erased in flash,
+# FPGA won't boot it
 # returns status True-OK False-Fail
-def flash_stream(filedata, addr=0):
+def flash_stream(filedata, addr=0, verify=0, check=None):
+  crc32_init()
+  shadow = None
+  if flash_shadow:
+    id = idcode()
   flash_open()
+  if flash_shadow:
+    shadow_file = flash_shadow_file % (id, flash_jedec)
+    shadow = flash_shadow_load(shadow_file)
   addr_mask = flash_erase_size-1
   if addr & addr_mask:
-    print("addr must be rounded to flash_erase_size = %d bytes (& 0x%06X)" % (flash_erase_size, 0xFFFFFF & ~addr_mask))
+    print("addr must be rounded to flash_erase_size = %d bytes (& 0x%08X)" % (flash_erase_size, 0xFFFFFFFF & ~addr_mask))
+    return False
+  if flash_size and addr >= flash_size:
+    print("addr 0x%08X beyond %dMB flash" % (addr, flash_size>>20))
     return False
-  addr = addr & 0xFFFFFF & ~addr_mask # rounded to even 64K (erase block)
   bytes_uploaded = 0
   stopwatch_start()
   #if 1:
@@ -563,45 +1721,112 @@ def flash_stream(filedata, addr=0):
   count_total = 0
   count_erase = 0
   count_write = 0
-  file_block = bytearray(flash_erase_size)
+  count_skip = 0
+  count_page = 0
+  page_flag = bytearray(flash_erase_size//flash_write_size)
+  page_none = bytes(len(page_flag))
+  # two file blocks, one more for the first block if checked
+  need = (2 if check is None else 3)*flash_erase_size + flash_read_size
+  collect()
+  if mem_free() < need:
+    print("%dK erase block needs %dK RAM, %dK free, lower flash_erase_max" % (flash_erase_size>>10, need>>10, mem_free()>>10))
+    return False
+  file_blocks = (bytearray(flash_erase_size), bytearray(flash_erase_size))
   flash_block = bytearray(flash_read_size)
-  file_blockmv=memoryview(file_block)
+  cur = 0
+  n_next = flash_stream_read(filedata, file_blocks[cur], 0)
   progress_char="."
-  while filedata.readinto(file_block):
+  retry = 3
+  first = None # first block, written after check()
+  checked = check is None
+  while n_next or first:
+    if n_next:
+      n = n_next
+      n_next = -1 # next block not read yet
+      file_blockmv = memoryview(file_blocks[cur])
+      cur ^= 1
+      pos = bytes_uploaded
+      if pos == 0 and not checked:
+        first = bytearray(file_blockmv)
+        bytes_uploaded += n
+        print("\r0x%06X %dK -" % (addr, flash_erase_size>>10),end="")
+        n_next = flash_stream_read(filedata, file_blocks[cur], 0)
+        continue
+    else: # end of file
+      checked = True
+      if not check():
+        flash_erase_block(addr)
+        if shadow is not None:
+          flash_shadow_set(shadow, addr//flash_erase_size, 0)
+        print("\rfirst %dK block erased" % (flash_erase_size>>10))
+        retry = 0
+        break
+      n = 0 # already counted
+      file_blockmv = memoryview(first)
+      first = None
+      pos = 0
     led.value((bytes_uploaded >> 12)&1)
     retry = 3
-    while retry > 0:
+    skip = 0
+    if shadow is not None:
+      blk = (addr+pos)//flash_erase_size
+      crc = crc32_buf(0, file_blockmv, flash_erase_size, crc_table)
+      if crc and not verify and flash_shadow_get(shadow, blk) == crc:
+        skip = 1 # no readback, same as last verified
+        count_skip += 1
+        if (addr+pos) & 0xFFFF == 0:
+          print("\r0x%06X %dK s" % (addr+pos, flash_erase_size>>10),end="")
+        else:
+          print("s",end="")
+        count_total += 1
+        bytes_uploaded += n
+      else:
+        flash_shadow_set(shadow, blk, 0) # unknown until verified
+    while retry > 0 and not skip:
       must = 0
       flash_rd = 0
+      page_flag[:] = page_none
       while flash_rd<flash_erase_size:
-        flash_read_block(flash_block,addr+bytes_uploaded+flash_rd)
-        must = compare_flash_file_buf(flash_block,file_blockmv[flash_rd:flash_rd+flash_read_size],must)
+        flash_read_block(flash_block,addr+pos+flash_rd)
+        must = compare_flash_file_buf(flash_block,file_blockmv[flash_rd:flash_rd+flash_read_size],page_flag,flash_rd//flash_write_size,must)
         flash_rd+=flash_read_size
-      write_addr = addr+bytes_uploaded
-      if must == 0:
+      write_addr = addr+pos
+      if not must & 3:
         if (write_addr & 0xFFFF) == 0:
           print("\r0x%06X %dK %c" % (write_addr, flash_erase_size>>10, progress_char),end="")
         else:
           print(progress_char,end="")
         progress_char="."
         count_total += 1
-        bytes_uploaded += len(file_block)
+        bytes_uploaded += n
+        if shadow is not None:
+          flash_shadow_set(shadow, blk, crc)
         break
       retry -= 1
       if must & 1: # must_erase:
         #print("from 0x%06X erase %dK" % (write_addr, flash_erase_size>>10),end="\r")
-        flash_erase_block(write_addr)
+        flash_erase_start(write_addr)
+        if n_next < 0:
+          n_next = flash_stream_read(filedata, file_blocks[cur], 1)
+        flash_wait_status(int(flash_erase_ms))
         count_erase += 1
         progress_char = "e"
       if must & 2: # must_write:
         #print("from 0x%06X write %dK" % (write_addr, flash_erase_size>>10),end="\r")
+        # only pages that differ, after erase only not all 0xFF
+        page_must = 2 if must & 1 else 1
         block_addr = 0
         next_block_addr = 0
-        while next_block_addr < len(file_block):
+        while next_block_addr < len(file_blockmv):
           next_block_addr = block_addr+flash_write_size
-          flash_write_block(file_blockmv[block_addr:next_block_addr-1], file_blockmv[next_block_addr-1], write_addr)
+          if page_flag[block_addr//flash_write_size] & page_must:
+            flash_write_start(file_blockmv[block_addr:next_block_addr-1], file_blockmv[next_block_addr-1], write_addr)
+            count_page += 1
+            if n_next < 0:
+              n_next = flash_stream_read(filedata, file_blocks[cur], 1)
           write_addr += flash_write_size
           block_addr = next_block_addr
+        flash_wait_status(1004)
         count_write += 1
         progress_char = "w"
       #if not verify:
@@ -610,36 +1835,312 @@ def flash_stream(filedata, addr=0):
       #  break
     if retry <= 0:
       break
+    if n_next < 0:
+      n_next = flash_stream_read(filedata, file_blocks[cur], 0)
+  if not checked and retry > 0 and not check(): # empty file
+    retry = 0
   print("\r",end="")
   stopwatch_stop(bytes_uploaded)
-  print("%dK blocks: %d total, %d erased, %d written." % (flash_erase_size>>10, count_total, count_erase, count_write))
+  print("%dK blocks: %d total, %d erased, %d written (%d pages)." % (flash_erase_size>>10, count_total, count_erase, count_write, count_page))
+  if shadow is not None:
+    print("%d skipped by %s" % (count_skip, shadow_file))
+    flash_shadow_save(shadow_file, shadow)
   return retry > 0 # True if successful
 
+# cache_budget in bytes, -1 resolved on first use
+def cache_limit():
+  global cache_budget
+  if cache_budget < 0:
+    free = mem_free()
+    cache_budget = free//4 if free > 0x100000 else 0
+  return cache_budget
+
+# file size, mtime and bitstream size,
+# bitstream size of .gz is gzip ISIZE from the end of file,
+# of .lz4 content size from the frame header,
+# of .bitc length from the container header.
+# None if not cacheable
+def cache_stat(filepath):
+  if cache_limit() == 0 or filepath.startswith("http://") or filepath.startswith("/http:/"):
+    return None
+  try:
+    st = stat(filepath)
+    size = st[6]
+    if filepath.endswith(".gz"):
+      with open(filepath, "rb") as f:
+        f.seek(-4, 2)
+        size = unpack("<I", f.read(4))[0]
+    if filepath.endswith(".lz4"):
+      import unlz4
+      size = unlz4.content_size(filepath)
+    if filepath.endswith(".bitc"):
+      import bitc
+      size = bitc.info(filepath)[1]
+    return (st[6], st[8], size)
+  except (OSError, ValueError):
+    return None
+
+# drop least recently used bitstreams until size fits
+def cache_evict(size):
+  used = 0
+  for c in cache:
+    used += len(c[2])
+  while cache and used + size > cache_budget:
+    used -= len(cache.pop(0)[2])
+  collect()
+
+def cache_clear():
+  del cache[:]
+  collect()
+
+# cache entry with decompressed bitstream of a local file,
+# from cache or read, checked and inserted into cache.
+# None if the cache is off or the bitstream doesn't fit
+def cache_load(filepath):
+  st = cache_stat(filepath)
+  if st is None:
+    return None
+  for i in range(len(cache)):
+    if cache[i][0] == filepath:
+      c = cache.pop(i)
+      if c[1] == st:
+        cache.append(c) # most recently used
+        return c
+      break # file changed
+  size = st[2]
+  if size == 0 or size > cache_budget:
+    return None
+  cache_evict(size)
+  try:
+    buf = bytearray(size)
+  except MemoryError:
+    return None
+  filedata, gz = filedata_gz(filepath)
+  if readinto_full(filedata, memoryview(buf)) != size:
+    return None
+  crc = crc32_buf(0, buf, size, crc32_init())
+  if not stream_check(filepath, filedata, crc, size):
+    return None
+  cache.append([filepath, st, buf, crc])
+  return cache[-1]
+
+# offset of the USERCODE value of the last
+# ISC_PROGRAM_USERCODE command (C2 00 00 00 + 4 bytes), -1 if none
+@micropython.viper
+def find_usercode(p:ptr8, l:int)->int:
+  i = l-8
+  while i >= 0:
+    if p[i] == 0xC2 and p[i+1] == 0 and p[i+2] == 0 and p[i+3] == 0:
+      return i+4
+    i -= 1
+  return -1
+
+# USERCODE of compressed files, filepath: ((size, mtime), USERCODE)
+usercode_memo = {}
+
+# USERCODE the bitstream file programs, 0 if none.
+# command is near the end: cached bitstream is searched,
+# else the last 1K of .bit. .bit.gz/.lz4 can't seek, all is
+# decompressed once and its USERCODE kept in usercode_memo
+# until the file changes. .bitc has it in the container header
+def bitstream_usercode(filepath):
+  if filepath.startswith("http://") or filepath.startswith("/http:/"):
+    return 0
+  if filepath.endswith(".bitc"):
+    import bitc
+    return bitc.info(filepath)[3]
+  try:
+    st = stat(filepath)
+  except OSError:
+    return 0
+  key = (st[6], st[8])
+  m = usercode_memo.get(filepath)
+  if m and m[0] == key:
+    return m[1]
+  c = cache_load(filepath)
+  if c:
+    buf = c[2]
+    l = len(buf)
+  else:
+    filedata, gz = filedata_gz(filepath)
+    if not gz:
+      filedata.seek(max(0, stat(filepath)[6]-1024))
+    buf = bytearray(4096)
+    mv = memoryview(buf)
+    keep = 0
+    while True:
+      l = keep + readinto_full(filedata, mv[keep:])
+      if l < len(buf):
+        break
+      mv[:1024] = mv[len(buf)-1024:]
+      keep = 1024
+  i = find_usercode(buf, l)
+  usercode = 0 if i < 0 else unpack_from(">I", buf, i)[0]
+  if filepath.endswith(".gz") or filepath.endswith(".lz4"):
+    usercode_memo[filepath] = (key, usercode)
+  return usercode
+
+# 1: prog() leaves the FPGA running if its USERCODE
+# matches the bitstream and DONE is set, see prog_same()
+prog_skip = 0
+
+# True if the running design has the nonzero USERCODE
+# of the bitstream, DONE set and no FAIL.
+# give each design a unique USERCODE, e.g. "ecppack --usercode"
+def prog_same(filepath):
+  want = bitstream_usercode(filepath)
+  if want == 0 or want == 0xFFFFFFFF:
+    return False
+  usercode, status = usercode_status()
+  return usercode == want and status & 0x2100 == 0x100 # DONE, no FAIL
+
+# bitstream from RAM, crc of buf
+# checked when it was read, see cache_load()
+def prog_buf(buf, crc):
+  global stream_crc, stream_bytes
+  prog_open()
+  stream_crc = crc
+  stream_bytes = len(buf)
+  stopwatch_start()
+  t = ticks_ms()
+  hwspi.write(buf)
+  stat_add(stat_spi_ms, ticks_ms()-t)
+  stat_add(stat_hwspi, len(buf))
+  stopwatch_stop(len(buf))
+  prog_stream_done()
+
+# gz is True for compressed ".gz", ".lz4" or ".bitc"
 def filedata_gz(filepath):
   gz = filepath.endswith(".gz")
   if filepath.startswith("http://") or filepath.startswith("/http:/"):
     filedata = open_web(filepath, gz)
   else:
     filedata = open_file(filepath, gz)
+  if filedata and filepath.endswith(".lz4"):
+    import unlz4
+    return unlz4.DecompIO(filedata), True
+  if filedata and filepath.endswith(".bitc"):
+    import bitc
+    return bitc.ChunkIO(filedata), True
   return filedata, gz
 
-def prog(filepath, close=True):
+# CRC32 and length of the bitstream as told by its source
+# after it is read, None if unknown: .bitc header, gzip trailer
+# (CRC32, ISIZE), .lz4 content size, HTTP Content-Length
+def source_check(filepath, filedata):
+  if hasattr(filedata, "crc"):
+    return filedata.crc, filedata.length
+  if filepath.endswith(".gz"):
+    filedata.read(1) # to end of deflate data
+    t = bytearray(8)
+    if readinto_full(gz_stream, memoryview(t)) == 8:
+      return unpack("<II", t)
+  elif getattr(filedata, "size", 0):
+    return None, filedata.size
+  elif filepath.startswith("http://") or filepath.startswith("/http:/"):
+    return None, web_length
+  return None, None
+
+# False if data read from filedata, of length n
+# and CRC32 crc, is not what its source says
+def stream_check(filepath, filedata, crc, n):
+  want_crc, want_n = source_check(filepath, filedata)
+  if want_n is not None and want_n != n:
+    print("%s: %d bytes read, expected %d" % (filepath, n, want_n))
+    return False
+  if want_crc is not None and want_crc != crc:
+    print("%s: CRC32 0x%08X, expected 0x%08X" % (filepath, crc, want_crc))
+    return False
+  return True
+
+# False if .bitc container (open or file name)
+# is made for another device, its IDCODE 0 fits any
+def bitc_target_ok(filedata):
+  want = getattr(filedata, "idcode", 0)
+  if isinstance(filedata, str):
+    import bitc
+    want = bitc.info(filedata)[0]
+  if want:
+    id = idcode()
+    if id != want:
+      print("bitstream is for IDCODE 0x%08X, device is 0x%08X" % (want, id))
+      return False
+  return True
+
+# SPI block for prog_stream(), small while
+# decompressor holds a large window,
+# .bitc chunk as it is decompressed
+def prog_blocksize(filepath, gz, filedata=None):
+  if getattr(filedata, "chunk_size", 0):
+    return filedata.chunk_size
+  if gz and not (filepath.endswith(".gz") and gz_wbits <= 12):
+    return 4096
+  return 16384
+
+def prog(filepath, close=True, dev=None, skip=None):
+  if dev is not None and not select(dev):
+    return False
+  if skip is None:
+    skip = prog_skip
+  if skip and close and prog_same(filepath):
+    print("running design matches %s" % filepath)
+    return True
+  c = cache_load(filepath)
+  if c:
+    if filepath.endswith(".bitc") and not bitc_target_ok(filepath):
+      return False
+    prog_buf(c[2], c[3])
+    if close:
+      return prog_close()
+    return True
   filedata, gz = filedata_gz(filepath)
   if filedata:
-    if gz:
-      prog_stream(filedata,blocksize=4096)
-    else:
-      prog_stream(filedata,blocksize=16384)
+    if not bitc_target_ok(filedata):
+      return False
+    prog_stream(filedata,blocksize=prog_blocksize(filepath, gz, filedata))
+    if not stream_check(filepath, filedata, stream_crc, stream_bytes):
+      prog_abort() # don't start a corrupt bitstream
+      return False
     # NOTE now the SD card can be released before bitstream starts
     if close:
       return prog_close() # start the bitstream
     return True
   return False
 
-def flash(filepath, addr=0, close=True):
+# SPI passthru needs the FPGA alone on the chain
+def flash_chain_ok():
+  if dr_pre or dr_post:
+    print("flash: device %d is not alone on the JTAG chain" % chain_dev)
+    return False
+  return True
+
+# chunk: resume .bitc from that chunk, writing
+# flash from addr + its offset in the bitstream.
+# a bitstream that doesn't match its CRC32 or length
+# is left in flash without its first erase block, not
+# started, returns False, see flash_stream()
+def flash(filepath, addr=0, close=True, chunk=0, verify=0):
+  if not flash_chain_ok():
+    return False
   filedata, gz = filedata_gz(filepath)
   if filedata:
-    status=flash_stream(filedata,addr)
+    if not bitc_target_ok(filedata):
+      return False
+    if chunk:
+      if not hasattr(filedata, "seek_chunk"):
+        print("resume needs .bitc container")
+        return False
+      if filedata.chunk_size % flash_erase_size:
+        print("resume needs chunk size multiple of %d" % flash_erase_size)
+        return False
+      addr += filedata.seek_chunk(chunk)
+    check = None
+    if not chunk: # resumed .bitc has checked chunks but not the whole bitstream
+      check = lambda: stream_check(filepath, filedata, stream_crc, stream_bytes)
+    status=flash_stream(filedata,addr,verify,check)
+    if not status:
+      flash_close(refresh=False) # don't start a corrupt bitstream
+      return False
     # NOTE now the SD card can be released before bitstream starts
     if close:
       flash_close() # start the bitstream
@@ -648,6 +2149,8 @@ def flash(filepath, addr=0, close=True):
 
 def flashrd(addr=0, length=1):
   data = bytearray(length)
+  if not flash_chain_ok():
+    return data
   flash_read(data, addr)
   return data
 
@@ -656,17 +2159,25 @@ def passthru():
   if id != 0 and id != 0xFFFFFFFF:
     filepath = "passthru%08x.bit.gz" % id
     print("ecp5.prog(\"%s\")" % filepath)
-    filedata = open_file(filepath, gz=True)
-    prog_stream(filedata,blocksize=4096)
-    return prog_close()
+    return prog(filepath)
   return False
 
 def help():
   print("usage:")
   print("ecp5.flash(\"blink.bit.gz\", addr=0x000000)")
   print("ecp5.flashrd(addr=0x000000, length=1)")
+  print("ecp5.flash(\"blink.bit.gz\", verify=1) # read all back, see flash_shadow")
   print("ecp5.prog(\"http://192.168.4.2/blink.bit\")")
   print("ecp5.prog(\"blink.bit.gz\") # gzip -9 blink.bit")
+  print("ecp5.prog(\"blink.bit.lz4\") # tools/lz4pack.py blink.bit")
+  print("ecp5.flash(\"blink.bitc\", chunk=3) # tools/bitcpack.py, resume")
+  print("ecp5.chain() # list of IDCODEs, device 0 nearest to TDO")
+  print("ecp5.prog(\"blink.bit.gz\", dev=1) # program device 1 of the chain")
   print("ecp5.passthru()")
+  print("ecp5.prog(\"blink.bit\", skip=1) # not if running USERCODE matches")
+  print("with ecp5.session(): # keep JTAG on for many operations")
+  print("ecp5.print_stats() # where time went in last prog/flash")
+  print("ecp5.cache_clear() # forget bitstreams kept in RAM by prog()")
+  print("ecp5.calibrate() # find fastest reliable TCK, save to %s" % config_file)
   print("\"0x%08X\" % ecp5.idcode()")
   print("0x%08X" % idcode())
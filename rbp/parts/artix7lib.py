@@ -4,7 +4,7 @@
 # AUTHOR=EMARD
 # LICENSE=BSD
 
-from time import sleep_ms
+from time import sleep_ms, ticks_ms
 from machine import Pin
 from micropython import const
 from struct import pack, unpack
@@ -45,15 +45,11 @@ def idcode():
 # a can be 0-size
 def user1_send(a,b):
   sir(2) # USER1
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   jtag.swspi.write(a)
   jtag.swspi.write(b[:-1])
   send_data_byte_reverse(b[-1],1,8) # last byte -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drupdate)
 
 # USER1 send a, recv b
 # a can be 0-size
@@ -61,14 +57,11 @@ def user1_send(a,b):
 @micropython.viper
 def user1_send_recv(a,b):
   sir(2) # USER1
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   jtag.swspi.write(a)
   jtag.swspi.readinto(b)
   send_tms(1) # -> exit 1 DR, dummy bit
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
+  tap_goto(state_drupdate)
 
 # common JTAG open for both program and flash
 def common_open():
@@ -86,14 +79,17 @@ def prog_open():
   common_open()
   sir(0x3F) # BYPASS
   sir(0xB) # JPROGRAM
-  runtest_idle(1,20)
+  # ISC_NOOP IR capture has INIT_COMPLETE (0x10) when
+  # configuration memory is cleared, poll it for max 100 ms
+  t = ticks_ms()
+  while sir(0x14) & 0x10 == 0 and ticks_ms()-t < 100:
+    runtest_idle(100,0)
   check_response(sir(0x14), mask=0x10, expected=0x10, message="FAIL ISC_NOOP")
   sir(5) # CFG_IN
   # ---------- bitstream begin -----------
   # manually walk the TAP
   # we will be sending one long DR command
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR # NOTE sent with 1 TCK glitch
+  tap_goto(state_drshift) # NOTE sent with 1 TCK glitch
   # switch from bitbanging to SPI mode
   jtag.hwspi.init(sck=Pin(gpio_tck)) # 1 TCK-glitch TDI=0
   # we are lucky that format of the bitstream tolerates
@@ -116,11 +112,7 @@ def prog_stream_done():
 # returns status True-OK False-Fail
 def prog_close():
   bitbang_jtag_on()
-  send_tms(1) # -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  #send_tms(0) # -> idle, disabled here as runtest_idle does the same
+  tap_goto(state_drupdate)
   runtest_idle(1,10)
   # ---------- bitstream end -----------
   sir(0xC) # JSTART
@@ -132,12 +124,10 @@ def prog_close():
 
 # call this before sending the flash image
 # FPGA will enter flashing mode
-# TAP should be in "select DR scan" state
 @micropython.viper
 def flash_open():
   file="jtagspi%08x.bit.gz" % idcode()
-  prog_stream(open_file(file,True))
-  if not prog_close():
+  if not prog(file): # each call, too big for the prog() cache
     print("%s failed" % file)
   common_open()
   reset_tap()
@@ -48,15 +48,11 @@ def idcode():
 # a can be 0-size
 def user1_send(a,b):
   sir(2) # USER1
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   jtag.swspi.write(a)
   jtag.swspi.write(b[:-1])
   send_data_byte_reverse(b[-1],1,8) # last byte -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drupdate)
 
 # USER1 send a, recv b
 # a can be 0-size
@@ -64,14 +60,11 @@ def user1_send(a,b):
 @micropython.viper
 def user1_send_recv(a,b):
   sir(2) # USER1
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   jtag.swspi.write(a)
   jtag.swspi.readinto(b)
   send_tms(1) # -> exit 1 DR, dummy bit
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
+  tap_goto(state_drupdate)
 
 # common JTAG open for both program and flash
 def common_open():
@@ -84,10 +77,8 @@ def common_open():
 
 # workaround to keep same sdr/sir
 def workaround():
-  send_tms(0) # -> capture DR
-  send_tms(1) # -> exit 1 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drcapture)
+  tap_goto(state_drupdate)
 
 # call this before sending the bitstram
 # FPGA will enter programming mode
@@ -100,8 +91,7 @@ def prog_open():
   # ---------- bitstream begin -----------
   # manually walk the TAP
   # we will be sending one long DR command
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR # NOTE sent with 1 TCK glitch
+  tap_goto(state_drshift) # NOTE sent with 1 TCK glitch
   # switch from bitbanging to SPI mode
   jtag.hwspi.init(sck=Pin(gpio_tck)) # 1 TCK-glitch TDI=0
   # we are lucky that format of the bitstream tolerates
@@ -124,11 +114,7 @@ def prog_stream_done():
 # returns status True-OK False-Fail
 def prog_close():
   bitbang_jtag_on()
-  send_tms(1) # -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drupdate)
   runtest_idle(8,2)
   # ---------- bitstream end -----------
   sir(4)
@@ -148,12 +134,10 @@ def prog_close():
 
 # call this before sending the flash image
 # FPGA will enter flashing mode
-# TAP should be in "select DR scan" state
 @micropython.viper
 def flash_open():
   file="jtagspi%08x.bit.gz" % idcode()
-  prog_stream(open_file(file,True))
-  if not prog_close():
+  if not prog(file): # each call, too big for the prog() cache
     print("%s failed" % file)
   common_open()
   reset_tap()
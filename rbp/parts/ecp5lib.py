@@ -4,7 +4,7 @@
 # AUTHOR=EMARD
 # LICENSE=BSD
 
-from time import sleep_ms
+from time import sleep_ms, ticks_ms
 from machine import Pin
 from micropython import const
 from struct import pack, unpack
@@ -14,10 +14,20 @@ import jtag
 from jtag import *
 
 flash_read_size = const(2048)
-flash_write_size = const(256)
-flash_erase_size = const(4096)
-flash_erase_cmd = { 4096:0x20, 32768:0x52, 65536:0xD8, 262144:0xD8 } # erase commands from FLASH PDF
-flash_erase_cmd = flash_erase_cmd[flash_erase_size]
+# flash chip parameters, set by flash_open() from JEDEC ID and SFDP, see flash_config()
+flash_jedec = 0 # JEDEC ID: manufacturer, memory type, capacity
+flash_size = 0 # bytes, 0: unknown
+flash_write_size = 256 # page
+flash_erase_size = 4096
+flash_erase_cmd = 0x20
+flash_erase_ms = 2002 # erase busy timeout
+flash_cmd4 = { 0x03:0x13, 0x02:0x12, 0x20:0x21, 0x52:0x5C, 0xD8:0xDC } # 4-byte address commands
+flash_read_cmd = 0x03
+flash_write_cmd = 0x02
+flash_addr_len = 3 # 4 above 16MB, with commands from flash_cmd4
+# largest erase block flashlib may use.
+# 4K fits on ESP32-WROOM, raise it on WROVER for chips without uniform 4K erase
+flash_erase_max = 4096
 read_status = bytearray([5])
 status = bytearray(1)
 
@@ -33,6 +43,21 @@ def idcode():
   bitbang_jtag_off()
   return unpack("<I", id_bytes)[0]
 
+# read LSC_READ_STATUS until (status & mask) == value
+# with n idle cycles between reads, at most timeout_ms.
+# returns last status
+def wait_status(mask, value, timeout_ms, n=16):
+  status = bytearray(4)
+  t = ticks_ms()
+  while True:
+    sir(0x3C) # LSC_READ_STATUS
+    status[:] = b"\x00\x00\x00\x00"
+    sdr_response(status)
+    s = unpack("<I",status)[0]
+    if s & mask == value or ticks_ms()-t >= timeout_ms:
+      return s
+    runtest_idle(n,0)
+
 # common JTAG open for both program and flash
 def common_open():
   jtag_open()
@@ -41,17 +66,12 @@ def common_open():
   sir(0x1C) # LSC_PRELOAD: program Bscan register
   sdr(bytearray([0xFF for i in range(64)]))
   sir(0xC6) # ISC ENABLE: Enable SRAM programming mode
-  sdr_idle(b"\x00",2,10)
-  sir_idle(0x3C,2,1) # LSC_READ_STATUS
-  status = bytearray(4)
-  sdr_response(status)
-  check_response(unpack("<I",status)[0], mask=0x24040, expected=0, message="FAIL status")
+  sdr_idle(b"\x00",2,0)
+  # poll BUSY (0x1000) instead of fixed waits
+  check_response(wait_status(0x1000,0,100), mask=0x24040, expected=0, message="FAIL status")
   sir(0x0E) # ISC_ERASE: Erase the SRAM
-  sdr_idle(b"\x01",2,10)
-  sir_idle(0x3C,2,1) # LSC_READ_STATUS
-  status = bytearray(4)
-  sdr_response(status)
-  check_response(unpack("<I",status)[0], mask=0xB000, expected=0, message="FAIL status")
+  sdr_idle(b"\x01",2,0)
+  check_response(wait_status(0x1000,0,100), mask=0xB000, expected=0, message="FAIL status")
 
 # call this before sending the bitstram
 # FPGA will enter programming mode
@@ -64,8 +84,7 @@ def prog_open():
   # ---------- bitstream begin -----------
   # manually walk the TAP
   # we will be sending one long DR command
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   # switch from bitbanging to SPI mode
   jtag.hwspi.init(sck=Pin(gpio_tck)) # 1 TCK-glitch? TDI=0
   # we are lucky that format of the bitstream tolerates
@@ -88,23 +107,17 @@ def prog_stream_done():
 # returns status True-OK False-Fail
 def prog_close():
   bitbang_jtag_on()
-  send_tms(1) # -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  #send_tms(0) # -> idle, disabled here as runtest_idle does the same
-  runtest_idle(100,10)
+  tap_goto(state_drupdate)
+  runtest_idle(100,0)
+  wait_status(0x1000,0,10) # not BUSY
   # ---------- bitstream end -----------
-  sir_idle(0xC0,2,1) # read usercode
+  sir_idle(0xC0,2,0) # read usercode
   usercode = bytearray(4)
   sdr_response(usercode)
   check_response(unpack("<I",usercode)[0],expected=0,message="FAIL usercode")
-  sir_idle(0x26,2,200) # ISC DISABLE
-  sir_idle(0xFF,2,1) # BYPASS
-  sir(0x3C) # LSC_READ_STATUS
-  status = bytearray(4)
-  sdr_response(status)
-  status = unpack("<I",status)[0]
+  sir_idle(0x26,2,0) # ISC DISABLE
+  status = wait_status(0x2100,0x100,200,100) # DONE, no FAIL
+  sir_idle(0xFF,2,0) # BYPASS
   check_response(status,mask=0x2100,expected=0x100,message="FAIL status")
   done = True
   if (status & 0x2100) != 0x100:
@@ -116,7 +129,6 @@ def prog_close():
 
 # call this before sending the flash image
 # FPGA will enter flashing mode
-# TAP should be in "select DR scan" state
 @micropython.viper
 def flash_open():
   common_open()
@@ -129,13 +141,13 @@ def flash_open():
   # 0x60 and other SPI flash commands here are bitreverse() values
   # of flash commands found in SPI FLASH datasheet.
   # e.g. 0x1B here is actually 0xD8 in datasheet, 0x60 is is 0x06 etc.
+  flash_config()
 
 @micropython.viper
 def flash_wait_status(n:int):
   retry=n
   mask=1 # WIP bit (work-in-progress)
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   jtag.swspi.write(read_status) # READ STATUS REGISTER
   while retry > 0:
     jtag.swspi.readinto(status)
@@ -145,13 +157,16 @@ def flash_wait_status(n:int):
     retry -= 1
   send_tms(1) # -> exit 1 DR # exit at byte incomplete
   #send_data_byte_reverse(0,1,8) # exit at byte complete
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drupdate)
   if retry <= 0:
     print("error %d flash status 0x%02X & 0x%02X != 0" % (n,status[0],mask))
 
+# command and flash_addr_len address bytes, MSB first
+def flash_req(cmd, addr):
+  if flash_addr_len == 4:
+    return pack(">BI", cmd, addr)
+  return pack(">I", (cmd << 24) | (addr & 0xFFFFFF))
+
 def flash_erase_block(addr=0):
   sdr(b"\x60") # SPI WRITE ENABLE
   flash_wait_status(1001)
@@ -159,45 +174,112 @@ def flash_erase_block(addr=0):
   #status = pack("<H",0x00A0) # READ STATUS REGISTER
   #sdr_response(status)
   #check_response(unpack("<H",status)[0],mask=0xC100,expected=0x4000)
-  req = pack(">I", (flash_erase_cmd << 24) | (addr & 0xFFFFFF))
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  req = flash_req(flash_erase_cmd, addr)
+  tap_goto(state_drshift)
   jtag.swspi.write(req[:-1])
   send_data_byte_reverse(req[-1],1,8) # last byte -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
-  flash_wait_status(2002)
+  tap_goto(state_drupdate)
+  flash_wait_status(flash_erase_ms)
 
 def flash_write_block(block, addr=0):
   sdr(b"\x60") # SPI WRITE ENABLE
   flash_wait_status(1003)
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  tap_goto(state_drshift)
   # bitreverse(0x40) = 0x02 -> 0x02000000
-  jtag.swspi.write(pack(">I", 0x02000000 | (addr & 0xFFFFFF)))
+  jtag.swspi.write(flash_req(flash_write_cmd, addr))
   jtag.swspi.write(block[:-1]) # whole block except last byte
   send_data_byte_reverse(block[-1],1,8) # last byte -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drupdate)
   flash_wait_status(1004)
 
 # data is bytearray of to-be-read length
 def flash_read_block(data, addr=0):
   # 0x0B is SPI flash fast read command
-  sdr = pack(">I",0x03000000 | (addr & 0xFFFFFF))
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
+  sdr = flash_req(flash_read_cmd, addr)
+  tap_goto(state_drshift)
   jtag.swspi.write(sdr) # send SPI FLASH read command and address and dummy byte
   jtag.swspi.readinto(data) # retrieve whole block
   send_data_byte_reverse(0,1,8) # dummy read byte -> exit 1 DR
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drupdate)
+
+# JEDEC ID (0x9F) of SPI flash to 3-byte data:
+# manufacturer, memory type, capacity
+def flash_read_id(data):
+  tap_goto(state_drshift)
+  jtag.swspi.write(b"\x9F")
+  jtag.swspi.readinto(data)
+  send_data_byte_reverse(0,1,8) # dummy read byte -> exit 1 DR
+  tap_goto(state_drupdate)
+
+# SFDP (0x5A) from addr to data,
+# 3-byte address and a dummy byte on any chip
+def flash_read_sfdp(data, addr):
+  tap_goto(state_drshift)
+  jtag.swspi.write(pack(">IB", 0x5A000000 | addr, 0))
+  jtag.swspi.readinto(data)
+  send_data_byte_reverse(0,1,8) # dummy read byte -> exit 1 DR
+  tap_goto(state_drupdate)
+
+# chip parameters from JEDEC ID and the SFDP basic flash
+# parameter table (JESD216): size, page, erase types and
+# their max times, 3 or 4 address bytes.
+# of erase types up to flash_erase_max, the fastest per byte,
+# 4K only if the chip erases 4K everywhere.
+# above 16MB 4-byte address commands are used, not 4-byte
+# mode (0xB7), the chip stays ready for FPGA boot.
+def flash_config():
+  global flash_jedec, flash_size, flash_write_size, flash_erase_size, flash_erase_cmd, flash_erase_ms
+  global flash_read_cmd, flash_write_cmd, flash_addr_len
+  id = bytearray(3)
+  flash_read_id(id)
+  flash_jedec = id[0]<<16 | id[1]<<8 | id[2]
+  size = 1 << id[2] if 16 <= id[2] < 32 else 0 # most vendors
+  page = 256
+  uniform4k = 1
+  erase = [(4096, 0x20, 0), (65536, 0xD8, 0)] # size, command, max ms
+  h = bytearray(16)
+  flash_read_sfdp(h, 0)
+  if h[0:4] == b"SFDP" and h[8] == 0: # first parameter header is basic table
+    t = bytearray(4*min(16, h[11]))
+    flash_read_sfdp(t, h[12] | h[13]<<8 | h[14]<<16)
+    d = unpack("<%dI" % (len(t)//4), t)
+    if len(d) >= 9:
+      if d[1] & 0x80000000:
+        size = 1 << ((d[1] & 0x7FFFFFFF) - 3)
+      else:
+        size = (d[1]+1) >> 3
+      uniform4k = d[0] & 3 == 1
+      erase = []
+      for i in range(4):
+        e = (d[7+i//2] >> 16*(i&1)) & 0xFFFF
+        ms = 0
+        if len(d) >= 10 and d[9]:
+          # typical time, units 1 ms, 16 ms, 128 ms, 1 s, max is 2*(multiplier+1) times that
+          typ = (d[9] >> (4+7*i)) & 0x7F
+          ms = ((typ & 0x1F)+1) * (1, 16, 128, 1000)[typ>>5] * 2*((d[9] & 15)+1)
+        if e & 0xFF:
+          erase.append((1 << (e & 0xFF), e >> 8, ms))
+      if len(d) >= 11:
+        page = 1 << ((d[10] >> 4) & 15)
+  best = None
+  for e in erase:
+    if e[0] < flash_read_size or (e[0] == 4096 and not uniform4k):
+      continue
+    if best is None or (best[0] > flash_erase_max and e[0] < best[0]):
+      best = e # smallest, until one fits
+    elif e[0] <= flash_erase_max and e[2]*best[0] < best[2]*e[0]:
+      best = e # less time per byte
+  if best is None:
+    best = (65536, 0xD8, 0)
+  flash_size = size
+  flash_write_size = page
+  flash_erase_size = best[0]
+  flash_erase_ms = max(2002, best[2])
+  flash_addr_len = 4 if size > 0x1000000 else 3
+  cmd = (3, 2, best[1])
+  if flash_addr_len == 4:
+    cmd = [flash_cmd4.get(c, c) for c in cmd]
+  flash_read_cmd, flash_write_cmd, flash_erase_cmd = cmd
 
 # call this after uploading all of the flash blocks,
 # this will exit FPGA flashing mode and start the bitstream
@@ -207,7 +289,8 @@ def flash_close():
   # ---------- flashing end -----------
   sdr(b"\x20") # SPI WRITE DISABLE
   sir_idle(0xFF,100,1) # BYPASS
-  sir_idle(0x26,2,200) # ISC DISABLE
+  sir_idle(0x26,2,0) # ISC DISABLE
+  wait_status(0x1000,0,200) # not BUSY
   sir_idle(0xFF,2,1) # BYPASS
   sir(0x79) # LSC_REFRESH reload the bitstream from flash
   sdr_idle(b"\x00\x00\x00",2,100)
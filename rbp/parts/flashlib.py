@@ -20,25 +20,47 @@ def flash_read(data, addr=0):
   spi.flash_read_block(data, addr)
   spi.flash_close()
 
-# accelerated compare flash and file block
+# accelerated compare flash and file block in one pass,
+# 32-bit words, length multiple of 4, file_b[0] is page p0.
+# flags of each page:
+# bit 0: differs from flash, must be written without erase
+# bit 1: not all 0xFF, must be written after erase
 # return value
 # 0-must nothing, 1-must erase, 2-must write, 3-must erase and write
+# bit 2: some page differs, bit 3: some page not all 0xFF,
+# kept for the next part of the same erase block
 @micropython.viper
-def compare_flash_file_buf(flash_b, file_b, must:int) -> int:
-  flash_block = ptr8(addressof(flash_b))
-  file_block = ptr8(addressof(file_b))
-  l = int(len(file_b))
-  for i in range(l):
-    if (flash_block[i] & file_block[i]) != file_block[i]:
-      must = 1
-  if must: # erase will reset all bytes to 0xFF
-    for i in range(l):
-      if file_block[i] != 0xFF:
-        must = 3
-  else: # no erase
-    for i in range(l):
-      if flash_block[i] != file_block[i]:
-        must = 2
+def compare_flash_file_buf(flash_b, file_b, flags, p0:int, page:int, must:int)->int:
+  flash_block = ptr32(addressof(flash_b))
+  file_block = ptr32(addressof(file_b))
+  f = ptr8(addressof(flags))
+  n = int(len(file_b)) >> 2
+  words = page >> 2 # per page
+  p = p0
+  i = 0
+  while i < n:
+    end = i + words
+    if end > n:
+      end = n
+    while i < end:
+      a = flash_block[i]
+      b = file_block[i]
+      if a != b:
+        f[p] |= 1
+        if (a & b) != b:
+          must |= 1
+      if (b & (b >> 16) & 0xFFFF) != 0xFFFF: # both halves 0xFFFF
+        f[p] |= 2
+      i += 1
+      if f[p] == 3 and must & 1: # nothing more to learn from this page
+        i = end
+    must |= f[p] << 2
+    p += 1
+  if must & 1: # erase resets all bytes to 0xFF
+    if must & 8:
+      must |= 2
+  elif must & 4:
+    must |= 2
   return must
 
 # clever = read-compare-erase-write
@@ -49,9 +71,8 @@ def flash_stream(filedata, addr=0):
   spi.flash_open()
   addr_mask = spi.flash_erase_size-1
   if addr & addr_mask:
-    print("addr must be rounded to flash_erase_size = %d bytes (& 0x%06X)" % (spi.flash_erase_size, 0xFFFFFF & ~addr_mask))
+    print("addr must be rounded to flash_erase_size = %d bytes (& 0x%08X)" % (spi.flash_erase_size, 0xFFFFFFFF & ~addr_mask))
     return False
-  addr = addr & 0xFFFFFF & ~addr_mask # rounded to even 64K (erase block)
   bytes_uploaded = 0
   stopwatch_start()
   #if 1:
@@ -63,6 +84,9 @@ def flash_stream(filedata, addr=0):
   count_total = 0
   count_erase = 0
   count_write = 0
+  count_page = 0
+  page_flag = bytearray(spi.flash_erase_size//spi.flash_write_size)
+  page_none = bytes(len(page_flag))
   file_block = bytearray(spi.flash_erase_size)
   flash_block = bytearray(spi.flash_read_size)
   progress_char="."
@@ -72,12 +96,13 @@ def flash_stream(filedata, addr=0):
     while retry >= 0:
       must = 0
       flash_rd = 0
+      page_flag[:] = page_none
       while flash_rd<spi.flash_erase_size:
         spi.flash_read_block(flash_block,addr+bytes_uploaded+flash_rd)
-        must = compare_flash_file_buf(flash_block,file_block[flash_rd:flash_rd+spi.flash_read_size],must)
+        must = compare_flash_file_buf(flash_block,file_block[flash_rd:flash_rd+spi.flash_read_size],page_flag,flash_rd//spi.flash_write_size,spi.flash_write_size,must)
         flash_rd+=spi.flash_read_size
       write_addr = addr+bytes_uploaded
-      if must == 0:
+      if not must & 3:
         if (write_addr & 0xFFFF) == 0:
           print("\r0x%06X %dK %c" % (write_addr, spi.flash_erase_size>>10, progress_char),end="")
         else:
@@ -92,11 +117,15 @@ def flash_stream(filedata, addr=0):
         count_erase += 1
         progress_char = "e"
       if must & 2: # must_write:
+        # only pages that differ, after erase only not all 0xFF
+        page_must = 2 if must & 1 else 1
         block_addr = 0
         next_block_addr = 0
         while next_block_addr < len(file_block):
           next_block_addr = block_addr+spi.flash_write_size
-          spi.flash_write_block(file_block[block_addr:next_block_addr], addr=write_addr)
+          if page_flag[block_addr//spi.flash_write_size] & page_must:
+            spi.flash_write_block(file_block[block_addr:next_block_addr], addr=write_addr)
+            count_page += 1
           write_addr += spi.flash_write_size
           block_addr = next_block_addr
         count_write += 1
@@ -109,7 +138,7 @@ def flash_stream(filedata, addr=0):
       break
   print("\r",end="")
   stopwatch_stop(bytes_uploaded)
-  print("%dK blocks: %d total, %d erased, %d written." % (spi.flash_erase_size>>10, count_total, count_erase, count_write))
+  print("%dK blocks: %d total, %d erased, %d written (%d pages)." % (spi.flash_erase_size>>10, count_total, count_erase, count_write, count_page))
   return retry >= 0 # True if successful
 
 def flash(filepath, addr=0, close=True):
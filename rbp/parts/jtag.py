@@ -8,6 +8,7 @@ from time import ticks_ms
 from machine import SPI, Pin
 from micropython import const
 from uctypes import addressof
+from struct import unpack
 
 # FIXME hi-z tcknc
 
@@ -34,11 +35,45 @@ gpio_led = const(19)
 #gpio_led = const(5)
 
 irlen = 8
-spi_freq = const(25000000) # Hz JTAG clk frequency
+spi_freq = 25000000 # Hz JTAG clk frequency, config_file overrides
+config_file = "jtag.conf" # per-board settings "name:value", see calibrate()
 spi_channel = const(2) # -1 soft, 1:sd, 2:jtag
 
+# 1: SDR payloads over SPI when available, 0: always bitbang
+spi_lsb1st = 1
+
 hwspi=None
 swspi=None
+lsb1st_spi=None # SPI clocking TCK in bitbang mode, None if not available
+rb=bytearray(256) # reverse bits
+lsb1st_buf=bytearray(64) # bit-reversed scratch for SPI shifts
+lsb1st_mv=memoryview(lsb1st_buf)
+
+# TAP states
+state_reset     = const(0)
+state_idle      = const(1)
+state_drselect  = const(2)
+state_drcapture = const(3)
+state_drshift   = const(4)
+state_drexit1   = const(5)
+state_drpause   = const(6)
+state_drexit2   = const(7)
+state_drupdate  = const(8)
+state_irselect  = const(9)
+state_ircapture = const(10)
+state_irshift   = const(11)
+state_irexit1   = const(12)
+state_irpause   = const(13)
+state_irexit2   = const(14)
+state_irupdate  = const(15)
+# next state for [2*state+tms]
+tap_next=bytes([
+  1, 0,  1, 2,  3, 9,  4, 5,  4, 5,  6, 8,  6, 7,  4, 8,
+  1, 2, 10, 0, 11,12, 11,12, 13,15, 13,14, 11,15,  1, 2])
+tap_state=state_reset # tracked TAP state
+# shortest TMS path for [16*from+to], bits sent LSB first
+tap_path_tms=bytearray(256)
+tap_path_len=bytearray(256)
 
 def bitbang_jtag_on():
   global tms,tck,tdi,tdo,led
@@ -66,15 +101,46 @@ def bitbang_jtag_off():
   del tdi
   del tdo
 
+# per-board settings, written by calibrate()
+def load_config():
+  global spi_freq
+  try:
+    with open(config_file) as f:
+      for line in f:
+        # blank, hand-edited or half-written lines keep defaults
+        item = line.strip().split(":", 1)
+        if len(item) != 2:
+          continue
+        name = item[0]
+        try:
+          value = int(item[1])
+        except ValueError:
+          continue
+        if name == "spi_freq":
+          spi_freq = value
+  except (OSError, ValueError): # ValueError: not UTF-8 text
+    pass
+
+def save_config():
+  with open(config_file, "w") as f:
+    f.write("spi_freq:%d\n" % spi_freq)
+
+load_config()
+
 # initialize both hardware accelerated SPI
 # software SPI on the same pins
+# hwspi SCK is parked at gpio_tcknc between bitstreams,
+# swspi on the JTAG pins shifts LSB-first payloads
 def spi_jtag_on():
-  global hwspi,swspi
+  global hwspi,swspi,lsb1st_spi
   hwspi=SPI(spi_channel, baudrate=spi_freq, polarity=1, phase=1, bits=8, firstbit=SPI.MSB, sck=Pin(gpio_tck), mosi=Pin(gpio_tdi), miso=Pin(gpio_tdo))
   swspi=SPI(-1, baudrate=spi_freq, polarity=1, phase=1, bits=8, firstbit=SPI.MSB, sck=Pin(gpio_tck), mosi=Pin(gpio_tdi), miso=Pin(gpio_tdo))
+  if spi_lsb1st:
+    lsb1st_spi=swspi
 
 def spi_jtag_off():
-  global hwspi,swspi
+  global hwspi,swspi,lsb1st_spi
+  lsb1st_spi=None
   hwspi.deinit()
   del hwspi
   swspi.deinit()
@@ -87,35 +153,98 @@ def spi_jtag_off():
 #    print("%02X" % block[len(block)-n-1], end="")
 #  print(tail, end="")
 
-#@micropython.viper
-#def init_reverse_bits(self):
-#  p8rb=ptr8(addressof(self.rb))
-#  #p8rb=memoryview(self.rb)
-#  for i in range(256):
-#    v=i
-#    r=0
-#    for j in range(8):
-#      r<<=1
-#      r|=v&1
-#      v>>=1
-#    p8rb[i]=r
+@micropython.viper
+def init_reverse_bits():
+  p8rb=ptr8(addressof(rb))
+  for i in range(256):
+    v=i
+    r=0
+    for j in range(8):
+      r<<=1
+      r|=v&1
+      v>>=1
+    p8rb[i]=r
+
+init_reverse_bits()
+
+# bit-reverse n bytes from src to dst, src and dst may be the same
+@micropython.viper
+def reverse_bits_buf(src:ptr8, dst:ptr8, n:int):
+  p8rb=ptr8(addressof(rb))
+  for i in range(n):
+    dst[i]=p8rb[src[i]]
+
+# breadth-first search from each state,
+# fills tap_path_tms and tap_path_len
+def init_tap_paths():
+  for start in range(16):
+    seen=1<<start
+    todo=[(start,0,0)]
+    for state,bits,n in todo:
+      tap_path_tms[start*16+state]=bits
+      tap_path_len[start*16+state]=n
+      for t in range(2):
+        nxt=tap_next[2*state+t]
+        if not (seen>>nxt)&1:
+          seen|=1<<nxt
+          todo.append((nxt,bits|(t<<n),n+1))
+
+init_tap_paths()
 
 @micropython.viper
 def send_tms(val:int):
+  global tap_state
   if val:
     tms.on()
   else:
     tms.off()
   tck.off()
   tck.on()
+  tap_state=int(ptr8(addressof(tap_next))[2*int(tap_state)+val])
 
+# walk the shortest path from tracked state to the new state
+# TMS bits are clocked as one burst
 @micropython.viper
-def send_read_data_buf(buf, last:int, w:ptr8):
-  p = ptr8(addressof(buf))
-  l = int(len(buf))
-  val = 0
+def tap_goto(state:int):
+  global tap_state
+  i=(int(tap_state)<<4)|state
+  bits=int(ptr8(addressof(tap_path_tms))[i])
+  for n in range(int(ptr8(addressof(tap_path_len))[i])):
+    if (bits >> n) & 1:
+      tms.on()
+    else:
+      tms.off()
+    tck.off()
+    tck.on()
+  tap_state=state
+
+# l bytes go thru SPI as bit-reversed bytes
+def spi_read_data_ptr(p, l, w):
+  s = addressof(lsb1st_buf)
+  i = 0
+  while i < l:
+    n = min(l-i, len(lsb1st_buf))
+    reverse_bits_buf(p+i, s, n)
+    lsb1st_spi.write_readinto(lsb1st_mv[:n], lsb1st_mv[:n])
+    if w:
+      reverse_bits_buf(s, w+i, n)
+    i += n
+
+# shift l bytes from p, response to w if not 0
+# all but the last byte go thru SPI when available,
+# last byte is bitbanged to set TMS at the last bit
+# TMS=1 at the last bit moves TAP from "shift" to "exit 1"
+@micropython.viper
+def send_read_data_ptr(p:ptr8, l:int, last:int, w:ptr8):
+  global tap_state
+  j = 0
   tms.off()
-  for i in range(l-1):
+  if l > 1:
+    if lsb1st_spi:
+      spi_read_data_ptr(p, l-1, w)
+      j = l-1
+  val = 0
+  for i in range(j, l-1):
     byte = 0
     val = p[i]
     for nf in range(8):
@@ -153,9 +282,16 @@ def send_read_data_buf(buf, last:int, w:ptr8):
     byte |= 1 << 7
   if int(w):
     w[l-1] = byte # write last byte
+  if last:
+    tap_state = int(tap_state)+1
+
+@micropython.viper
+def send_read_data_buf(buf, last:int, w:ptr8):
+  send_read_data_ptr(addressof(buf), int(len(buf)), last, w)
 
 @micropython.viper
 def send_read_data_byte(val:int, last:int, bits:int)->int:
+  global tap_state
   tms.off()
   byte = 0
   for nf in range(bits-1):
@@ -177,10 +313,13 @@ def send_read_data_byte(val:int, last:int, bits:int)->int:
   tck.on()
   if tdo.value():
     byte |= 1 << (bits-1)
+  if last:
+    tap_state = int(tap_state)+1
   return byte
 
 @micropython.viper
 def send_data_byte_reverse(val:int, last:int, bits:int):
+  global tap_state
   tms.off()
   for nf in range(bits-1):
     if (val >> (7-nf)) & 1:
@@ -197,84 +336,64 @@ def send_data_byte_reverse(val:int, last:int, bits:int):
     tdi.off()
   tck.off()
   tck.on()
-  
-# TAP to "reset" state
+  if last:
+    tap_state = int(tap_state)+1
+
+# TAP to "reset" state from any state
 @micropython.viper
 def reset_tap():
+  global tap_state
   for n in range(6):
     send_tms(1) # -> Test Logic Reset
+  tap_state = state_reset
 
-# TAP should be in "idle" state
-# TAP returns to "select DR scan" state
+# TAP goes to "idle" state and stays there
+# for count cycles during minimum of ms time
 @micropython.viper
 def runtest_idle(count:int, duration_ms:int):
+  tap_goto(state_idle)
   leave=int(ticks_ms()) + duration_ms
   for n in range(count):
     send_tms(0) # -> idle
   while int(ticks_ms()) < leave:
     send_tms(0) # -> idle
-  send_tms(1) # -> select DR scan
 
-# send SIR command (bytes)
-# TAP should be in "select DR scan" state
-# TAP returns to "select DR scan" state
+# send SIR command (int)
+# TAP can be in any state
+# TAP returns to "update IR" state
 # LSB first
 @micropython.viper
 def sir(val:int)->int:
-  send_tms(1) # -> select IR scan
-  send_tms(0) # -> capture IR
-  send_tms(0) # -> shift IR
+  tap_goto(state_irshift)
   r=int(send_read_data_byte(val,1,irlen)) # -> exit 1 IR
-  send_tms(0) # -> pause IR
-  send_tms(1) # -> exit 2 IR
-  send_tms(1) # -> update IR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_irupdate)
   return r
 
 @micropython.viper
 def sir_idle(val:int, n:int, ms:int)->int:
-  send_tms(1) # -> select IR scan
-  send_tms(0) # -> capture IR
-  send_tms(0) # -> shift IR
-  r=int(send_read_data_byte(val,1,irlen)) # -> exit 1 IR
-  send_tms(0) # -> pause IR
-  send_tms(1) # -> exit 2 IR
-  send_tms(1) # -> update IR
-  runtest_idle(n+1, ms) # -> select DR scan
+  r=int(sir(val))
+  runtest_idle(n, ms)
   return r
 
 # LSB first
 @micropython.viper
 def sdr(buf):
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  send_read_data_buf(buf,1,0)
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drshift)
+  send_read_data_buf(buf,1,0) # -> exit 1 DR
+  tap_goto(state_drupdate)
 
 # LSB first
 @micropython.viper
 def sdr_idle(buf, n:int, ms:int):
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  send_read_data_buf(buf,1,0)
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  runtest_idle(n+1, ms) # -> select DR scan
+  sdr(buf)
+  runtest_idle(n, ms)
 
 # sdr buffer will be overwritten with response LSB first
 @micropython.viper
 def sdr_response(buf):
-  send_tms(0) # -> capture DR
-  send_tms(0) # -> shift DR
-  send_read_data_buf(buf,1,addressof(buf))
-  send_tms(0) # -> pause DR
-  send_tms(1) # -> exit 2 DR
-  send_tms(1) # -> update DR
-  send_tms(1) # -> select DR scan
+  tap_goto(state_drshift)
+  send_read_data_buf(buf,1,addressof(buf)) # -> exit 1 DR
+  tap_goto(state_drupdate)
 
 # common JTAG open for both program and flash
 def jtag_open():
@@ -285,6 +404,88 @@ def jtag_open():
   reset_tap()
   runtest_idle(1,0)
 
+# hwspi TCK frequencies tried by calibrate(), 80 MHz APB divided
+calibrate_freqs = (5000000, 8000000, 10000000, 13333333, 16000000, 20000000, 26666666, 40000000)
+
+# bit offset of n bits of t (MSB first) in rx, -1 if not found
+def find_bits(rx, t, n):
+  l = 8*len(rx)
+  r = int.from_bytes(rx, "big")
+  m = (1 << n) - 1
+  for d in range(min(32, l-n+1)):
+    if (r >> (l-d-n)) & m == t:
+      return d
+  return -1
+
+# hwspi readback at freq of a pattern thru BYPASS
+# and of IDCODE id. returns bit offsets, -1 if not found.
+# IDCODE is in DR after reset, IR of all ones is BYPASS
+# for any vendor, only irlen of the part is needed
+def calibrate_read(freq, tx, rx, rxid, id):
+  jtag_open()
+  tap_goto(state_drshift)
+  hwspi.init(baudrate=freq, sck=Pin(gpio_tck))
+  hwspi.readinto(rxid, 0xFF)
+  hwspi.init(sck=Pin(gpio_tcknc))
+  bitbang_jtag_on()
+  sir((1 << irlen)-1) # BYPASS
+  tap_goto(state_drshift)
+  hwspi.init(baudrate=freq, sck=Pin(gpio_tck))
+  hwspi.write_readinto(tx, rx)
+  hwspi.init(sck=Pin(gpio_tcknc))
+  bitbang_jtag_on()
+  reset_tap()
+  led.off()
+  spi_jtag_off()
+  bitbang_jtag_off()
+  # IDCODE is shifted LSB first
+  idrev = int.from_bytes(bytes([rb[b] for b in id.to_bytes(4, "little")]), "big")
+  return find_bits(rx, int.from_bytes(tx, "big") >> 32, 8*len(tx)-32), find_bits(rxid, idrev, 32)
+
+# find highest hwspi TCK frequency with reliable readback,
+# keep one step below it as safety margin and save to config_file.
+# returns selected frequency, 0 if none works
+def calibrate(repeat=4, save=True):
+  global spi_freq
+  bitbang_jtag_on()
+  reset_tap()
+  runtest_idle(1,0)
+  r = bytearray(4)
+  sdr_response(r) # IDCODE
+  reset_tap()
+  bitbang_jtag_off()
+  id = unpack("<I", r)[0]
+  if id == 0 or id == 0xFFFFFFFF:
+    print("calibrate: no JTAG device")
+    return 0
+  tx = bytearray([(i*0x3B+0x5A)&0xFF for i in range(64)])
+  rx = bytearray(len(tx))
+  rxid = bytearray(8)
+  ref = None
+  good = -1
+  for i in range(len(calibrate_freqs)):
+    freq = calibrate_freqs[i]
+    ok = True
+    for n in range(repeat):
+      d = calibrate_read(freq, tx, rx, rxid, id)
+      if ref is None:
+        ref = d # offsets at lowest frequency are the reference
+      if d != ref or -1 in d:
+        ok = False
+        break
+    print("%d Hz %s" % (freq, "ok" if ok else "fail"))
+    if not ok:
+      break
+    good = i
+  if good < 0:
+    print("calibrate: fails at lowest frequency")
+    return 0
+  spi_freq = calibrate_freqs[max(0, good-1)]
+  print("spi_freq = %d Hz" % spi_freq)
+  if save:
+    save_config()
+  return spi_freq
+
 def stopwatch_start():
   global stopwatch_ms
   stopwatch_ms = ticks_ms()
@@ -292,16 +493,49 @@ def stopwatch_start():
 def stopwatch_stop(bytes_uploaded):
   global stopwatch_ms
   elapsed_ms = ticks_ms() - stopwatch_ms
-  transfer_rate_MBps = 0
+  transfer_rate_kBps = 0
   if elapsed_ms > 0:
     transfer_rate_kBps = bytes_uploaded // elapsed_ms
   print("%d bytes uploaded in %d ms (%d kB/s)" % (bytes_uploaded, elapsed_ms, transfer_rate_kBps))
 
+gz_wbits = 15 # deflate window of last opened .gz, see open_gz()
+
+# gzip header, deflate window from FEXTRA subfield "WB"
+# (1 byte, log2 window size 9-15) written by tools/gzwin.py,
+# 15 (32K) without it. Stream is left at the deflate data
+def gz_header(stream):
+  h = stream.read(10)
+  if len(h) < 10 or h[0] != 0x1F or h[1] != 0x8B or h[2] != 8:
+    raise ValueError("not gzip")
+  flg = h[3]
+  wbits = 15
+  if flg & 4: # FEXTRA
+    x = stream.read(unpack("<H", stream.read(2))[0])
+    i = 0
+    while i+4 <= len(x):
+      l = x[i+2] | (x[i+3] << 8)
+      if x[i] == 0x57 and x[i+1] == 0x42 and l == 1 and 9 <= x[i+4] <= 15: # "WB"
+        wbits = x[i+4]
+      i += 4+l
+  for f in (8, 16): # FNAME, FCOMMENT zero terminated
+    if flg & f:
+      while stream.read(1) not in (b"\x00", b""):
+        pass
+  if flg & 2: # FHCRC
+    stream.read(2)
+  return wbits
+
+# raw deflate after gzip header, window only as large as needed
+def open_gz(stream):
+  global gz_wbits
+  import uzlib
+  gz_wbits = gz_header(stream)
+  return uzlib.DecompIO(stream, -gz_wbits)
+
 def open_file(filename, gz=False):
   filedata = open(filename,"rb")
   if gz:
-    import uzlib
-    return uzlib.DecompIO(filedata,31)
+    return open_gz(filedata)
   return filedata
 
 def open_web(url, gz=False):
@@ -319,16 +553,22 @@ def open_web(url, gz=False):
     if len(s.readline()) < 3: # first empty line (contains "\r\n")
       break
   if gz:
-    import uzlib
-    return uzlib.DecompIO(s,31)
+    return open_gz(s)
   return s
 
+# gz is True for compressed ".gz", ".lz4" or ".bitc"
 def filedata_gz(filepath):
   gz = filepath.endswith(".gz")
   if filepath.startswith("http://") or filepath.startswith("/http:/"):
     filedata = open_web(filepath, gz)
   else:
     filedata = open_file(filepath, gz)
+  if filedata and filepath.endswith(".lz4"):
+    import unlz4
+    return unlz4.DecompIO(filedata), True
+  if filedata and filepath.endswith(".bitc"):
+    import bitc
+    return bitc.ChunkIO(filedata), True
   return filedata, gz
 
 def check_response(response, expected, mask=0xFFFFFFFF, message=""):
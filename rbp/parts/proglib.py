@@ -9,30 +9,225 @@
 #import artix7lib as fpga
 import cyclone5lib as fpga
 
+from time import ticks_ms
+from struct import unpack
+from gc import collect, mem_free
+from os import stat
+try:
+  import _thread
+except ImportError:
+  _thread = None
+
 import jtag
 from jtag import *
 
+# RAM for decompressed bitstreams of prog(), see cache_load()
+# 0: off, -1: quarter of free RAM if more than 1 MB (WROVER PSRAM)
+cache_budget = 0
+cache = [] # [filepath, (size, mtime, bitstream size), bitstream], least recently used first
+
+# 1: prog_stream() reads in a _thread if available, 0: never
+prog_threads = 0
+read_ms = 0 # time in readinto() during last prog_stream()
+
+# read until mv is full or end of file,
+# sockets and DecompIO may return less than asked.
+# returns number of bytes read
+def readinto_full(filedata, mv):
+  n = 0
+  while n < len(mv):
+    r = filedata.readinto(mv[n:])
+    if not r:
+      break
+    n += r
+  return n
+
+# reader thread of prog_stream_threaded()
+# fills block i while the other one goes to hwspi,
+# len 0 marks end of file, stop[0] set by the main loop ends it
+def prog_stream_reader(filedata, block, n, free, full, stop):
+  global read_ms
+  i = 0
+  while True:
+    free[i].acquire()
+    if stop[0]:
+      break
+    t = ticks_ms()
+    try:
+      n[i] = readinto_full(filedata, block[i])
+    except Exception as e:
+      print("prog_stream: %s" % e)
+      n[i] = 0
+    read_ms += ticks_ms()-t
+    full[i].release()
+    if n[i] == 0:
+      break
+    i ^= 1
+
+# double-buffered: next block is read in a _thread
+# while current block goes to hwspi
+def prog_stream_threaded(filedata, blocksize):
+  block = (memoryview(bytearray(blocksize)), memoryview(bytearray(blocksize)))
+  n = [0, 0]
+  free = (_thread.allocate_lock(), _thread.allocate_lock())
+  full = (_thread.allocate_lock(), _thread.allocate_lock())
+  for lock in full:
+    lock.acquire()
+  stop = [0]
+  _thread.start_new_thread(prog_stream_reader, (filedata, block, n, free, full, stop))
+  bytes_uploaded = 0
+  spi_ms = 0
+  i = 0
+  try:
+    while True:
+      full[i].acquire()
+      if n[i] == 0:
+        break
+      t = ticks_ms()
+      jtag.hwspi.write(block[i][:n[i]])
+      spi_ms += ticks_ms()-t
+      bytes_uploaded += n[i]
+      free[i].release()
+      i ^= 1
+  finally: # reader waits on free, let it see stop
+    stop[0] = 1
+    for lock in free:
+      if lock.locked():
+        lock.release()
+  return bytes_uploaded, spi_ms
+
 def prog_stream(filedata, blocksize=4096):
+  global read_ms
   fpga.prog_open()
   bytes_uploaded = 0
   stopwatch_start()
-  block = bytearray(blocksize)
-  while True:
-    if filedata.readinto(block):
-      jtag.hwspi.write(block)
-      bytes_uploaded += len(block)
-    else:
-      break
+  t0 = ticks_ms()
+  read_ms = 0
+  if hasattr(filedata, "readspan"): # .bitc, no copy, zero runs not decompressed
+    while True:
+      mv = filedata.readspan(blocksize)
+      if len(mv) == 0:
+        break
+      jtag.hwspi.write(mv)
+      bytes_uploaded += len(mv)
+  elif prog_threads and _thread:
+    bytes_uploaded, spi_ms = prog_stream_threaded(filedata, blocksize)
+    overlap = max(0, read_ms+spi_ms-(ticks_ms()-t0))
+    print("%d ms read, %d ms SPI, %d ms overlapped" % (read_ms, spi_ms, overlap))
+  else:
+    block = memoryview(bytearray(blocksize))
+    while True:
+      n = readinto_full(filedata, block)
+      if n:
+        jtag.hwspi.write(block[:n])
+        bytes_uploaded += n
+      else:
+        break
   stopwatch_stop(bytes_uploaded)
   fpga.prog_stream_done()
 
+# cache_budget in bytes, -1 resolved on first use
+def cache_limit():
+  global cache_budget
+  if cache_budget < 0:
+    free = mem_free()
+    cache_budget = free//4 if free > 0x100000 else 0
+  return cache_budget
+
+# file size, mtime and bitstream size,
+# bitstream size of .gz is gzip ISIZE from the end of file,
+# of .lz4 content size from the frame header,
+# of .bitc length from the container header.
+# None if not cacheable
+def cache_stat(filepath):
+  if cache_limit() == 0 or filepath.startswith("http://") or filepath.startswith("/http:/"):
+    return None
+  try:
+    st = stat(filepath)
+    size = st[6]
+    if filepath.endswith(".gz"):
+      with open(filepath, "rb") as f:
+        f.seek(-4, 2)
+        size = unpack("<I", f.read(4))[0]
+    if filepath.endswith(".lz4"):
+      import unlz4
+      size = unlz4.content_size(filepath)
+    if filepath.endswith(".bitc"):
+      import bitc
+      size = bitc.info(filepath)[1]
+    return (st[6], st[8], size)
+  except (OSError, ValueError):
+    return None
+
+# drop least recently used bitstreams until size fits
+def cache_evict(size):
+  used = 0
+  for c in cache:
+    used += len(c[2])
+  while cache and used + size > cache_budget:
+    used -= len(cache.pop(0)[2])
+  collect()
+
+def cache_clear():
+  del cache[:]
+  collect()
+
+# decompressed bitstream of a local file,
+# from cache or read and inserted into cache.
+# None if the cache is off or the bitstream doesn't fit
+def cache_load(filepath):
+  st = cache_stat(filepath)
+  if st is None:
+    return None
+  for i in range(len(cache)):
+    if cache[i][0] == filepath:
+      c = cache.pop(i)
+      if c[1] == st:
+        cache.append(c) # most recently used
+        return c[2]
+      break # file changed
+  size = st[2]
+  if size == 0 or size > cache_budget:
+    return None
+  cache_evict(size)
+  try:
+    buf = bytearray(size)
+  except MemoryError:
+    return None
+  filedata, gz = filedata_gz(filepath)
+  if readinto_full(filedata, memoryview(buf)) != size:
+    return None
+  cache.append([filepath, st, buf])
+  return buf
+
+# bitstream from RAM
+def prog_buf(buf):
+  fpga.prog_open()
+  stopwatch_start()
+  jtag.hwspi.write(buf)
+  stopwatch_stop(len(buf))
+  fpga.prog_stream_done()
+
+# SPI block for prog_stream(), small while
+# decompressor holds a large window,
+# .bitc chunk as it is decompressed
+def prog_blocksize(filepath, gz, filedata=None):
+  if getattr(filedata, "chunk_size", 0):
+    return filedata.chunk_size
+  if gz and not (filepath.endswith(".gz") and jtag.gz_wbits <= 12):
+    return 4096
+  return 16384
+
 def prog(filepath, close=True):
+  buf = cache_load(filepath)
+  if buf:
+    prog_buf(buf)
+    if close:
+      return fpga.prog_close()
+    return True
   filedata, gz = filedata_gz(filepath)
   if filedata:
-    if gz:
-      prog_stream(filedata,blocksize=4096)
-    else:
-      prog_stream(filedata,blocksize=16384)
+    prog_stream(filedata,blocksize=prog_blocksize(filepath, gz, filedata))
     # NOTE now the SD card can be released before bitstream starts
     if close:
       return fpga.prog_close() # start the bitstream
@@ -0,0 +1,415 @@
+# micropython ESP32
+# SVF player
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# plays SVF from file, http or gzip stream.
+# SVF is read thru a bounded buffer and
+# hex data are converted to binary as they arrive.
+# usage:
+# import svf
+# svf.play("bitstream.svf.gz")
+
+from time import sleep_ms
+from machine import Pin
+from micropython import const
+from struct import unpack_from
+from uctypes import addressof
+from gc import collect
+
+import jtag
+from jtag import *
+
+# SDR longer than this many bytes without TDO check
+# go thru hwspi (1 TCK-glitch, TDI=0 at the start),
+# 0: always bitbang
+hwspi_min = 4096
+
+rdbuf=bytearray(1024) # SVF text read buffer
+rdlen=0
+rdpos=0
+rdtotal=0 # SVF bytes read
+rdfile=None
+spibuf=bytearray(1024) # bit-reversed scratch for hwspi
+spimv=memoryview(spibuf)
+hexst=bytearray(8) # hex parser: digit count, stop reason
+svf_line=0 # statement number for error messages
+
+# SVF state names in the order of jtag state_* constants
+svf_states=("RESET","IDLE","DRSELECT","DRCAPTURE","DRSHIFT","DREXIT1","DRPAUSE","DREXIT2","DRUPDATE",
+  "IRSELECT","IRCAPTURE","IRSHIFT","IREXIT1","IRPAUSE","IREXIT2","IRUPDATE")
+svf_params=("TDI","TDO","MASK","SMASK")
+
+# scan registers for HIR HDR TIR TDR SIR SDR:
+# [length, TDI, TDO, MASK, SMASK, check, response]
+# TDO MASK SMASK response are None until needed, MASK None is all 1
+reg_len   = const(0)
+reg_tdi   = const(1)
+reg_tdo   = const(2)
+reg_mask  = const(3)
+reg_check = const(5)
+reg_resp  = const(6)
+svf_reg={}
+
+def svf_getc():
+  global rdpos, rdlen, rdtotal
+  if rdpos >= rdlen:
+    rdlen = rdfile.readinto(rdbuf) or 0
+    rdpos = 0
+    rdtotal += rdlen
+    if rdlen <= 0:
+      return -1
+  c = rdbuf[rdpos]
+  rdpos += 1
+  return c
+
+# next SVF token: keyword, number, ";", "(" or ")"
+# "" at end of file
+def svf_token():
+  global rdpos
+  c = svf_getc()
+  while True:
+    while c == 32 or (c >= 9 and c <= 13):
+      c = svf_getc()
+    if c == 33 or c == 47: # "!" or "//" comment
+      while c >= 0 and c != 10:
+        c = svf_getc()
+      continue
+    break
+  if c < 0:
+    return ""
+  if c == 59 or c == 40 or c == 41:
+    return chr(c)
+  t = bytearray()
+  while c > 32 and c != 59 and c != 40 and c != 41:
+    t.append(c)
+    c = svf_getc()
+  if c >= 0:
+    rdpos -= 1
+  return t.decode().upper()
+
+# tokens until ";"
+def svf_args():
+  args = []
+  while True:
+    t = svf_token()
+    if t == ";" or t == "":
+      return args
+    args.append(t)
+
+# pack hex digits MSB first into dst until ")"
+# st: digit count, stop reason 1:")" 2:overflow
+@micropython.viper
+def hex_scan(src:ptr8, pos:int, end:int, dst:ptr8, cap:int, st:ptr32)->int:
+  n = st[0]
+  while pos < end:
+    c = src[pos]
+    pos += 1
+    if c == 41: # ")"
+      st[1] = 1
+      break
+    if c >= 48 and c <= 57:
+      v = c - 48
+    elif c >= 65 and c <= 70:
+      v = c - 55
+    elif c >= 97 and c <= 102:
+      v = c - 87
+    else:
+      continue
+    if n >= cap:
+      st[1] = 2
+      break
+    if n & 1:
+      dst[n >> 1] |= v
+    else:
+      dst[n >> 1] = v << 4
+    n += 1
+  st[0] = n
+  return pos
+
+# n hex digits packed MSB first -> l bytes LSB first
+@micropython.viper
+def hex_lsb1st(p:ptr8, n:int, l:int):
+  b = (n+1) >> 1
+  if n & 1: # odd digits, shift in a leading zero
+    i = b-1
+    while i > 0:
+      p[i] = ((p[i-1] << 4) | (p[i] >> 4)) & 0xFF
+      i -= 1
+    p[0] = p[0] >> 4
+  i = 0
+  j = b-1
+  while i < j:
+    v = p[i]
+    p[i] = p[j]
+    p[j] = v
+    i += 1
+    j -= 1
+  for i in range(b, l):
+    p[i] = 0
+
+# read "(hex)" into dst after "(" token
+def svf_hex(dst):
+  global rdpos
+  hexst[:] = bytes(8)
+  while hexst[4] == 0:
+    if svf_getc() < 0:
+      print("SVF %d: unexpected end of file" % svf_line)
+      return False
+    rdpos = hex_scan(rdbuf, rdpos-1, rdlen, dst, 2*len(dst), hexst)
+  if hexst[4] != 1:
+    print("SVF %d: too many hex digits" % svf_line)
+    return False
+  hex_lsb1st(dst, unpack_from("<I", hexst)[0], len(dst))
+  return True
+
+# parse length and parameters of a scan command
+def svf_scan(cmd):
+  t = svf_token()
+  if not t.isdigit():
+    print("SVF %d: %s bad length %s" % (svf_line, cmd, t))
+    return None
+  n = int(t)
+  r = svf_reg.get(cmd)
+  if r is None or r[reg_len] != n:
+    svf_reg[cmd] = None
+    collect()
+    r = [n, bytearray((n+7) >> 3), None, None, None, False, None]
+    svf_reg[cmd] = r
+  if cmd == "SIR" or cmd == "SDR":
+    r[reg_check] = False
+  while True:
+    t = svf_token()
+    if t == ";":
+      return r
+    if t not in svf_params or svf_token() != "(":
+      print("SVF %d: %s bad parameter %s" % (svf_line, cmd, t))
+      return None
+    i = svf_params.index(t) + 1
+    if r[i] is None:
+      r[i] = bytearray(len(r[reg_tdi]))
+    if not svf_hex(r[i]):
+      return None
+    if i == reg_tdo:
+      r[reg_check] = True
+      if r[reg_resp] is None:
+        r[reg_resp] = bytearray(len(r[reg_tdi]))
+
+# compare n bits of response with TDO under MASK
+# returns 0 if equal, else index+1 of the first different byte
+@micropython.viper
+def svf_compare(r:ptr8, tdo:ptr8, mask:ptr8, n:int)->int:
+  l = (n+7) >> 3
+  for i in range(l):
+    m = 0xFF
+    if int(mask):
+      m = mask[i]
+    if i == l-1 and (n & 7):
+      m &= (1 << (n & 7)) - 1
+    if (r[i] ^ tdo[i]) & m:
+      return i+1
+  return 0
+
+# bytes thru hwspi, MSB first after bit-reverse
+def svf_hwspi(p, l):
+  s = addressof(spibuf)
+  jtag.hwspi.init(sck=Pin(gpio_tck)) # 1 TCK-glitch TDI=0
+  i = 0
+  while i < l:
+    n = min(l-i, len(spibuf))
+    reverse_bits_buf(p+i, s, n)
+    jtag.hwspi.write(spimv[:n])
+    i += n
+  jtag.hwspi.init(sck=Pin(gpio_tcknc)) # avoid TCK-glitch
+  bitbang_jtag_on()
+
+# shift one scan register, TAP must be in shift state
+def svf_shift_reg(r, last):
+  n = r[reg_len]
+  if n == 0:
+    return True
+  tdi = r[reg_tdi]
+  check = r[reg_check]
+  l = (n-1) >> 3 # bytes before the last 1-8 bits
+  w = addressof(r[reg_resp]) if check else 0
+  if l:
+    if hwspi_min and l >= hwspi_min and not check:
+      svf_hwspi(addressof(tdi), l)
+    else:
+      send_read_data_ptr(addressof(tdi), l, 0, w)
+  b = send_read_data_byte(tdi[l], last, n-8*l)
+  if check:
+    r[reg_resp][l] = b
+    i = svf_compare(r[reg_resp], r[reg_tdo], r[reg_mask] or 0, n)
+    if i:
+      i -= 1
+      print("SVF %d: TDO mismatch at byte %d 0x%02X != 0x%02X" % (svf_line, i, r[reg_resp][i], r[reg_tdo][i]))
+      return False
+  return True
+
+# header, data, trailer as one scan
+# ends in ENDIR/ENDDR state
+def svf_shift(ir, r):
+  if ir:
+    regs = (svf_reg.get("HIR"), r, svf_reg.get("TIR"))
+    tap_goto(state_irshift)
+  else:
+    regs = (svf_reg.get("HDR"), r, svf_reg.get("TDR"))
+    tap_goto(state_drshift)
+  lastreg = None
+  for x in regs:
+    if x and x[reg_len]:
+      lastreg = x
+  for x in regs:
+    if x and not svf_shift_reg(x, x is lastreg):
+      return False
+  tap_goto(svf_endir if ir else svf_enddr)
+  return True
+
+def svf_state(name):
+  if name in svf_states:
+    return svf_states.index(name)
+  print("SVF %d: unknown state %s" % (svf_line, name))
+  return -1
+
+# SVF number like 1.00E-02, None if not a number
+def svf_number(t):
+  try:
+    return float(t)
+  except ValueError:
+    return None
+
+# RUNTEST [run_state] [count TCK|SCK] [min SEC] [MAXIMUM max SEC] [ENDSTATE end_state]
+def svf_runtest(args):
+  global svf_run_state, svf_run_end
+  count = 0
+  ms = 0
+  i = 0
+  if args and args[0] in svf_states:
+    svf_run_state = svf_run_end = svf_states.index(args[0])
+    i = 1
+  while i < len(args):
+    if args[i] == "ENDSTATE" and i+1 < len(args):
+      svf_run_end = svf_state(args[i+1])
+      if svf_run_end < 0:
+        return False
+      i += 2
+    elif args[i] == "MAXIMUM":
+      i += 3
+    elif i+1 < len(args) and svf_number(args[i]) is not None:
+      if args[i+1] == "SEC":
+        ms = int(svf_number(args[i])*1000+0.999)
+      else: # TCK or SCK
+        count = int(svf_number(args[i]))
+      i += 2
+    else:
+      print("SVF %d: RUNTEST bad parameter %s" % (svf_line, args[i]))
+      return False
+  if svf_run_state == state_idle:
+    runtest_idle(count, ms)
+  else:
+    tap_goto(svf_run_state)
+    tms = 1 if svf_run_state == state_reset else 0
+    for i in range(count):
+      send_tms(tms)
+    sleep_ms(ms)
+  tap_goto(svf_run_end)
+  return True
+
+# FREQUENCY [cycles HZ]: hwspi and swspi TCK not above it
+# for the rest of the file, spi_freq without a value.
+# bitbanged TCK is slower than SPI and not limited
+def svf_frequency(args):
+  f = jtag.spi_freq
+  if args:
+    v = svf_number(args[0])
+    if len(args) != 2 or args[1] != "HZ" or v is None or v < 1:
+      print("SVF %d: FREQUENCY bad parameter %s" % (svf_line, " ".join(args)))
+      return False
+    f = min(f, int(v))
+  jtag.hwspi.init(baudrate=f)
+  jtag.swspi.init(baudrate=f)
+  bitbang_jtag_on() # swspi init takes the JTAG pins
+  return True
+
+def svf_statement(cmd):
+  global svf_endir, svf_enddr
+  if cmd in ("SIR","SDR","HIR","HDR","TIR","TDR"):
+    r = svf_scan(cmd)
+    if r is None:
+      return False
+    if cmd == "SIR":
+      return svf_shift(1, r)
+    if cmd == "SDR":
+      return svf_shift(0, r)
+    return True
+  args = svf_args()
+  if cmd == "RUNTEST":
+    return svf_runtest(args)
+  if cmd == "STATE":
+    for name in args:
+      state = svf_state(name)
+      if state < 0:
+        return False
+      if state == state_reset:
+        reset_tap()
+      else:
+        tap_goto(state)
+    return True
+  if cmd == "ENDIR" or cmd == "ENDDR":
+    if len(args) != 1:
+      print("SVF %d: %s needs one state" % (svf_line, cmd))
+      return False
+    state = svf_state(args[0])
+    if state < 0:
+      return False
+    if cmd == "ENDIR":
+      svf_endir = state
+    else:
+      svf_enddr = state
+    return True
+  if cmd == "FREQUENCY":
+    return svf_frequency(args)
+  if cmd == "TRST":
+    return True
+  print("SVF %d: unsupported %s" % (svf_line, cmd))
+  return False
+
+# returns True if all statements passed
+def play_stream(filedata):
+  global rdfile, rdlen, rdpos, rdtotal, svf_line
+  global svf_endir, svf_enddr, svf_run_state, svf_run_end
+  rdfile = filedata
+  rdlen = rdpos = rdtotal = svf_line = 0
+  svf_endir = svf_enddr = svf_run_state = svf_run_end = state_idle
+  jtag_open()
+  ok = True
+  try:
+    while ok:
+      t = svf_token()
+      if t == "":
+        break
+      if t == ";":
+        continue
+      svf_line += 1
+      ok = svf_statement(t)
+  except MemoryError:
+    print("SVF %d: scan does not fit in RAM" % svf_line)
+    ok = False
+  finally: # release JTAG pins and hwspi on any error
+    spi_jtag_off()
+    bitbang_jtag_off()
+    svf_reg.clear()
+    rdfile = None
+    collect()
+  return ok
+
+def play(filepath):
+  filedata, gz = filedata_gz(filepath)
+  if filedata:
+    stopwatch_start()
+    ok = play_stream(filedata)
+    stopwatch_stop(rdtotal)
+    return ok
+  return False
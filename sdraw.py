@@ -18,7 +18,7 @@ class sdraw:
   
   def stopwatch_stop(self, bytes_uploaded):
     elapsed_ms = ticks_ms() - self.stopwatch_ms
-    transfer_rate_MBps = 0
+    transfer_rate_kBps = 0
     if elapsed_ms > 0:
       transfer_rate_kBps = bytes_uploaded // elapsed_ms
     print("%d bytes uploaded in %d ms (%d kB/s)" % (bytes_uploaded, elapsed_ms, transfer_rate_kBps))
@@ -49,6 +49,18 @@ class sdraw:
       return uzlib.DecompIO(s,31)
     return s
 
+  # read until mv is full or end of file,
+  # sockets and DecompIO may return less than asked.
+  # returns number of bytes read
+  def readinto_full(self, filedata, mv):
+    n = 0
+    while n < len(mv):
+      r = filedata.readinto(mv[n:])
+      if not r:
+        break
+      n += r
+    return n
+
   def sd_open(self):
     self.sd = SDCard(slot=3)
 
@@ -89,14 +101,19 @@ class sdraw:
     addr=self.sd_wrapaddr(addr)
     nearend=self.sd_wrapaddr(-blocksize)
     self.stopwatch_start()
-    block = bytearray(blocksize)
+    block = memoryview(bytearray(blocksize))
     while True:
       waddr=addr+bytes_uploaded
       if waddr >= nearend and len(block) > 0x200:
-        block = bytearray(0x200)
-      if filedata.readinto(block):
-        self.sd.writeblocks(waddr//0x200,block)
-        bytes_uploaded += len(block)
+        block = memoryview(bytearray(0x200))
+      n = self.readinto_full(filedata, block)
+      if n:
+        # whole 512-byte sectors, zero after end of file
+        m = (n+0x1FF) & ~0x1FF
+        if m > n:
+          block[n:m] = bytes(m-n)
+        self.sd.writeblocks(waddr//0x200,block[:m])
+        bytes_uploaded += n
       else:
         break
     self.stopwatch_stop(bytes_uploaded)
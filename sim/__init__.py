@@ -0,0 +1,66 @@
+# Host-side simulation of the ESP32 JTAG programmer
+#
+# Stands in for machine, micropython, uctypes, uzlib and
+# time.ticks_ms so ecp5.py runs unmodified under CPython,
+# driving a cycle-accurate TAP chain with an ECP5
+# configuration engine and SPI flash behind it.
+#
+# import sim
+# b = sim.install()
+# import ecp5
+# ecp5.prog("blink.bit")
+# print(sim.report(b))
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import gc, sys, time
+
+from . import mpy, machine, uzlib, tap
+from .board import board, PINOUT, PINOUT_RBP
+from .ecp5dev import ecp5
+from .spiflash import spiflash
+
+def install(b=None):
+  if b is None:
+    b = board([ecp5(flash=spiflash())])
+  mpy.install(b)
+  machine.board = b
+  sys.modules["machine"] = machine
+  sys.modules["uzlib"] = uzlib
+  time.ticks_ms = b.ticks_ms
+  time.ticks_us = b.ticks_us
+  time.sleep_ms = b.sleep_ms
+  time.sleep_us = b.sleep_us
+  time.ticks_diff = lambda a, b: a-b
+  time.ticks_add = lambda a, b: a+b
+  if not hasattr(gc, "mem_free"):
+    gc.mem_free = lambda: 4*1024*1024
+    gc.mem_alloc = lambda: 0
+  return b
+
+# TCK cycles per source and payload bytes per cycle
+def report(b, payload_bytes=0):
+  cycles = b.tck_cycles()
+  s = "%d TCK cycles (%s), %d us" % (cycles,
+    ", ".join("%s %d" % kv for kv in sorted(b.cycles.items())), b.time_ns//1000)
+  if payload_bytes and cycles:
+    s += ", %d bytes, %.3f bytes/cycle" % (payload_bytes, payload_bytes/cycles)
+  return s
+
+# run f() once per bitbang backend of ecp5.py,
+# returns (ok, n) where ok is True if both clocked
+# the same TMS/TDI sequence and returned the same result.
+# A first Pin run leaves board and TAP in the state
+# both compared runs start from.
+def check_bitbang(b, f):
+  import ecp5
+  runs = []
+  for reg in (0, 0, 1):
+    ecp5.gpio_reg = reg
+    b.trace = []
+    r = f()
+    runs.append(([e[1:] for e in b.trace], r))
+  b.trace = None
+  ecp5.gpio_reg = 1
+  return runs[1] == runs[2], len(runs[2][0])
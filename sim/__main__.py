@@ -0,0 +1,59 @@
+# run ecp5.py against the simulated board
+#
+# python3 -m sim idcode
+# python3 -m sim prog blink.bit
+# python3 -m sim flash blink.bit.gz --addr 0x100000
+# python3 -m sim bitbang blink.bit
+# python3 -m sim svf blink.svf (rbp/parts/svf.py, rbp wiring)
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import argparse, os, sys
+
+import sim
+
+def main():
+  p = argparse.ArgumentParser(prog="python3 -m sim", description="ecp5.py on a simulated ULX3S")
+  p.add_argument("cmd", choices=("idcode", "prog", "flash", "flashrd", "bitbang", "svf"),
+                 help="bitbang: compare Pin and register-level edges")
+  p.add_argument("file", nargs="?")
+  p.add_argument("--addr", type=lambda x: int(x, 0), default=0)
+  p.add_argument("--length", type=lambda x: int(x, 0), default=256, help="flashrd bytes")
+  p.add_argument("--idcode", type=lambda x: int(x, 0), default=0x41113043)
+  p.add_argument("--glitch", action="store_true", help="1 TCK when hwspi takes over TCK")
+  p.add_argument("--max-hz", type=int, help="hwspi faster than this reads stale TDO")
+  p.add_argument("--pin", action="store_true", help="bitbang thru Pin methods, not registers")
+  p.add_argument("--pinout", choices=("ecp5", "rbp"),
+                 help="wiring of ecp5.py or rbp/parts/jtag.py, default rbp for svf")
+  a = p.parse_args()
+  rbp = a.pinout == "rbp" or (a.pinout is None and a.cmd == "svf")
+  b = sim.install(sim.board([sim.ecp5(idcode=a.idcode, flash=sim.spiflash())],
+                            pinout=sim.PINOUT_RBP if rbp else sim.PINOUT,
+                            glitch=a.glitch, max_hz=a.max_hz))
+  if a.cmd == "svf":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rbp", "parts"))
+    import svf
+    print(svf.play(a.file))
+    print(sim.report(b))
+    return
+  import ecp5
+  ecp5.gpio_reg = 0 if a.pin else 1
+  payload = 0
+  if a.file and not a.file.startswith("http"):
+    payload = os.path.getsize(a.file)
+  if a.cmd == "idcode":
+    print("0x%08X" % ecp5.idcode())
+  elif a.cmd == "prog":
+    print(ecp5.prog(a.file))
+  elif a.cmd == "flash":
+    print(ecp5.flash(a.file, addr=a.addr))
+  elif a.cmd == "flashrd":
+    print(ecp5.flashrd(a.addr, a.length).hex())
+  elif a.cmd == "bitbang":
+    ok, n = sim.check_bitbang(b, lambda: (ecp5.idcode(), a.file and ecp5.prog(a.file),
+                                          ecp5.flashrd(a.addr, a.length)))
+    print("%d edges, %s" % (n, "same" if ok else "DIFFERENT"))
+  print(sim.report(b, payload))
+
+main()
@@ -0,0 +1,116 @@
+# ESP32 GPIO matrix, TCK clocking and virtual time
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+from . import tap as t
+
+# ULX3S v3.0.x pinout, same as ecp5.py
+PINOUT = dict(tms=21, tck=18, tdi=23, tdo=19, tcknc=17, led=5)
+# ULX3S v3.1.x and FROGO wiring of rbp/parts/jtag.py
+PINOUT_RBP = dict(tms=5, tck=18, tdi=23, tdo=34, tcknc=21, led=19)
+
+class board:
+  def __init__(self, chain, pinout=PINOUT, bitbang_ns=1000, swspi_ns=400, glitch=False, max_hz=None):
+    # chain[0] is next to TDO, chain[-1] is next to TDI
+    self.chain = chain
+    for dev in chain:
+      dev.board = self
+      if getattr(dev, "flash", None):
+        dev.flash.board = self
+    self.pin = dict(pinout)
+    self.bitbang_ns = bitbang_ns
+    self.swspi_ns = swspi_ns
+    self.glitch = glitch
+    self.max_hz = max_hz # faster hwspi samples stale TDO
+    self.level = {}
+    self.route = {} # gpio -> "gpio", "in" or SPI object driving it
+    self.time_ns = 0
+    self.cycles = {}
+    self.trace = None # list of (source, tms, tdi) per rising TCK edge
+    for n in pinout.values():
+      self.level[n] = 1
+      self.route[n] = "in"
+
+  def ticks_ms(self):
+    return self.time_ns // 1000000
+
+  def ticks_us(self):
+    return self.time_ns // 1000
+
+  def sleep_ms(self, ms):
+    self.time_ns += int(ms)*1000000
+
+  def sleep_us(self, us):
+    self.time_ns += int(us)*1000
+
+  def tdo(self):
+    return self.chain[0].tdo
+
+  def read(self, n):
+    if n == self.pin["tdo"]:
+      return self.tdo()
+    return self.level.get(n, 1)
+
+  # output v on gpio n if driven by source
+  def drive(self, n, v, source, period_ns=None, name=None):
+    if self.route.get(n) != source:
+      return
+    old = self.level.get(n, 1)
+    self.level[n] = v
+    if n == self.pin["tck"] and v != old:
+      if v:
+        self.rising(name or (source if isinstance(source, str) else source.name),
+                    period_ns or self.bitbang_ns)
+      else:
+        self.falling()
+
+  def falling(self):
+    for dev in self.chain:
+      dev.falling()
+
+  def rising(self, source, period_ns):
+    self.time_ns += period_ns
+    self.cycles[source] = self.cycles.get(source, 0) + 1
+    tms = self.level[self.pin["tms"]]
+    tdi = self.level[self.pin["tdi"]]
+    if self.trace is not None:
+      self.trace.append((source, tms, tdi))
+    # all devices sample TDO of their neighbour before it changes
+    ins = [dev.tdo for dev in self.chain[1:]] + [tdi]
+    for dev, i in zip(self.chain, ins):
+      dev.rising(tms, i)
+
+  def tck_cycles(self):
+    return sum(self.cycles.values())
+
+  def state(self):
+    return t.NAMES[self.chain[0].state]
+
+  # ESP32 GPIO registers for register-level bitbanging
+  GPIO_OUT_W1TS  = 0x3FF44008
+  GPIO_OUT_W1TC  = 0x3FF4400C
+  GPIO_OUT1_W1TS = 0x3FF44014
+  GPIO_OUT1_W1TC = 0x3FF44018
+  GPIO_IN        = 0x3FF4403C
+  GPIO_IN1       = 0x3FF44040
+
+  def reg_write(self, addr, v):
+    if addr in (self.GPIO_OUT_W1TS, self.GPIO_OUT_W1TC, self.GPIO_OUT1_W1TS, self.GPIO_OUT1_W1TC):
+      base = 32 if addr in (self.GPIO_OUT1_W1TS, self.GPIO_OUT1_W1TC) else 0
+      level = 1 if addr in (self.GPIO_OUT_W1TS, self.GPIO_OUT1_W1TS) else 0
+      for i in range(32):
+        if (v >> i) & 1:
+          self.drive(base+i, level, "gpio", name="gpio_reg")
+      return
+    raise ValueError("write to unknown register 0x%08X" % addr)
+
+  def reg_read(self, addr):
+    if addr in (self.GPIO_IN, self.GPIO_IN1):
+      base = 32 if addr == self.GPIO_IN1 else 0
+      v = 0
+      for i in range(32):
+        if self.read(base+i):
+          v |= 1 << i
+      return v
+    raise ValueError("read from unknown register 0x%08X" % addr)
@@ -0,0 +1,196 @@
+# Lattice ECP5 JTAG configuration engine model
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+from .tap import tap, reg, DRSHIFT
+
+ISC_ENABLE          = 0xC6
+ISC_DISABLE         = 0x26
+ISC_ERASE           = 0x0E
+LSC_READ_STATUS     = 0x3C
+LSC_PRELOAD         = 0x1C
+LSC_INIT_ADDRESS    = 0x46
+LSC_BITSTREAM_BURST = 0x7A
+LSC_PROG_SPI        = 0x3A
+LSC_REFRESH         = 0x79
+USERCODE            = 0xC0
+IDCODE              = 0xE0
+
+STATUS_ISC  = 0x200
+STATUS_DONE = 0x100
+STATUS_BUSY = 0x1000
+STATUS_FAIL = 0x2000
+
+# bitstream burst: bytes arrive MSB first.
+# like the ECP5, the preamble is found at any bit offset
+# (e.g. after the hwspi TCK glitch), bytes are aligned to its end
+class burst:
+  def __init__(self, dev):
+    self.dev = dev
+  def capture(self):
+    self.byte = 0
+    self.bits = 0
+  def out(self):
+    return 0
+  def shift(self, tdi):
+    self.byte = ((self.byte << 1) | tdi) & 0xFF
+    self.bits += 1
+    if self.dev.config_bit(tdi):
+      self.bits = 0
+      return
+    if self.bits == 8:
+      self.bits = 0
+      self.dev.config_byte(self.byte)
+  def update(self):
+    pass
+
+# LSC_PROG_SPI passthrough: TDI->MOSI, MISO->TDO, TCK->SCK, CS low in shift DR
+class spipass:
+  def __init__(self, dev):
+    self.dev = dev
+  def capture(self):
+    pass
+  def out(self):
+    return self.dev.flash.miso
+  def shift(self, tdi):
+    self.dev.flash.rising(tdi)
+  def update(self):
+    pass
+
+class ecp5(tap):
+  def __init__(self, idcode=0x41113043, flash=None, bsr=1008,
+               erase_us=2000, enable_us=100, wakeup_us=500):
+    tap.__init__(self, idcode, 8, IDCODE)
+    self.flash = flash
+    self.isc = False
+    self.spi = False
+    self.done = False
+    self.usercode = 0
+    self.busy_until = 0
+    self.erase_us = erase_us
+    self.enable_us = enable_us
+    self.wakeup_us = wakeup_us
+    self.done_at = None
+    self.preload = reg(bsr, 0)
+    self.burst = burst(self)
+    self.spipass = spipass(self)
+    self.reset_config()
+
+  def now(self):
+    return self.board.time_ns if self.board else 0
+
+  def reset_config(self):
+    self.sync = False
+    self.preamble = 0
+    self.data = bytearray()
+    self.burst_bytes = 0
+
+  def status(self):
+    s = 0
+    if self.isc:
+      s |= STATUS_ISC
+    if self.done and (self.done_at is None or self.now() >= self.done_at):
+      s |= STATUS_DONE
+    if self.now() < self.busy_until:
+      s |= STATUS_BUSY
+    return s
+
+  # True at the last bit of the preamble
+  def config_bit(self, b):
+    if self.sync:
+      return False
+    self.preamble = ((self.preamble << 1) | b) & 0xFFFFFFFF
+    if self.preamble == 0xFFFFBDB3:
+      self.sync = True
+      self.burst_bytes += 1
+      return True
+    return False
+
+  def config_byte(self, b):
+    self.burst_bytes += 1
+    if self.sync:
+      self.data.append(b)
+
+  # last ISC_PROGRAM_USERCODE command in the configuration data
+  @staticmethod
+  def find_usercode(data):
+    i = data.rfind(b"\xC2\x00\x00\x00")
+    if i < 0 or i+8 > len(data):
+      return 0
+    return int.from_bytes(data[i+4:i+8], "big")
+
+  def select_dr(self, ir):
+    if ir == LSC_READ_STATUS:
+      return reg(32, self.status)
+    if ir == USERCODE:
+      return reg(32, lambda: self.usercode)
+    if ir == LSC_PRELOAD:
+      return self.preload
+    if ir == ISC_ENABLE:
+      return reg(8, 0, self.isc_enable)
+    if ir == ISC_ERASE:
+      return reg(8, 0, self.isc_erase)
+    if ir == LSC_INIT_ADDRESS:
+      return reg(8, 0)
+    if ir == LSC_BITSTREAM_BURST and self.isc:
+      return self.burst
+    if ir == LSC_PROG_SPI:
+      if self.spi:
+        return self.spipass
+      return reg(16, 0, self.spi_key)
+    if ir == LSC_REFRESH:
+      return reg(24, 0)
+    return tap.select_dr(self, ir)
+
+  def isc_enable(self, v):
+    self.isc = True
+    self.busy_until = self.now() + 1000*self.enable_us
+
+  def isc_erase(self, v):
+    self.done = False
+    self.usercode = 0
+    self.reset_config()
+    self.busy_until = self.now() + 1000*self.erase_us
+
+  def spi_key(self, v):
+    if v == 0x68FE:
+      self.spi = True
+
+  def ir_update(self, ir):
+    if ir != LSC_PROG_SPI:
+      self.spi = False
+    if ir == ISC_DISABLE and self.isc:
+      self.isc = False
+      self.start(self.data if self.sync else None)
+    elif ir == LSC_REFRESH:
+      self.refresh()
+
+  # wake up with configuration data or stay unconfigured
+  def start(self, data):
+    self.done = data is not None
+    self.usercode = self.find_usercode(data) if data else 0
+    self.done_at = self.now() + 1000*self.wakeup_us
+
+  def refresh(self):
+    self.reset_config()
+    data = None
+    if self.flash:
+      i = self.flash.mem.find(b"\xFF\xFF\xBD\xB3", 0, 0x10000)
+      if i >= 0:
+        # configuration length is unknown, take what fits in the largest ECP5
+        data = bytes(self.flash.mem[i+4:i+4+0x300000])
+    self.start(data)
+
+  def transition(self, old, new):
+    if self.flash is None or not self.spi or self.ir != LSC_PROG_SPI:
+      return
+    if new == DRSHIFT and old != DRSHIFT:
+      self.flash.select()
+    elif old == DRSHIFT and new != DRSHIFT:
+      self.flash.deselect()
+
+  def falling(self):
+    if self.state == DRSHIFT and self.dr is self.spipass:
+      self.flash.falling()
+    tap.falling(self)
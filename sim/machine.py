@@ -0,0 +1,132 @@
+# machine.Pin and machine.SPI on top of the simulated board
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+board = None # set by sim.install()
+
+class Pin:
+  IN = 1
+  OUT = 3
+  OPEN_DRAIN = 7
+  PULL_UP = 2
+  PULL_DOWN = 1
+
+  def __init__(self, id, mode=-1, pull=-1, value=None):
+    self.id = id
+    self.init(mode, pull, value)
+
+  def init(self, mode=-1, pull=-1, value=None):
+    if mode == Pin.OUT:
+      board.route[self.id] = "gpio"
+      board.drive(self.id, board.level.get(self.id, 1) if value is None else value, "gpio")
+    elif mode == Pin.IN:
+      board.route[self.id] = "in"
+
+  def value(self, v=None):
+    if v is None:
+      return board.read(self.id)
+    board.drive(self.id, 1 if v else 0, "gpio")
+
+  def on(self):
+    board.drive(self.id, 1, "gpio")
+
+  def off(self):
+    board.drive(self.id, 0, "gpio")
+
+  def __call__(self, v=None):
+    return self.value(v)
+
+class SPI:
+  MSB = 0
+  LSB = 1
+
+  def __init__(self, id, baudrate=1000000, polarity=0, phase=0, bits=8, firstbit=0,
+               sck=None, mosi=None, miso=None):
+    self.id = id
+    self.name = "swspi" if id == -1 else "hwspi"
+    self.sck = self.mosi = self.miso = None
+    self.baudrate = baudrate
+    self.init(baudrate=baudrate, polarity=polarity, phase=phase, sck=sck, mosi=mosi, miso=miso)
+
+  def init(self, baudrate=None, polarity=None, phase=None, bits=8, firstbit=0,
+           sck=None, mosi=None, miso=None):
+    if baudrate:
+      self.baudrate = baudrate
+    if self.id == -1:
+      # soft SPI drives its pins as plain GPIO
+      self.source = "gpio"
+      for p in (sck, mosi):
+        if p is not None:
+          board.route[p.id] = "gpio"
+    else:
+      self.source = self
+      old = self.sck
+      if old is not None and sck is not None and old != sck.id and board.route.get(old) is self:
+        board.route[old] = "in"
+      if sck is not None and board.glitch and sck.id == board.pin["tck"] and board.route.get(sck.id) is not self:
+        board.route[sck.id] = self
+        board.drive(sck.id, 0, self)
+        board.drive(sck.id, 1, self, self.period_ns())
+      for p in (sck, mosi):
+        if p is not None:
+          board.route[p.id] = self
+    if sck is not None:
+      self.sck = sck.id
+    if mosi is not None:
+      self.mosi = mosi.id
+    if miso is not None:
+      self.miso = miso.id
+    if self.id != -1:
+      for n in (self.sck, self.mosi):
+        if n is not None:
+          board.route[n] = self
+
+  def deinit(self):
+    if self.id != -1:
+      for n in (self.sck, self.mosi):
+        if board.route.get(n) is self:
+          board.route[n] = "in"
+
+  def period_ns(self):
+    if self.id == -1:
+      return board.swspi_ns
+    return max(1, 1000000000 // self.baudrate)
+
+  # mode 3: data out on falling, sampled on rising edge
+  def xfer(self, tx, rx):
+    src = self.source
+    period = self.period_ns()
+    sck = self.sck
+    mosi = self.mosi
+    miso = self.miso
+    # too fast for the wiring: TDO sampled one bit late
+    stale = board.max_hz and self.id != -1 and self.baudrate > board.max_hz
+    prev = 1
+    for i in range(len(tx)):
+      b = tx[i]
+      r = 0
+      for nf in range(8):
+        board.drive(sck, 0, src)
+        board.drive(mosi, (b >> (7-nf)) & 1, src)
+        board.drive(sck, 1, src, period, self.name)
+        bit = board.read(miso)
+        if stale:
+          bit, prev = prev, bit
+        r = (r << 1) | bit
+      if rx is not None:
+        rx[i] = r
+
+  def write(self, buf):
+    self.xfer(buf, None)
+
+  def readinto(self, buf, write=0):
+    self.xfer(bytes([write])*len(buf), buf)
+
+  def read(self, n, write=0):
+    buf = bytearray(n)
+    self.readinto(buf, write)
+    return bytes(buf)
+
+  def write_readinto(self, wbuf, rbuf):
+    self.xfer(bytes(wbuf), rbuf)
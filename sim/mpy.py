@@ -0,0 +1,138 @@
+# CPython stand-ins for micropython, uctypes
+# and the viper pointer builtins
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import builtins, functools, inspect, sys, types
+
+board = None # set by sim.install()
+
+# addressof() hands out fake addresses: slot << 32 | offset.
+# slot 0 is the peripheral register space (GPIO etc.)
+mem = {} # slot -> memoryview, least recently used first
+slots = {} # id(obj) -> (obj, slot), same object keeps its address
+mem_slot = 0
+
+def addressof(obj):
+  global mem_slot
+  hit = slots.get(id(obj))
+  if hit and hit[0] is obj:
+    slot = hit[1]
+    mem[slot] = mem.pop(slot)
+    return slot << 32
+  mv = memoryview(obj)
+  if mv.format != "B" or mv.ndim != 1:
+    mv = mv.cast("B")
+  mem_slot += 1
+  mem[mem_slot] = mv
+  slots[id(obj)] = (obj, mem_slot)
+  if len(mem) > 4096:
+    old = next(iter(mem))
+    o = mem.pop(old).obj
+    if slots.get(id(o), (None, 0))[1] == old:
+      del slots[id(o)]
+  return mem_slot << 32
+
+def sizeof(obj):
+  return memoryview(obj).nbytes
+
+class ptr:
+  width = 1
+  def __init__(self, addr):
+    if not isinstance(addr, int):
+      addr = int(addr) if isinstance(addr, ptr) else addressof(addr)
+    self.addr = addr
+  def __int__(self):
+    return self.addr
+  __index__ = __int__
+  def __bool__(self):
+    return self.addr != 0
+  # viper hands pointers to python code as int addresses
+  def __add__(self, n):
+    return self.addr + n
+  __radd__ = __add__
+  def __eq__(self, o):
+    return self.addr == int(o)
+  def __hash__(self):
+    return self.addr
+  def __getitem__(self, i):
+    a = self.addr + i*self.width
+    if a >> 32 == 0:
+      return board.reg_read(a)
+    mv = mem[a >> 32]
+    o = a & 0xFFFFFFFF
+    if self.width == 1:
+      return mv[o]
+    return int.from_bytes(mv[o:o+self.width], "little")
+  def __setitem__(self, i, v):
+    a = self.addr + i*self.width
+    v &= (1 << 8*self.width)-1
+    if a >> 32 == 0:
+      board.reg_write(a, v)
+      return
+    mv = mem[a >> 32]
+    o = a & 0xFFFFFFFF
+    if self.width == 1:
+      mv[o] = v
+    else:
+      mv[o:o+self.width] = v.to_bytes(self.width, "little")
+
+class ptr8(ptr):
+  width = 1
+
+class ptr16(ptr):
+  width = 2
+
+class ptr32(ptr):
+  width = 4
+
+def uint(v):
+  return int(v) & 0xFFFFFFFF
+
+# viper converts arguments annotated as pointers
+# from int addresses or buffer objects
+def viper(f):
+  conv = {}
+  for name, ann in f.__annotations__.items():
+    if isinstance(ann, type) and issubclass(ann, ptr):
+      conv[name] = ann
+  if not conv:
+    return f
+  params = list(inspect.signature(f).parameters)
+  @functools.wraps(f)
+  def wrapper(*args):
+    args = list(args)
+    for i, name in enumerate(params[:len(args)]):
+      t = conv.get(name)
+      if t and not isinstance(args[i], t):
+        args[i] = t(args[i])
+    return f(*args)
+  return wrapper
+
+def native(f):
+  return f
+
+def const(v):
+  return v
+
+def install(b):
+  global board
+  board = b
+  micropython = types.ModuleType("micropython")
+  micropython.viper = viper
+  micropython.native = native
+  micropython.const = const
+  micropython.alloc_emergency_exception_buf = lambda n: None
+  micropython.mem_info = lambda *a: None
+  uctypes = types.ModuleType("uctypes")
+  uctypes.addressof = addressof
+  uctypes.sizeof = sizeof
+  sys.modules["micropython"] = micropython
+  sys.modules["uctypes"] = uctypes
+  builtins.micropython = micropython
+  builtins.const = const
+  builtins.ptr8 = ptr8
+  builtins.ptr16 = ptr16
+  builtins.ptr32 = ptr32
+  builtins.uint = uint
@@ -0,0 +1,194 @@
+# SPI NOR flash model, mode 3, MSB first
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+from struct import pack
+
+# sizes in bytes, times in us
+class spiflash:
+  def __init__(self, size=0x1000000, jedec=b"\xEF\x40\x18", page=256,
+               erase=((4096,0x20),(32768,0x52),(65536,0xD8)),
+               t_page=700, t_erase=(45000,120000,150000), four_byte_cmds=True):
+    self.size = size
+    self.mem = bytearray(b"\xFF"*size)
+    self.jedec = jedec
+    self.page = page
+    self.erase = erase
+    self.t_page = t_page
+    self.t_erase = t_erase
+    self.four_byte_cmds = four_byte_cmds
+    self.addr4 = False
+    self.wel = False
+    self.busy_until = 0
+    self.board = None
+    self.selected = False
+    self.sfdp = self.make_sfdp()
+    # statistics
+    self.reads = 0
+    self.programs = 0
+    self.erases = 0
+    self.busy_polls = 0
+
+  def now(self):
+    return self.board.time_ns if self.board else 0
+
+  def busy(self):
+    return self.now() < self.busy_until
+
+  def status(self):
+    return (1 if self.busy() else 0) | (2 if self.wel else 0)
+
+  # JESD216 header + basic flash parameter table (16 DWORDs)
+  def make_sfdp(self):
+    bfpt = [0]*16
+    e4k = [op for sz, op in self.erase if sz == 4096]
+    bfpt[0] = 0xFFF00000 | ((e4k[0] if e4k else 0xFF) << 8) | (1 if e4k else 3) \
+            | (1 << 2) | ((1 if self.size > 0x1000000 else 0) << 17)
+    bfpt[1] = self.size*8-1
+    etypes = list(self.erase)[:4] + [(0, 0)]*(4-len(self.erase[:4]))
+    for i, (sz, op) in enumerate(etypes):
+      n = sz.bit_length()-1 if sz else 0
+      field = (op << 8) | n
+      if i < 2:
+        bfpt[7] |= field << (16*i)
+      else:
+        bfpt[8] |= field << (16*(i-2))
+    # typical erase times, max is 2*(3+1) times that
+    bfpt[9] = 3
+    for i, t in enumerate(self.t_erase[:min(4, len(self.erase))]):
+      ms = max(1, t//1000)
+      u = 0
+      while u < 3 and (ms+(1, 16, 128, 1000)[u]-1)//(1, 16, 128, 1000)[u] > 32:
+        u += 1
+      n = min(32, (ms+(1, 16, 128, 1000)[u]-1)//(1, 16, 128, 1000)[u])
+      bfpt[9] |= ((u << 5) | (n-1)) << (4+7*i)
+    bfpt[10] = (self.page.bit_length()-1) << 4
+    table = b"".join(pack("<I", d) for d in bfpt)
+    hdr = b"SFDP" + bytes([6, 1, 0, 0xFF])
+    phdr = bytes([0, 6, 1, 16]) + pack("<I", 0x30)[:3] + b"\xFF"
+    sfdp = bytearray(b"\xFF"*0x30)
+    sfdp[0:8] = hdr
+    sfdp[8:16] = phdr
+    return bytes(sfdp) + table
+
+  def select(self):
+    self.selected = True
+    self.bits = 0
+    self.byte = 0
+    self.cmd = bytearray()
+    self.out = None
+    self.miso = 1
+
+  def deselect(self):
+    if not self.selected:
+      return
+    self.selected = False
+    self.execute()
+
+  def addr_bytes(self, op):
+    if op in (0x13, 0x12, 0x21, 0xDC, 0x0C):
+      return 4
+    return 4 if self.addr4 else 3
+
+  def get_addr(self, n):
+    a = 0
+    for b in self.cmd[1:1+n]:
+      a = (a << 8) | b
+    return a
+
+  # output stream after a full byte of command
+  def respond(self):
+    op = self.cmd[0]
+    n = len(self.cmd)
+    if op == 0x05 and n == 1:
+      self.busy_polls += 1
+      self.out = ("status",)
+    elif op == 0x9F and n == 1:
+      self.out = ("data", self.jedec, 0)
+    elif op in (0x03, 0x13):
+      na = self.addr_bytes(op)
+      if n == 1+na and not self.busy():
+        self.out = ("mem", self.get_addr(na) % self.size)
+    elif op in (0x0B, 0x0C):
+      na = self.addr_bytes(op)
+      if n == 2+na and not self.busy():
+        self.out = ("mem", self.get_addr(na) % self.size)
+    elif op == 0x5A and n == 5:
+      self.out = ("data", self.sfdp, self.get_addr(3))
+
+  def next_out_byte(self):
+    o = self.out
+    if o[0] == "status":
+      return self.status()
+    if o[0] == "mem":
+      a = o[1]
+      self.out = ("mem", (a+1) % self.size)
+      self.reads += 1
+      return self.mem[a]
+    data, a = o[1], o[2]
+    self.out = ("data", data, a+1)
+    return data[a] if a < len(data) else 0xFF
+
+  def falling(self):
+    if not self.selected or self.out is None:
+      self.miso = 1
+      return
+    if self.bits == 0:
+      self.obyte = self.next_out_byte()
+    self.miso = (self.obyte >> (7-self.bits)) & 1
+
+  def rising(self, mosi):
+    if not self.selected:
+      return
+    self.byte = ((self.byte << 1) | mosi) & 0xFF
+    self.bits += 1
+    if self.bits == 8:
+      self.bits = 0
+      if self.out is None:
+        self.cmd.append(self.byte)
+        self.respond()
+
+  def execute(self):
+    if not self.cmd:
+      return
+    op = self.cmd[0]
+    if self.busy() and op != 0x05:
+      return
+    if op == 0x06:
+      self.wel = True
+    elif op == 0x04:
+      self.wel = False
+    elif op == 0xB7:
+      self.addr4 = True
+    elif op == 0xE9:
+      self.addr4 = False
+    elif op in (0x02, 0x12) and self.wel:
+      na = self.addr_bytes(op)
+      if len(self.cmd) > 1+na:
+        a = self.get_addr(na) % self.size
+        base = a & ~(self.page-1)
+        for i, b in enumerate(self.cmd[1+na:]):
+          o = base + ((a-base+i) % self.page)
+          self.mem[o] &= b
+        self.programs += 1
+        self.busy_until = self.now() + self.t_page*1000
+      self.wel = False
+    elif op in (0xC7, 0x60) and self.wel:
+      self.mem[:] = b"\xFF"*self.size
+      self.erases += 1
+      self.busy_until = self.now() + 1000*self.t_erase[-1]*64
+      self.wel = False
+    else:
+      for i, (sz, eop) in enumerate(self.erase):
+        four = {0x20:0x21, 0xD8:0xDC}.get(eop)
+        if op == eop or (self.four_byte_cmds and op == four):
+          if self.wel:
+            na = 4 if op == four else self.addr_bytes(op)
+            if len(self.cmd) >= 1+na:
+              a = (self.get_addr(na) % self.size) & ~(sz-1)
+              self.mem[a:a+sz] = b"\xFF"*sz
+              self.erases += 1
+              self.busy_until = self.now() + 1000*self.t_erase[min(i, len(self.t_erase)-1)]
+            self.wel = False
+          break
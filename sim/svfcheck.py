@@ -0,0 +1,99 @@
+# regression check of rbp/parts/svf.py on the simulated board
+#
+# python3 -m sim.svfcheck
+#
+# plays generated SVF files: IDCODE check, IDCODE with TDO
+# mismatch, bitstream thru hwspi (also with the TCK glitch)
+# and bitbanged.
+# exit status 1 if any check fails
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import os, sys, tempfile
+
+import sim
+
+IDCODE = 0x41113043
+USERCODE = 0x12345678
+
+# configuration data the sim ECP5 accepts: junk, preamble,
+# frames, ISC_PROGRAM_USERCODE near the end
+def bitstream(frames=8192):
+  return (b"\xFF"*16 + b"\xFF\xFF\xBD\xB3" + bytes(range(256))*(frames//256)
+    + b"\xC2\x00\x00\x00" + USERCODE.to_bytes(4, "big") + b"\xFF"*16)
+
+# bytes in shift order, each MSB first, as SVF hex (LSB first)
+def svf_hex(data):
+  rb = [int("{:08b}".format(i)[::-1], 2) for i in range(256)]
+  h = bytes(reversed([rb[x] for x in data])).hex().upper()
+  return "\n".join(h[i:i+120] for i in range(0, len(h), 120))
+
+def svf_idcode(idcode):
+  return """STATE RESET;
+ENDIR IDLE;
+ENDDR IDLE;
+SIR 8 TDI (E0);
+SDR 32 TDI (00000000) TDO (%08X) MASK (FFFFFFFF);
+""" % idcode
+
+def svf_prog(bit):
+  return svf_idcode(IDCODE) + """SIR 8 TDI (1C);
+SDR 510 TDI (3F%s);
+SIR 8 TDI (C6);
+SDR 8 TDI (00);
+RUNTEST IDLE 2 TCK 1.00E-02 SEC;
+SIR 8 TDI (0E);
+SDR 8 TDI (01);
+RUNTEST 2 TCK 1.00E-02 SEC;
+SIR 8 TDI (46);
+SDR 8 TDI (01);
+RUNTEST 2 TCK 1.00E-02 SEC;
+SIR 8 TDI (7A);
+RUNTEST 2 TCK 1.00E-02 SEC;
+SDR %d TDI (%s);
+RUNTEST 100 TCK 1.00E-02 SEC;
+SIR 8 TDI (26);
+RUNTEST IDLE 2 TCK 2.00E-01 SEC ENDSTATE IDLE;
+SIR 8 TDI (3C);
+SDR 32 TDI (00000000) TDO (00000100) MASK (00002100);
+SIR 8 TDI (C0);
+SDR 32 TDI (00000000) TDO (%08X);
+""" % ("F"*126, 8*len(bit), svf_hex(bit), USERCODE)
+
+def main():
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rbp", "parts"))
+  b = sim.install(sim.board([sim.ecp5(idcode=IDCODE)], pinout=sim.PINOUT_RBP))
+  import svf
+  dev = b.chain[0]
+  fail = 0
+
+  def play(text):
+    with tempfile.NamedTemporaryFile("w", suffix=".svf", delete=False) as f:
+      f.write(text)
+    try:
+      return svf.play(f.name)
+    finally:
+      os.remove(f.name)
+
+  def check(name, ok):
+    nonlocal fail
+    released = all(r == "in" for r in b.route.values())
+    print("%-32s %s" % (name, "ok" if ok and released else "FAIL"))
+    if not (ok and released):
+      fail += 1
+
+  check("idcode", play(svf_idcode(IDCODE)) is True)
+  check("idcode TDO mismatch", play(svf_idcode(IDCODE ^ 1)) is False)
+  bit = bitstream()
+  for hwspi_min, glitch in ((svf.hwspi_min, False), (svf.hwspi_min, True), (0, False)):
+    svf.hwspi_min = hwspi_min
+    b.glitch = glitch
+    dev.done = False
+    dev.usercode = 0
+    ok = play(svf_prog(bit))
+    check("bitstream hwspi_min=%d%s" % (hwspi_min, " glitch" if glitch else ""),
+          ok is True and dev.done and dev.usercode == USERCODE)
+  sys.exit(1 if fail else 0)
+
+main()
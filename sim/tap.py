@@ -0,0 +1,125 @@
+# IEEE 1149.1 TAP controller model
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+RESET     = 0
+IDLE      = 1
+DRSELECT  = 2
+DRCAPTURE = 3
+DRSHIFT   = 4
+DREXIT1   = 5
+DRPAUSE   = 6
+DREXIT2   = 7
+DRUPDATE  = 8
+IRSELECT  = 9
+IRCAPTURE = 10
+IRSHIFT   = 11
+IREXIT1   = 12
+IRPAUSE   = 13
+IREXIT2   = 14
+IRUPDATE  = 15
+
+# next state for (TMS=0, TMS=1)
+NEXT = (
+  (IDLE,      RESET),    # RESET
+  (IDLE,      DRSELECT), # IDLE
+  (DRCAPTURE, IRSELECT), # DRSELECT
+  (DRSHIFT,   DREXIT1),  # DRCAPTURE
+  (DRSHIFT,   DREXIT1),  # DRSHIFT
+  (DRPAUSE,   DRUPDATE), # DREXIT1
+  (DRPAUSE,   DREXIT2),  # DRPAUSE
+  (DRSHIFT,   DRUPDATE), # DREXIT2
+  (IDLE,      DRSELECT), # DRUPDATE
+  (IRCAPTURE, RESET),    # IRSELECT
+  (IRSHIFT,   IREXIT1),  # IRCAPTURE
+  (IRSHIFT,   IREXIT1),  # IRSHIFT
+  (IRPAUSE,   IRUPDATE), # IREXIT1
+  (IRPAUSE,   IREXIT2),  # IRPAUSE
+  (IRSHIFT,   IRUPDATE), # IREXIT2
+  (IDLE,      DRSELECT), # IRUPDATE
+)
+
+NAMES = ("RESET", "IDLE",
+  "DRSELECT", "DRCAPTURE", "DRSHIFT", "DREXIT1", "DRPAUSE", "DREXIT2", "DRUPDATE",
+  "IRSELECT", "IRCAPTURE", "IRSHIFT", "IREXIT1", "IRPAUSE", "IREXIT2", "IRUPDATE")
+
+# fixed length shift register, LSB is next to TDO
+class reg:
+  def __init__(self, length, capture=0, update=None):
+    self.length = length
+    self.value = capture
+    self.on_update = update
+    self.sr = 0
+  def capture(self):
+    self.sr = self.value() if callable(self.value) else self.value
+  def out(self):
+    return self.sr & 1
+  def shift(self, tdi):
+    self.sr = (self.sr >> 1) | (tdi << (self.length-1))
+  def update(self):
+    if self.on_update:
+      self.on_update(self.sr)
+
+# one device in the scan chain
+class tap:
+  def __init__(self, idcode, irlen, ir_idcode, ir_bypass=None):
+    self.idcode = idcode
+    self.irlen = irlen
+    self.ir_idcode = ir_idcode
+    self.ir_bypass = (1 << irlen)-1 if ir_bypass is None else ir_bypass
+    self.state = RESET
+    self.ir = ir_idcode
+    self.ir_sr = 0
+    self.tdo = 1
+    self.dr = None
+    self.bypass = reg(1, 0)
+    self.idcode_reg = reg(32, idcode)
+    self.board = None
+
+  # register selected by current instruction, override for more
+  def select_dr(self, ir):
+    if ir == self.ir_idcode:
+      return self.idcode_reg
+    return self.bypass
+
+  def ir_capture(self):
+    return 1
+
+  def ir_update(self, ir):
+    pass
+
+  def idle(self):
+    pass
+
+  def rising(self, tms, tdi):
+    s = self.state
+    if s == RESET:
+      self.ir = self.ir_idcode
+    elif s == IDLE:
+      self.idle()
+    elif s == DRCAPTURE:
+      self.dr = self.select_dr(self.ir)
+      self.dr.capture()
+    elif s == DRSHIFT:
+      self.dr.shift(tdi)
+    elif s == DRUPDATE:
+      self.dr.update()
+    elif s == IRCAPTURE:
+      self.ir_sr = self.ir_capture()
+    elif s == IRSHIFT:
+      self.ir_sr = (self.ir_sr >> 1) | (tdi << (self.irlen-1))
+    elif s == IRUPDATE:
+      self.ir = self.ir_sr
+      self.ir_update(self.ir)
+    self.state = NEXT[s][tms]
+    self.transition(s, self.state)
+
+  def transition(self, old, new):
+    pass
+
+  def falling(self):
+    if self.state == DRSHIFT:
+      self.tdo = self.dr.out()
+    elif self.state == IRSHIFT:
+      self.tdo = self.ir_sr & 1
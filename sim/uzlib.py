@@ -0,0 +1,42 @@
+# uzlib.DecompIO on top of zlib
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import zlib
+
+class DecompIO:
+  def __init__(self, stream, wbits=0):
+    self.stream = stream
+    self.d = zlib.decompressobj(wbits)
+    self.buf = b""
+
+  def read(self, n=-1):
+    # byte at a time like micropython, so the stream
+    # is left right after the deflate data (gzip trailer)
+    while (n < 0 or len(self.buf) < n) and not self.d.eof:
+      chunk = self.stream.read(1)
+      if not chunk:
+        break
+      self.buf += self.d.decompress(chunk)
+    if n < 0:
+      n = len(self.buf)
+    r, self.buf = self.buf[:n], self.buf[n:]
+    return r
+
+  def readinto(self, buf):
+    r = self.read(len(buf))
+    buf[:len(r)] = r
+    return len(r)
+
+  def readline(self):
+    r = b""
+    while not r.endswith(b"\n"):
+      c = self.read(1)
+      if not c:
+        break
+      r += c
+    return r
+
+def decompress(data, wbits=15):
+  return zlib.decompress(data, wbits)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# pack bitstream to ".bitc" container for bitc.py:
+# header with target IDCODE, length, USERCODE and CRC32,
+# chunk index with offsets and CRC32 of each chunk,
+# independently compressed chunks. Zero runs are
+# cut out of the chunk into a table, device sends them
+# from a static zero buffer without decompressing.
+
+# usage: bitcpack.py blink.bit [blink.bitc] [--method lz4|deflate|stored]
+#                    [--chunk 16384] [--wbits 12] [--idcode 0x41113043]
+#                    [--zero-run 64]
+# list:  bitcpack.py -l blink.bitc
+# unpack: bitcpack.py -d blink.bitc blink.bit
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import argparse, gzip, os, re, struct, sys, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import lz4pack
+
+MAGIC = b"BITC"
+METHODS = {"stored": 0, "deflate": 1, "lz4": 2}
+NAMES = {v: k for k, v in METHODS.items()}
+ZERO_RUNS = 0x10
+
+# value after the last ECP5 bitstream command cmd 00 00 00,
+# VERIFY_ID 0xE2 is near the start, ISC_PROGRAM_USERCODE 0xC2 near the end
+def command_value(data, cmd, last=True):
+  pat = bytes([cmd, 0, 0, 0])
+  i = data.rfind(pat) if last else data.find(pat, 0, 4096)
+  if i < 0 or i+8 > len(data):
+    return 0
+  return struct.unpack_from(">I", data, i+4)[0]
+
+def compress(method, raw, wbits):
+  if method == 1:
+    c = zlib.compressobj(9, zlib.DEFLATED, -wbits, 9)
+    return c.compress(raw) + c.flush()
+  if method == 2:
+    return lz4pack.compress_block(raw)
+  return raw
+
+# zero runs of at least minrun bytes:
+# table count, (literal bytes, zero bytes) pairs and literals
+def zero_runs(raw, minrun):
+  table = b""
+  lit = b""
+  i = 0
+  for r in re.finditer(b"\x00{%d,}" % minrun, raw) if minrun else ():
+    table += struct.pack("<II", r.start()-i, r.end()-r.start())
+    lit += raw[i:r.start()]
+    i = r.end()
+  return struct.pack("<I", len(table)//8) + table, lit + raw[i:]
+
+def pack(data, method=2, chunk=16384, wbits=12, idcode=None, minrun=64):
+  if idcode is None:
+    idcode = command_value(data, 0xE2, last=False)
+  usercode = command_value(data, 0xC2)
+  chunks = []
+  for i in range(0, len(data), chunk):
+    raw = data[i:i+chunk]
+    table, lit = zero_runs(raw, minrun)
+    c = compress(method, lit, wbits)
+    m = method
+    if len(c) >= len(lit):
+      c, m = lit, 0
+    if len(table) > 4:
+      chunks.append((table+c, zlib.crc32(lit, zlib.crc32(table)), m | ZERO_RUNS))
+    else:
+      chunks.append((c, zlib.crc32(raw), m))
+  head = MAGIC + struct.pack("<BBBB6I", 1, wbits, 0, 0, idcode, len(data), chunk, len(chunks),
+                             usercode, zlib.crc32(data))
+  offset = len(head) + 16*len(chunks) + 4
+  index = b""
+  for c, crc, m in chunks:
+    index += struct.pack("<IIIB3x", offset, len(c), crc, m)
+    offset += len(c)
+  return head + index + struct.pack("<I", zlib.crc32(head+index)) + b"".join(c for c, crc, m in chunks)
+
+def header(buf):
+  assert buf[:4] == MAGIC and buf[4] == 1, "not BITC version 1"
+  wbits = buf[5]
+  idcode, length, chunk, n, usercode, crc = struct.unpack_from("<6I", buf, 8)
+  index = [struct.unpack_from("<IIIB", buf, 32+16*i) for i in range(n)]
+  assert zlib.crc32(buf[:32+16*n]) == struct.unpack_from("<I", buf, 32+16*n)[0], "index CRC"
+  return wbits, idcode, length, chunk, usercode, crc, index
+
+def unpack(buf):
+  wbits, idcode, length, chunk, usercode, crc, index = header(buf)
+  out = b""
+  for k, (offset, n, ccrc, m) in enumerate(index):
+    c = buf[offset:offset+n]
+    table = b""
+    if m & ZERO_RUNS:
+      table = c[:4+8*struct.unpack_from("<I", c)[0]]
+      c = c[len(table):]
+    if m & 3 == 1:
+      lit = zlib.decompressobj(-wbits).decompress(c)
+    elif m & 3 == 2:
+      lit = lz4pack.unpack_block(c)
+    else:
+      lit = c
+    assert zlib.crc32(lit, zlib.crc32(table)) == ccrc, "chunk %d CRC" % k
+    i = 0
+    for j in range(4, len(table), 8):
+      l, z = struct.unpack_from("<II", table, j)
+      out += lit[i:i+l] + bytes(z)
+      i += l
+    out += lit[i:]
+  assert len(out) == length and zlib.crc32(out) == crc, "bitstream CRC"
+  return out
+
+def main():
+  p = argparse.ArgumentParser(description="bitstream container for bitc.py")
+  p.add_argument("input", help=".bit, .bit.gz or .bitc with -l/-d")
+  p.add_argument("output", nargs="?")
+  p.add_argument("-d", action="store_true", help="unpack")
+  p.add_argument("-l", action="store_true", help="list header and chunks")
+  p.add_argument("--method", choices=sorted(METHODS), default="lz4")
+  p.add_argument("--chunk", type=int, default=16384, help="bytes per chunk, multiple of 4096 to resume flashing")
+  p.add_argument("--wbits", type=int, default=12, help="deflate window 2^wbits, 9-15")
+  p.add_argument("--zero-run", type=int, default=64, help="zero runs this long or longer are not compressed, 0 off")
+  p.add_argument("--idcode", type=lambda x: int(x, 0), help="target IDCODE, default from bitstream VERIFY_ID, 0 any")
+  a = p.parse_args()
+  data = open(a.input, "rb").read()
+  if a.l:
+    wbits, idcode, length, chunk, usercode, crc, index = header(data)
+    print("idcode 0x%08X length %d chunk %d usercode 0x%08X crc32 0x%08X" % (idcode, length, chunk, usercode, crc))
+    for k, (offset, n, ccrc, m) in enumerate(index):
+      print("%4d offset %8d size %6d crc32 0x%08X %s" % (k, offset, n, ccrc, NAMES.get(m & 3, m) + (" zero runs %d" % struct.unpack_from("<I", data, offset)[0] if m & ZERO_RUNS else "")))
+    return
+  if a.d:
+    out = unpack(data)
+    name = a.output or (a.input[:-5]+".bit" if a.input.endswith(".bitc") else a.input+".bit")
+  else:
+    if data[:2] == b"\x1F\x8B":
+      data = gzip.decompress(data)
+    if not 9 <= a.wbits <= 15 or a.chunk <= 0:
+      sys.exit("bad --wbits or --chunk")
+    out = pack(data, METHODS[a.method], a.chunk, a.wbits, a.idcode, a.zero_run)
+    if unpack(out) != data:
+      sys.exit("internal error: packed data doesn't unpack")
+    name = a.output
+    if not name:
+      name = a.input
+      for ext in (".gz", ".bit"):
+        if name.endswith(ext):
+          name = name[:-len(ext)]
+      name += ".bitc"
+  open(name, "wb").write(out)
+  print("%s: %d -> %d bytes" % (name, len(data), len(out)))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+# recompress bitstream to gzip with a small deflate window
+# for RAM-limited ESP32 (WROOM). Window size goes into
+# gzip FEXTRA subfield "WB" (1 byte, log2 of window size)
+# which ecp5.py reads to allocate only that window.
+# Output is a normal gzip file, gunzip ignores the subfield.
+
+# usage: gzwin.py blink.bit [blink.bit.gz] [--wbits 12]
+#        gzwin.py old.bit.gz new.bit.gz --wbits 10
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import argparse, gzip, struct, sys, zlib
+
+def pack(data, wbits=12, level=9):
+  c = zlib.compressobj(level, zlib.DEFLATED, -wbits, 9)
+  deflate = c.compress(data) + c.flush()
+  extra = b"WB" + struct.pack("<HB", 1, wbits)
+  head = bytes([0x1F, 0x8B, 8, 4]) + struct.pack("<I", 0) + bytes([2, 255])
+  return head + struct.pack("<H", len(extra)) + extra + deflate \
+    + struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+def main():
+  p = argparse.ArgumentParser(description="gzip with small window for ecp5.py")
+  p.add_argument("input", help=".bit or .gz to recompress")
+  p.add_argument("output", nargs="?")
+  p.add_argument("--wbits", type=int, default=12, help="window 2^wbits bytes, 9-15 (default 12: 4K)")
+  a = p.parse_args()
+  if not 9 <= a.wbits <= 15:
+    sys.exit("wbits must be 9-15")
+  data = open(a.input, "rb").read()
+  if data[:2] == b"\x1F\x8B":
+    data = gzip.decompress(data)
+  out = pack(data, a.wbits)
+  if gzip.decompress(out) != data or zlib.decompressobj(-a.wbits).decompress(out[17:]) != data:
+    sys.exit("internal error: packed data doesn't unpack")
+  name = a.output or (a.input if a.input.endswith(".gz") else a.input+".gz")
+  open(name, "wb").write(out)
+  print("%s: %d -> %d bytes, %d byte window" % (name, len(data), len(out), 1 << a.wbits))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# pack bitstream to LZ4 frame for unlz4.py:
+# independent blocks, content size in header,
+# no checksums. Pure python, no lz4 module needed.
+
+# usage: lz4pack.py blink.bit [blink.bit.lz4] [--block 16384]
+# unpack: lz4pack.py -d blink.bit.lz4 blink.bit
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+import argparse, struct, sys
+
+MAGIC = 0x184D2204
+MINMATCH = 4
+LASTLITERALS = 5 # last 5 bytes of a block are literals
+MFLIMIT = 12 # last match starts at least 12 bytes before end
+MAXOFFSET = 0xFFFF
+
+def xxh32(data, seed=0):
+  P1, P2, P3, P4, P5 = 2654435761, 2246822519, 3266489917, 668265263, 374761393
+  M = 0xFFFFFFFF
+  rotl = lambda x, r: ((x << r) | (x >> (32-r))) & M
+  n = len(data)
+  i = 0
+  if n >= 16:
+    v = [(seed+P1+P2) & M, (seed+P2) & M, seed & M, (seed-P1) & M]
+    while i+16 <= n:
+      for k in range(4):
+        x = struct.unpack_from("<I", data, i)[0]
+        v[k] = (rotl((v[k] + x*P2) & M, 13) * P1) & M
+        i += 4
+    h = (rotl(v[0], 1) + rotl(v[1], 7) + rotl(v[2], 12) + rotl(v[3], 18)) & M
+  else:
+    h = (seed + P5) & M
+  h = (h + n) & M
+  while i+4 <= n:
+    h = (rotl((h + struct.unpack_from("<I", data, i)[0]*P3) & M, 17) * P4) & M
+    i += 4
+  while i < n:
+    h = (rotl((h + data[i]*P5) & M, 11) * P1) & M
+    i += 1
+  h ^= h >> 15
+  h = (h*P2) & M
+  h ^= h >> 13
+  h = (h*P3) & M
+  h ^= h >> 16
+  return h
+
+def length_bytes(out, l):
+  while l >= 255:
+    out.append(255)
+    l -= 255
+  out.append(l)
+
+def sequence(out, lit, ml, off):
+  token = (min(len(lit), 15) << 4) | (min(ml-MINMATCH, 15) if ml else 0)
+  out.append(token)
+  if len(lit) >= 15:
+    length_bytes(out, len(lit)-15)
+  out += lit
+  if ml:
+    out += struct.pack("<H", off)
+    if ml-MINMATCH >= 15:
+      length_bytes(out, ml-MINMATCH-15)
+
+# greedy LZ4 block compression with a hash of 4-byte sequences
+def compress_block(src):
+  n = len(src)
+  out = bytearray()
+  table = {}
+  anchor = 0
+  i = 0
+  limit = n - MFLIMIT
+  while i < limit:
+    key = src[i:i+4]
+    ref = table.get(key)
+    table[key] = i
+    if ref is None or i-ref > MAXOFFSET:
+      i += 1
+      continue
+    ml = MINMATCH
+    while i+ml < n-LASTLITERALS and src[ref+ml] == src[i+ml]:
+      ml += 1
+    sequence(out, src[anchor:i], ml, i-ref)
+    for j in range(i+1, min(i+ml, limit)):
+      table[src[j:j+4]] = j
+    i += ml
+    anchor = i
+  sequence(out, src[anchor:], 0, 0)
+  return bytes(out)
+
+def pack(data, block=16384):
+  flg = 0x40 | 0x20 | 0x08 # version 01, independent blocks, content size
+  bd = 0x40 # max block 64K
+  desc = struct.pack("<BBQ", flg, bd, len(data))
+  out = bytearray(struct.pack("<I", MAGIC) + desc)
+  out.append((xxh32(desc) >> 8) & 0xFF)
+  for i in range(0, len(data), block):
+    raw = data[i:i+block]
+    c = compress_block(raw)
+    if len(c) < len(raw):
+      out += struct.pack("<I", len(c)) + c
+    else:
+      out += struct.pack("<I", 0x80000000 | len(raw)) + raw
+  out += struct.pack("<I", 0)
+  return bytes(out)
+
+# reference decoder to check the packer on the host
+def unpack(data):
+  magic, flg, bd = struct.unpack_from("<IBB", data)
+  assert magic == MAGIC and flg & 0x20
+  i = 6 + (8 if flg & 8 else 0) + (4 if flg & 1 else 0) + 1
+  out = bytearray()
+  while True:
+    n = struct.unpack_from("<I", data, i)[0]
+    i += 4
+    if n == 0:
+      return bytes(out)
+    raw, n = n >> 31, n & 0x7FFFFFFF
+    blk = data[i:i+n]
+    i += n + (4 if flg & 0x10 else 0)
+    out += blk if raw else unpack_block(blk)
+
+def unpack_block(blk):
+  n = len(blk)
+  dst = bytearray()
+  j = 0
+  while j < n:
+    token = blk[j]
+    j += 1
+    l = token >> 4
+    if l == 15:
+      while True:
+        l += blk[j]
+        j += 1
+        if blk[j-1] != 255:
+          break
+    dst += blk[j:j+l]
+    j += l
+    if j >= n:
+      break
+    off = blk[j] | (blk[j+1] << 8)
+    j += 2
+    l = token & 15
+    if l == 15:
+      while True:
+        l += blk[j]
+        j += 1
+        if blk[j-1] != 255:
+          break
+    for k in range(l+MINMATCH):
+      dst.append(dst[-off])
+  return bytes(dst)
+
+def main():
+  p = argparse.ArgumentParser(description="LZ4 frame packer for unlz4.py")
+  p.add_argument("input")
+  p.add_argument("output", nargs="?")
+  p.add_argument("-d", action="store_true", help="unpack")
+  p.add_argument("--block", type=int, default=16384, help="block size, device needs 2x in RAM (max 65536)")
+  a = p.parse_args()
+  data = open(a.input, "rb").read()
+  if a.d:
+    out = unpack(data)
+    name = a.output or (a.input[:-4] if a.input.endswith(".lz4") else a.input+".out")
+  else:
+    if not 0 < a.block <= 0x10000:
+      sys.exit("block must be 1..65536")
+    out = pack(data, a.block)
+    if unpack(out) != data:
+      sys.exit("internal error: packed data doesn't unpack")
+    name = a.output or a.input+".lz4"
+  open(name, "wb").write(out)
+  print("%s: %d -> %d bytes" % (name, len(data), len(out)))
+
+if __name__ == "__main__":
+  main()
@@ -436,7 +436,21 @@ class FTP_client:
           import ecp5
           ecp5.passthru()
           cl.sendall('250 OK passthru\r\n')
-        elif path.endswith(".bit") or path.endswith(".bit.gz"):
+        elif path == "/session":
+          import ecp5
+          ecp5.session_open()
+          cl.sendall('250 OK JTAG stays on until site release\r\n')
+        elif path == "/release":
+          import ecp5
+          ecp5.session_close()
+          cl.sendall('250 OK JTAG released\r\n')
+        elif path == "/stats":
+          import ecp5
+          cl.sendall("211-JTAG stats of last fpga/flash upload\r\n")
+          for k, v in sorted(ecp5.stats().items()):
+            cl.sendall(" {} {}\r\n".format(k, v))
+          cl.sendall("211 Done.\r\n")
+        elif path.endswith(".bit") or path.endswith(".bit.gz") or path.endswith(".bit.lz4") or path.endswith(".bitc"):
           try:
             import ecp5
             if ecp5.prog(path, prog_close=False):
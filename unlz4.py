@@ -0,0 +1,168 @@
+# micropython ESP32
+# LZ4 frame decompressor
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# streaming reader for LZ4 frames (magic 04 22 4D 18)
+# with independent blocks, as made by tools/lz4pack.py
+# or "lz4" (not "lz4 -BD"). Each block is read whole and decoded by
+# viper, RAM is 2x block size: 16K blocks need 32K.
+# usage:
+# import unlz4
+# f = unlz4.DecompIO(open("blink.bit.lz4", "rb"))
+# f.readinto(buf)
+
+from struct import unpack, unpack_from
+
+magic = 0x184D2204
+block_max = (0, 0, 0, 0, 0x10000, 0x40000, 0x100000, 0x400000) # by BD bits 6-4
+
+# decode one LZ4 block from src[0:n] to dst
+# returns decoded length, -1 if it doesn't fit in cap
+# or refers before start of the block
+@micropython.viper
+def lz4_block(src:ptr8, n:int, dst:ptr8, cap:int)->int:
+  i = 0
+  o = 0
+  while i < n:
+    token = src[i]
+    i += 1
+    l = token >> 4
+    if l == 15:
+      while i < n:
+        b = src[i]
+        i += 1
+        l += b
+        if b != 255:
+          break
+    if o+l > cap or i+l > n:
+      return -1
+    e = i+l
+    while i < e:
+      dst[o] = src[i]
+      o += 1
+      i += 1
+    if i >= n: # last sequence has only literals
+      break
+    off = src[i] | (src[i+1] << 8)
+    i += 2
+    if off == 0 or off > o:
+      return -1
+    l = token & 15
+    if l == 15:
+      while i < n:
+        b = src[i]
+        i += 1
+        l += b
+        if b != 255:
+          break
+    l += 4
+    if o+l > cap:
+      return -1
+    e = o+l
+    while o < e: # may overlap, byte by byte
+      dst[o] = dst[o-off]
+      o += 1
+  return o
+
+# read until buf is full or end of file
+def readinto_full(stream, buf):
+  mv = memoryview(buf)
+  n = 0
+  while n < len(mv):
+    r = stream.readinto(mv[n:])
+    if not r:
+      break
+    n += r
+  return n
+
+# frame header: flags, max block size, content size (0 unknown)
+# stream is left at the first block
+def read_header(stream):
+  h = bytearray(6)
+  if readinto_full(stream, h) != 6 or unpack_from("<I", h)[0] != magic:
+    raise ValueError("not LZ4 frame")
+  flg = h[4]
+  if flg & 0xC0 != 0x40:
+    raise ValueError("LZ4 version")
+  size = 0
+  c = bytearray(8)
+  if flg & 8: # content size
+    readinto_full(stream, c)
+    size = unpack("<Q", c)[0]
+  if flg & 1: # dictionary id
+    readinto_full(stream, memoryview(c)[:4])
+  readinto_full(stream, memoryview(c)[:1]) # header checksum
+  return flg, block_max[(h[5] >> 4) & 7], size
+
+# decompressed length from header of LZ4 file, 0 if unknown
+def content_size(filename):
+  with open(filename, "rb") as f:
+    return read_header(f)[2]
+
+class DecompIO:
+  # blocksize: initial output buffer, grows up to
+  # max block size of the frame if a block needs more
+  def __init__(self, stream, blocksize=16384):
+    self.stream = stream
+    flg, self.block_max, self.size = read_header(stream)
+    if not flg & 0x20:
+      raise ValueError("LZ4 linked blocks (lz4 -BD) not supported")
+    self.block_crc = flg & 0x10
+    self.content_crc = flg & 4
+    self.out = bytearray(min(blocksize, self.block_max))
+    self.src = bytearray(min(blocksize, self.block_max))
+    self.hdr = bytearray(4)
+    self.data = memoryview(self.out)[:0]
+    self.pos = 0
+    self.eof = False
+
+  # next block to self.data, False at end of frame
+  def next_block(self):
+    if readinto_full(self.stream, self.hdr) != 4:
+      return False
+    n = unpack("<I", self.hdr)[0]
+    if n == 0: # end mark
+      if self.content_crc:
+        readinto_full(self.stream, self.hdr)
+      return False
+    raw = n >> 31
+    n &= 0x7FFFFFFF
+    if n > self.block_max:
+      raise ValueError("LZ4 block size")
+    if n > len(self.src):
+      self.src = None
+      self.src = bytearray(n)
+    src = memoryview(self.src)[:n]
+    if readinto_full(self.stream, src) != n:
+      raise ValueError("LZ4 truncated")
+    if self.block_crc:
+      readinto_full(self.stream, self.hdr)
+    if raw:
+      self.data = src
+    else:
+      l = lz4_block(self.src, n, self.out, len(self.out))
+      if l < 0 and len(self.out) < self.block_max:
+        self.out = None
+        self.out = bytearray(self.block_max)
+        l = lz4_block(self.src, n, self.out, len(self.out))
+      if l < 0:
+        raise ValueError("LZ4 corrupt block")
+      self.data = memoryview(self.out)[:l]
+    self.pos = 0
+    return True
+
+  def readinto(self, buf):
+    if self.pos >= len(self.data):
+      if self.eof or not self.next_block():
+        self.eof = True
+        return 0
+    n = min(len(buf), len(self.data)-self.pos)
+    buf[:n] = self.data[self.pos:self.pos+n]
+    self.pos += n
+    return n
+
+  def read(self, n):
+    buf = bytearray(n)
+    return buf[:readinto_full(self, memoryview(buf))]